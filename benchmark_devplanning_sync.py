@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the check and update pipeline on made up data.
+
+generate_sources builds Dev Planning and Aries pulls shaped like the real
+ones, with set rates of missing values, mismatches and duplicate keys, from
+a fixed seed so every run sees the same data. Each stage of run_checks and
+the update staging is timed, and its peak memory is measured in a separate
+pass under tracemalloc so the tracing doesn't skew the times.
+
+    python benchmark_devplanning_sync.py --sizes 10000 100000 1000000
+    python benchmark_devplanning_sync.py --save-baseline baseline.json
+    python benchmark_devplanning_sync.py --baseline baseline.json
+
+With --end-to-end the made up pulls are also written to a SQLite stand-in
+for Dev Planning and Aries (see devplanning_sync_sqlite), and the real
+pull, check, update and post update QC are timed against it:
+
+    python benchmark_devplanning_sync.py --sizes 100000 --end-to-end
+
+With --baseline the run exits with 1 if any stage got slower than the
+baseline by more than --tolerance. Baselines are only comparable on the
+same machine, so none is kept in the repo.
+"""
+import argparse
+import json
+import platform
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from devplanning_syn_GUI_functions import get_aries_engine
+from devplanning_syn_GUI_functions import load_sources
+from devplanning_syn_GUI_functions import use_backend
+from devplanning_sync import check
+from devplanning_sync_functions import _stage_changes
+from devplanning_sync_functions import add_derived_columns
+from devplanning_sync_functions import aries_changes
+from devplanning_sync_functions import ARIES_PRIORITY
+from devplanning_sync_functions import ARIES_SCHEMA
+from devplanning_sync_functions import ARIES_UPDATES
+from devplanning_sync_functions import cast_columns
+from devplanning_sync_functions import coalesce_columns
+from devplanning_sync_functions import combine_sources
+from devplanning_sync_functions import compare_columns
+from devplanning_sync_functions import compare_fields
+from devplanning_sync_functions import compare_numeric_columns
+from devplanning_sync_functions import dev_planning_columns
+from devplanning_sync_functions import DP_PRIORITY
+from devplanning_sync_functions import DP_SCHEMA
+from devplanning_sync_functions import FIELD_CHECKS
+from devplanning_sync_functions import field_view
+from devplanning_sync_functions import hierarchical_select
+from devplanning_sync_functions import pending_updates
+from devplanning_sync_functions import resolve_duplicates
+from devplanning_sync_functions import update_tables
+from devplanning_sync_sqlite import seed_sqlite
+from devplanning_sync_sqlite import sqlite_backend
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+# hierarchical_select works one value at a time, so it's only timed on this
+# many rows whatever the size.
+HIERARCHICAL_SELECT_ROWS = 1000
+
+# The business unit the end-to-end stages sync. generate_sources puts half
+# the wells in it.
+END_TO_END_UNIT = 'SOUTH TEXAS'
+
+# A stage only counts as a regression when it's slower by more than the
+# tolerance and by more than this many seconds, so millisecond stages
+# don't fail the run on noise.
+NOISE_FLOOR = 0.05
+
+
+def _pick(rng, n_rows, rate):
+    """
+    Returns a boolean mask with about rate of n_rows set.
+    """
+    return rng.random(n_rows) < rate
+
+
+def _names(prefix, numbers):
+    return prefix + pd.Series(numbers).astype(str)
+
+
+def generate_sources(n_wells, null_rate=0.02, mismatch_rate=0.05,
+                     duplicate_rate=0.01, seed=0):
+    """
+    Builds a Dev Planning pull and an Aries pull for n_wells wells.
+
+    Args:
+        n_wells: Number of wells both sides know about before the orphans
+                 and duplicates are added.
+        null_rate: Share of values left empty on the Aries side, and of
+                   wells only one side has.
+        mismatch_rate: Share of values that differ between the two sides.
+                       Half of the name mismatches only differ in case and
+                       punctuation.
+        duplicate_rate: Share of wells that get a second, lower priority
+                        row on each side.
+        seed: Seed for the random numbers.
+
+    Returns:
+        Tuple of (dev_planning, aries) cast to DP_SCHEMA and ARIES_SCHEMA.
+    """
+    rng = np.random.default_rng(seed)
+    numbers = np.arange(n_wells)
+    codes = _names('BM', numbers).str.zfill(10).to_numpy()
+
+    sl_lat = rng.uniform(28.0, 31.0, n_wells)
+    sl_long = rng.uniform(-99.0, -96.0, n_wells)
+    heading = rng.uniform(0, 2 * np.pi, n_wells)
+    lateral = rng.uniform(0.01, 0.04, n_wells)
+    bh_lat = sl_lat + lateral * np.sin(heading)
+    bh_long = sl_long + lateral * np.cos(heading)
+    lp_lat = sl_lat + 0.1 * lateral * np.sin(heading)
+    lp_long = sl_long + 0.1 * lateral * np.cos(heading)
+    waypoint = _pick(rng, n_wells, 0.5)
+    completable = np.round(lateral * 364000, 0)
+
+    dev_planning = pd.DataFrame({
+        'ARIES_ID': np.where(_pick(rng, n_wells, null_rate), None, codes),
+        'WELL_NAME': _names('SMITH-JONES UNIT ', numbers).to_numpy() + 'H',
+        'RSV_CAT': '5PUD',
+        'BUSINESS_UNIT': np.where(numbers % 2, 'SOUTH TEXAS',
+                                  'BRAZOS VALLEY'),
+        'SCENARIO': 'A',
+        'DEV_STATUS': 'PRIMARY',
+        'PSID': numbers + 100000,
+        'PROP_NUM': _names('', numbers).str.zfill(6).to_numpy(),
+        'PROJECT_NAME': _names('PROJECT ', numbers // 200).to_numpy(),
+        'PAD_NAME': _names('PAD ', numbers // 4).to_numpy(),
+        'MKT_DEDICATION_AREA': np.where(numbers % 3, 'MDA EAST', 'MDA WEST'),
+        'SL_LAT': sl_lat,
+        'SL_LONG': sl_long,
+        'WAYPOINT1_LAT': np.where(waypoint, lp_lat, np.nan),
+        'WAYPOINT1_LONG': np.where(waypoint, lp_long, np.nan),
+        'LP_LAT': lp_lat,
+        'LP_LONG': lp_long,
+        'BHL_LAT': bh_lat,
+        'BHL_LONG': bh_long,
+        'COMPLETABLE_LL': completable,
+        })
+
+    aries = pd.DataFrame({
+        'ARIES_CODE': codes,
+        'BUSINESS_UNIT': dev_planning.BUSINESS_UNIT,
+        'RSV_CAT': '5PUD',
+        'PROP_NUM': dev_planning.PROP_NUM,
+        'PRESPUDWELLID': dev_planning.PSID.astype(str),
+        'USER3': None,
+        'LEASE': dev_planning.WELL_NAME,
+        'PAD_NAME': dev_planning.PAD_NAME,
+        'LAT_SURFACE': sl_lat,
+        'LONG_SURFACE': sl_long,
+        'LAT_TARGET': lp_lat,
+        'LONG_TARGET': lp_long,
+        'LAT_BH': bh_lat,
+        'LONG_BH': bh_long,
+        'PLANNED_SH_LAT': sl_lat,
+        'PLANNED_SH_LONG': sl_long,
+        'PLANNED_TARGET_LAT': lp_lat,
+        'PLANNED_TARGET_LONG': lp_long,
+        'PLANNED_BH_LAT': bh_lat,
+        'PLANNED_BH_LONG': bh_long,
+        'LATERAL_LEN': completable,
+        'PLANNED_LL': completable,
+        'PROJECT_NAME': dev_planning.PROJECT_NAME,
+        'MDA': dev_planning.MKT_DEDICATION_AREA,
+        'TD_DATE': None,
+        })
+
+    # Differences between the two sides.
+    for column in ['LEASE', 'PAD_NAME', 'PROJECT_NAME', 'PROP_NUM']:
+        changed = _pick(rng, n_wells, mismatch_rate)
+        cosmetic = changed & _pick(rng, n_wells, 0.5)
+        aries.loc[changed & ~cosmetic, column] = (
+            aries.loc[changed & ~cosmetic, column] + ' OLD')
+        aries.loc[cosmetic, column] = (aries.loc[cosmetic, column]
+                                       .str.lower().str.replace('-', ' '))
+    for column in ['LAT_SURFACE', 'LAT_TARGET', 'LAT_BH', 'PLANNED_SH_LAT',
+                   'PLANNED_TARGET_LAT', 'PLANNED_BH_LAT']:
+        changed = _pick(rng, n_wells, mismatch_rate)
+        aries.loc[changed, column] += rng.normal(0, 0.001, changed.sum())
+    for column in ['LATERAL_LEN', 'PLANNED_LL']:
+        changed = _pick(rng, n_wells, mismatch_rate)
+        aries.loc[changed, column] += rng.integers(50, 500, changed.sum())
+    changed = _pick(rng, n_wells, mismatch_rate)
+    aries.loc[changed, 'PRESPUDWELLID'] = None
+
+    # Values missing in Aries.
+    for column in aries.columns.drop(['ARIES_CODE', 'BUSINESS_UNIT',
+                                      'RSV_CAT', 'USER3', 'TD_DATE']):
+        aries.loc[_pick(rng, n_wells, null_rate), column] = None
+
+    # Wells Aries has that Dev Planning doesn't.
+    orphans = aries.loc[_pick(rng, n_wells, null_rate)].copy()
+    orphans['ARIES_CODE'] = 'ORPHAN' + orphans.ARIES_CODE
+    aries = pd.concat([aries, orphans], ignore_index=True)
+
+    # Lower priority copies of some wells on both sides.
+    copies = _pick(rng, n_wells, duplicate_rate)
+    dev_planning = pd.concat(
+        [dev_planning, dev_planning.loc[copies].assign(SCENARIO='MDV')],
+        ignore_index=True)
+    aries = pd.concat(
+        [aries, aries.loc[np.flatnonzero(copies)].assign(RSV_CAT='6PROB')],
+        ignore_index=True)
+
+    return cast_columns(dev_planning, DP_SCHEMA), cast_columns(aries,
+                                                               ARIES_SCHEMA)
+
+
+def _stage_updates(state):
+    """
+    Builds the staging frames update_tables would upload, one per table,
+    without a database.
+    """
+    tables = {}
+    for change in aries_changes(state['results'], state['combined_df'],
+                                list(FIELD_CHECKS), 'SOUTH TEXAS'):
+        tables.setdefault(change[0], []).append(change[1:5])
+    return {table: _stage_changes(changes)[0]
+            for table, changes in tables.items()}
+
+
+def _check_stages():
+    """
+    Returns the stages to time as (name, function) pairs. Each function
+    takes a dict holding the pulls and whatever the earlier stages stored.
+    """
+    def dedupe(state):
+        state['dp_unique'] = resolve_duplicates(
+            state['dev_planning'], 'ARIES_ID', DP_PRIORITY)[0]
+        state['aries_unique'] = resolve_duplicates(
+            state['aries'], 'ARIES_CODE', ARIES_PRIORITY)[0]
+
+    def combine(state):
+        state['combined_df'] = combine_sources(state['dp_unique'],
+                                               state['aries_unique'])[0]
+
+    def derive(state):
+        add_derived_columns(state['combined_df'])
+
+    def compare(state):
+        state['results'] = compare_fields(FIELD_CHECKS, state['combined_df'])
+
+    def views(state):
+        for field in FIELD_CHECKS:
+            field_view(state['results'], state['combined_df'], field)
+
+    def stage_updates(state):
+        _stage_updates(state)
+
+    def single_text(state):
+        compare_columns('WELL_NAME', 'LEASE', state['combined_df'])
+
+    def single_numeric(state):
+        compare_numeric_columns('COMPLETABLE_LL', 'LATERAL_LEN',
+                                state['combined_df'])
+
+    def coalesce(state):
+        coalesce_columns([state['combined_df'].USER3,
+                          state['combined_df'].PRESPUDWELLID], int)
+
+    def hierarchical(state):
+        sample = state['combined_df'].iloc[:HIERARCHICAL_SELECT_ROWS]
+        for primary, secondary in zip(sample.USER3, sample.PRESPUDWELLID):
+            hierarchical_select(primary, secondary, int)
+
+    return [('resolve_duplicates', dedupe),
+            ('combine_sources', combine),
+            ('add_derived_columns', derive),
+            ('compare_fields', compare),
+            ('field_view', views),
+            ('stage_updates', stage_updates),
+            ('compare_columns', single_text),
+            ('compare_numeric_columns', single_numeric),
+            ('coalesce_columns', coalesce),
+            ('hierarchical_select', hierarchical)]
+
+
+def _end_to_end_stages(path):
+    """
+    Returns the stages of a sync round trip against a SQLite file, as
+    (name, function) pairs like _check_stages. The first stage seeds the
+    file, so every pass starts from the same data.
+    """
+    fields = list(ARIES_UPDATES)
+    columns = dev_planning_columns(fields)
+
+    def seed(state):
+        seed_sqlite(path, state['dev_planning'], state['aries'])
+
+    def pull(state):
+        state['pulled'] = load_sources(END_TO_END_UNIT, columns,
+                                       force_refresh=True)[:2]
+
+    def checks(state):
+        state['checks'] = check(*state['pulled'], fields)
+
+    def update(state):
+        update_tables(aries_changes(state['checks']['results'],
+                                    state['checks']['combined_df'], fields,
+                                    END_TO_END_UNIT),
+                      get_aries_engine())
+
+    def qc(state):
+        pulled = load_sources(END_TO_END_UNIT, columns,
+                              force_refresh=True)[:2]
+        pending = pending_updates(check(*pulled, fields)['results'])
+        if pending:
+            raise RuntimeError(f'{pending} values were still to push after '
+                               'the update.')
+
+    return [('sqlite_seed', seed),
+            ('sqlite_pull', pull),
+            ('sqlite_check', checks),
+            ('sqlite_update', update),
+            ('sqlite_qc', qc)]
+
+
+def _time_stages(stages, dev_planning, aries, repeat):
+    """
+    Runs the stages repeat times, then once more under tracemalloc.
+
+    Returns:
+        Dict of stage: {'seconds': fastest time, 'peak_mb': peak memory
+        allocated during the stage}.
+    """
+    seconds = {name: float('inf') for name, _ in stages}
+    for _ in range(repeat):
+        state = {'dev_planning': dev_planning, 'aries': aries}
+        for name, function in stages:
+            started = time.perf_counter()
+            function(state)
+            seconds[name] = min(seconds[name], time.perf_counter() - started)
+
+    # Tracing slows Python code down a lot, so memory gets its own pass.
+    peaks = {}
+    state = {'dev_planning': dev_planning, 'aries': aries}
+    tracemalloc.start()
+    try:
+        for name, function in stages:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            function(state)
+            peaks[name] = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+    return {name: {'seconds': round(seconds[name], 4),
+                   'peak_mb': round(peaks[name] / 2 ** 20, 2)}
+            for name, _ in stages}
+
+
+def benchmark(dev_planning, aries, repeat=3):
+    """
+    Times every stage on a pair of pulls and measures its peak memory.
+
+    Args:
+        dev_planning, aries: Pulls from generate_sources.
+        repeat: Number of timed passes. The fastest time of each stage is
+                kept.
+
+    Returns:
+        Dict of stage: {'seconds': fastest time, 'peak_mb': peak memory
+        allocated during the stage}.
+    """
+    return _time_stages(_check_stages(), dev_planning, aries, repeat)
+
+
+def benchmark_end_to_end(dev_planning, aries, repeat=3, folder=None):
+    """
+    Times a sync round trip on a pair of pulls: they are written to a SQLite
+    stand-in, then END_TO_END_UNIT is pulled, checked, updated and pulled
+    and checked again through the same loaders, checks and update SQL as a
+    real run. The stand-in is only in use for the length of the call.
+
+    Args:
+        dev_planning, aries: Pulls from generate_sources.
+        repeat: Number of timed passes. The fastest time of each stage is
+                kept.
+        folder: Where to write the SQLite file. A temporary folder is used
+                and removed when None.
+
+    Returns:
+        Dict of stage: {'seconds', 'peak_mb'} like benchmark.
+
+    Raises:
+        RuntimeError: The QC pull still found values to push, so the updates
+                      didn't land.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(folder or scratch, 'devplanning_sync.db')
+        previous = use_backend(sqlite_backend(path))
+        try:
+            return _time_stages(_end_to_end_stages(path), dev_planning,
+                                aries, repeat)
+        finally:
+            # Closes the engine's connections so the file can be removed.
+            use_backend(previous)
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, null_rate=0.02, mismatch_rate=0.05,
+                   duplicate_rate=0.01, seed=0, repeat=3, end_to_end=False):
+    """
+    Runs benchmark for every size, and benchmark_end_to_end too with
+    end_to_end.
+
+    Returns:
+        Report dict with the parameters, the versions it ran on, and the
+        stage results keyed by size.
+    """
+    parameters = {'null_rate': null_rate,
+                  'mismatch_rate': mismatch_rate,
+                  'duplicate_rate': duplicate_rate,
+                  'seed': seed}
+    report = {'parameters': parameters,
+              'versions': {'python': platform.python_version(),
+                           'numpy': np.__version__,
+                           'pandas': pd.__version__},
+              'results': {}}
+    for size in sizes:
+        dev_planning, aries = generate_sources(size, **parameters)
+        report['results'][str(size)] = benchmark(dev_planning, aries, repeat)
+        if end_to_end:
+            report['results'][str(size)].update(
+                benchmark_end_to_end(dev_planning, aries, repeat))
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance=0.25,
+                        noise_floor=NOISE_FLOOR):
+    """
+    Finds the stages that got slower than in a baseline report. Sizes and
+    stages the baseline doesn't have are skipped.
+
+    Args:
+        report: Output of run_benchmarks.
+        baseline: An earlier report run with the same parameters.
+        tolerance: Share a stage may slow down by before it counts.
+        noise_floor: Seconds a stage may slow down by before it counts.
+
+    Returns:
+        List of messages, one per regression. Empty when there are none.
+
+    Raises:
+        ValueError: The baseline was run with different parameters.
+    """
+    if baseline['parameters'] != report['parameters']:
+        raise ValueError('The baseline was run with different parameters: '
+                         f"{baseline['parameters']}")
+
+    regressions = []
+    for size, stages in report['results'].items():
+        for stage, result in stages.items():
+            before = baseline['results'].get(size, {}).get(stage)
+            if before is None:
+                continue
+            slower = result['seconds'] - before['seconds']
+            if slower > noise_floor and slower > before['seconds'] * tolerance:
+                regressions.append(
+                    f"{stage} at {size} wells: {result['seconds']:.3f} s, "
+                    f"baseline {before['seconds']:.3f} s")
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+
+    Returns:
+        0 when there are no regressions, 1 when there are, 2 when the
+        baseline can't be compared.
+    """
+    parser = argparse.ArgumentParser(
+        prog='benchmark_devplanning_sync',
+        description='Time the check and update pipeline on made up data.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                        help='Numbers of wells to generate.')
+    parser.add_argument('--null-rate', type=float, default=0.02)
+    parser.add_argument('--mismatch-rate', type=float, default=0.05)
+    parser.add_argument('--duplicate-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timed passes per size. The fastest is kept.')
+    parser.add_argument('--end-to-end', action='store_true',
+                        help='Also time the pull, check and update against '
+                             'a SQLite stand-in for both databases.')
+    parser.add_argument('--baseline',
+                        help='Report to compare against. Exits with 1 when '
+                             'a stage is slower.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Share a stage may slow down by.')
+    parser.add_argument('--save-baseline',
+                        help='Write the report here to compare later runs '
+                             'against.')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sizes, args.null_rate, args.mismatch_rate,
+                            args.duplicate_rate, args.seed, args.repeat,
+                            args.end_to_end)
+
+    code = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        try:
+            report['regressions'] = compare_to_baseline(report, baseline,
+                                                         args.tolerance)
+        except ValueError as e:
+            report['error'] = str(e)
+            code = 2
+        else:
+            code = 1 if report['regressions'] else 0
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+
+    print(json.dumps(report, indent=2))
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
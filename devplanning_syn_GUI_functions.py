@@ -6,86 +6,532 @@ Created on Tue Jan 31 16:21:22 2023
 """
 
 # This file houses the functions used for the GUI version of the DP sync.
+import contextvars
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import pyodbc
-import tkinter as tk
+import sqlalchemy
 
+from devplanning_sync_cache import CACHE_DIR
+from devplanning_sync_cache import cached_pull
+from devplanning_sync_cache import DEFAULT_TTL
+from devplanning_sync_cache import WATERMARK_COLUMN
+from devplanning_sync_functions import ARIES_SCHEMA
+from devplanning_sync_functions import cast_columns
+from devplanning_sync_functions import concat_chunks
 from devplanning_sync_functions import connect_to_snowflake
+from devplanning_sync_functions import DP_BASE_COLUMNS
+from devplanning_sync_functions import DP_SCHEMA
+from devplanning_sync_functions import read_sql_chunked
+from devplanning_sync_trace import frame_bytes
+from devplanning_sync_trace import trace_stage
 
 
-def _load_snowflake(business_unit):
-    sf_conn = connect_to_snowflake()
+# SQL expression for when a row was last changed in each source, e.g.
+# 'DP.LAST_MODIFIED' or, for Aries where a row spans two tables,
+# 'CASE WHEN M.LAST_UPDATE > B.LAST_UPDATE THEN M.LAST_UPDATE
+# ELSE B.LAST_UPDATE END'. A rowversion works too once cast to BIGINT.
+# When set, a stale snapshot is topped up with only the rows changed since
+# the last pull. When None every pull past the snapshot TTL is a full pull.
+WATERMARKS = {'dev_planning': None,
+              'aries': None}
 
-    snowflake_string = r"""
+DP_SCENARIOS = ['A', 'MDV']
+DP_DEV_STATUSES = ['PRIMARY', 'DEVELOPMENT']
+ARIES_RSV_CATS = ['5PUD', '5PUDX', '6PROB', '7POSS']
+
+ARIES_COLUMNS = ['M.ARIES_CODE',
+                 'M.BUSINESS_UNIT',
+                 'M.RSV_CAT',
+                 'M.PROP_NUM',
+                 'M.PRESPUDWELLID',
+                 'M.USER3',
+                 'M.LEASE',
+                 'M.SPUDDER_DATE',
+                 'M.FIRST_PROD',
+                 'M.PAD_NAME',
+                 'M.LAT_SURFACE',
+                 'M.LONG_SURFACE',
+                 'M.LAT_TARGET',
+                 'M.LONG_TARGET',
+                 'M.LAT_BH',
+                 'M.LONG_BH',
+                 'B.PLANNED_SH_LAT',
+                 'B.PLANNED_SH_LONG',
+                 'B.PLANNED_TARGET_LAT',
+                 'B.PLANNED_TARGET_LONG',
+                 'B.PLANNED_BH_LAT',
+                 'B.PLANNED_BH_LONG',
+                 'M.LATERAL_LEN',
+                 'B.PLANNED_LL',
+                 'B.PROJECT_NAME',
+                 'M.MDA',
+                 'M.RESV_ENG',
+                 'M.RESERVOIR',
+                 'M.TYPECURVE',
+                 'M.TYPECURVE_SHORT',
+                 'M.TD_DATE',
+                 'B.AFE_DATE']
+
+# Aries columns the in_aries_not_dp report needs. A semi-join pull only
+# fetches these for the Aries cases Dev Planning doesn't have.
+ARIES_KEY_COLUMNS = ['M.ARIES_CODE', 'M.BUSINESS_UNIT', 'M.RSV_CAT',
+                     'M.LEASE', 'M.TD_DATE']
+
+# Snowflake won't take more than this many values in one IN list.
+SNOWFLAKE_MAX_IN_LIST = 16384
+
+SNOWFLAKE_QUERY = r"""
     SELECT
-        *
+        {select_list}
     FROM
-        SOURCE.GIS.DEV_PLANNING AS DP
+        {dev_planning} AS DP
     WHERE
-        (DP.BUSINESS_UNIT = '{business_unit}')
-        AND DP.SCENARIO IN ('A', 'MDV')
-        AND DP.DEV_STATUS IN ('PRIMARY', 'DEVELOPMENT')
-    """.format(business_unit=business_unit)
+        DP.BUSINESS_UNIT IN ({business_units})
+        {filters}
+    """
+
+ARIES_QUERY = r"""
+    SELECT
+        {select_list}
+    FROM {ac_property} AS M
+    INNER JOIN {ac_budget} AS B
+        ON M.PROPNUM = B.PROPNUM
+    WHERE
+        M.BUSINESS_UNIT IN ({business_units})
+        {filters};
+    """
+
+
+def _sql_list(values):
+    """
+    Formats values as the inside of a SQL IN (...) list.
+    """
+    return ','.join(f"'{value}'" for value in values)
+
+
+def _business_units(business_unit):
+    """
+    Returns the business units a loader was asked for as a sorted list, and
+    the name the pull's snapshot is saved under.
+    """
+    if isinstance(business_unit, str):
+        units = [business_unit]
+    else:
+        units = sorted(set(business_unit))
+    return units, ', '.join(units)
+
+
+def _dp_select_list(columns):
+    """
+    Returns the Snowflake select list for a list of DEV_PLANNING columns,
+    or * for all of them when columns is None.
+    """
+    if columns is None:
+        return '*'
+    return ',\n        '.join(f'DP.{column}' for column in columns)
+
+
+def _dp_filters():
+    return """AND DP.SCENARIO IN ({scenarios})
+        AND DP.DEV_STATUS IN ({dev_statuses})""".format(
+        scenarios=_sql_list(DP_SCENARIOS),
+        dev_statuses=_sql_list(DP_DEV_STATUSES))
+
 
-    dev_planning = pd.read_sql(snowflake_string, sf_conn)
-    sf_conn.close()
-    return dev_planning
+def _aries_filters():
+    return 'AND M.RSV_CAT IN ({rsv_cats})'.format(
+        rsv_cats=_sql_list(ARIES_RSV_CATS))
 
 
-def _load_aries(business_unit):
+def _connect_to_aries():
     uid = os.getlogin()
-    conn = pyodbc.connect(
+    return pyodbc.connect(
         r'DRIVER={ODBC Driver 17 for SQL Server};' + r' uid={' + uid + r'};' +\
             r'server={Aries-prod}; Database={Working_District}; Trusted_Connection=yes')
 
-    # Write Query string from SQL
-    aries_string = r"""
-    SELECT
-        M.ARIES_CODE,
-        M.RSV_CAT,
-        M.PROP_NUM,
-        M.PRESPUDWELLID,
-        M.USER3,
-        M.LEASE,
-        M.SPUDDER_DATE,
-        M.FIRST_PROD,
-        M.PAD_NAME,
-        M.LAT_SURFACE,
-        M.LONG_SURFACE,
-        M.LAT_TARGET,
-        M.LONG_TARGET,
-        M.LAT_BH,
-        M.LONG_BH,
-        B.PLANNED_SH_LAT,
-        B.PLANNED_SH_LONG,
-        B.PLANNED_TARGET_LAT,
-        B.PLANNED_TARGET_LONG,
-        B.PLANNED_BH_LAT,
-        B.PLANNED_BH_LONG,
-        M.LATERAL_LEN,
-        B.PLANNED_LL,
-        B.PROJECT_NAME,
-        M.MDA,
-        M.RESV_ENG,
-        M.RESERVOIR,
-        M.TYPECURVE,
-        M.TYPECURVE_SHORT,
-        M.TD_DATE,
-        B.AFE_DATE
-    FROM [Working_District].[AriesAdmin].[AC_PROPERTY] AS M
-    INNER JOIN [Working_District].[AriesAdmin].[AC_BUDGET] AS B
-        ON M.PROPNUM = B.PROPNUM
-    WHERE
-        (M.BUSINESS_UNIT ='{business_unit}')
-        AND M.RSV_CAT IN ('5PUD','5PUDX','6PROB','7POSS');
-    """.format(business_unit=business_unit)
 
-    aries = pd.read_sql(aries_string, conn)
-    conn.close()
+# Where the loaders and get_aries_engine find Dev Planning and Aries.
+#   connect_dev_planning, connect_aries: Functions returning a new DB-API
+#       connection to each side.
+#   aries_url, engine_options: What get_aries_engine creates its engine
+#       with. The updates are written for the engine's dialect.
+#   tables: Names the pull queries use for DEV_PLANNING, AC_PROPERTY and
+#       AC_BUDGET.
+#   keys_table: Temp table a semi-join pull stages the Dev Planning keys in.
+#   cache_dir: Folder the pulls' snapshots are kept in, so pulls from
+#       different backends never overwrite each other.
+# Switch with use_backend. devplanning_sync_sqlite builds a SQLite one for
+# working offline.
+PRODUCTION = {
+    'name': 'production',
+    'connect_dev_planning': connect_to_snowflake,
+    'connect_aries': _connect_to_aries,
+    'aries_url': 'mssql://@Aries-prod/Working_District'
+                 '?driver=ODBC Driver 17 for SQL Server',
+    # fast_executemany sends the staging uploads as bulk inserts.
+    'engine_options': {'fast_executemany': True},
+    'tables': {'dev_planning': 'SOURCE.GIS.DEV_PLANNING',
+               'ac_property': '[Working_District].[AriesAdmin].[AC_PROPERTY]',
+               'ac_budget': '[Working_District].[AriesAdmin].[AC_BUDGET]'},
+    'keys_table': '#keys',
+    'cache_dir': CACHE_DIR,
+}
+
+backend = PRODUCTION
+aries_engine = None
+
+
+def use_backend(new_backend):
+    """
+    Points the loaders and get_aries_engine at another backend, e.g.
+    PRODUCTION or a devplanning_sync_sqlite.sqlite_backend.
+
+    Returns:
+        The backend that was in use, so it can be put back.
+    """
+    global aries_engine, backend
+    previous = backend
+    if aries_engine is not None:
+        aries_engine.dispose()
+    backend = new_backend
+    aries_engine = None
+    return previous
+
+
+def current_backend():
+    """
+    Returns the backend set with use_backend, PRODUCTION by default.
+    """
+    return backend
+
+
+def get_aries_engine():
+    """
+    Returns the SQLAlchemy engine for Working District, or the Aries of the
+    backend in use, creating it the first time it's needed. Reusing the
+    engine keeps its connection pool between pushes.
+    """
+    global aries_engine
+    if aries_engine is None:
+        aries_engine = sqlalchemy.create_engine(backend['aries_url'],
+                                                **backend['engine_options'])
+    return aries_engine
+
+
+def _load_snowflake(business_unit, columns=None, force_refresh=False,
+                    ttl=DEFAULT_TTL):
+    """
+    Pulls the active Dev Planning rows for a business unit from Snowflake,
+    or from the local snapshot if the same pull was made within ttl seconds.
+    An older snapshot is topped up with the rows changed since it was
+    pulled if WATERMARKS has a Dev Planning expression.
+
+    Args:
+        business_unit: The name of the business unit you are updating, or
+                       a list of them to pull in one query.
+        columns: DEV_PLANNING columns to select, usually from
+                 dev_planning_columns. Every column is pulled when None.
+        force_refresh: Skip the snapshot and query Snowflake.
+        ttl: Oldest snapshot to reuse, in seconds.
+    """
+    units, snapshot_name = _business_units(business_unit)
+    select_list = _dp_select_list(columns)
+    watermark = WATERMARKS['dev_planning']
+    if watermark is not None:
+        select_list += f',\n        {watermark} AS {WATERMARK_COLUMN}'
+
+    def delta_query(since):
+        # An ARIES_ID can have several rows, e.g. an A and an MDV scenario,
+        # so every row of an ARIES_ID with a change comes back, along with
+        # every row with no ARIES_ID, which can't be matched up. See
+        # merge_snapshot. Rows that left the filters since the last pull
+        # have to come back too, so they are dropped locally instead of in
+        # the query.
+        changed = SNOWFLAKE_QUERY.format(
+            select_list='DP.ARIES_ID', business_units=_sql_list(units),
+            filters=f"AND {watermark} > '{since}'", **backend['tables'])
+        return SNOWFLAKE_QUERY.format(
+            select_list=select_list, business_units=_sql_list(units),
+            filters=f'AND (DP.ARIES_ID IS NULL OR DP.ARIES_ID IN ({changed}))',
+            **backend['tables'])
+
+    def keep(frame):
+        return (frame.SCENARIO.isin(DP_SCENARIOS)
+                & frame.DEV_STATUS.isin(DP_DEV_STATUSES))
+
+    # The connection is only made once the snapshot has missed, so a hit
+    # skips the browser login.
+    def pull(query):
+        sf_conn = backend['connect_dev_planning']()
+        dev_planning = read_sql_chunked(query, sf_conn, DP_SCHEMA)
+        sf_conn.close()
+        return dev_planning
+
+    return cached_pull(
+        'dev_planning', snapshot_name,
+        SNOWFLAKE_QUERY.format(select_list=select_list,
+                               business_units=_sql_list(units),
+                               filters=_dp_filters(), **backend['tables']),
+        pull, ttl, force_refresh,
+        delta_query=delta_query if watermark is not None else None,
+        key='ARIES_ID', keep=keep, cache_dir=backend['cache_dir'])
+
+
+def _load_aries(business_unit, force_refresh=False, ttl=DEFAULT_TTL):
+    """
+    Pulls the active Aries cases for a business unit from Working District,
+    or from the local snapshot if the same pull was made within ttl seconds.
+    An older snapshot is topped up with the rows changed since it was
+    pulled if WATERMARKS has an Aries expression.
+
+    Args:
+        business_unit: The name of the business unit you are updating, or
+                       a list of them to pull in one query.
+        force_refresh: Skip the snapshot and query Working District.
+        ttl: Oldest snapshot to reuse, in seconds.
+    """
+    units, snapshot_name = _business_units(business_unit)
+    select_list = ',\n        '.join(ARIES_COLUMNS)
+    watermark = WATERMARKS['aries']
+    if watermark is not None:
+        select_list += f',\n        {watermark} AS {WATERMARK_COLUMN}'
+
+    def delta_query(since):
+        # Every case of an ARIES_CODE with a change comes back, as in
+        # _load_snowflake, since an ARIES_CODE can have a case in more than
+        # one reserve category.
+        changed = ARIES_QUERY.format(
+            select_list='M.ARIES_CODE', business_units=_sql_list(units),
+            filters=f"AND {watermark} > '{since}'", **backend['tables'])
+        # The subquery can't keep ARIES_QUERY's closing semicolon.
+        changed = changed.strip().rstrip(';')
+        return ARIES_QUERY.format(
+            select_list=select_list, business_units=_sql_list(units),
+            filters=f'AND (M.ARIES_CODE IS NULL'
+                    f' OR M.ARIES_CODE IN ({changed}))',
+            **backend['tables'])
+
+    def keep(frame):
+        return frame.RSV_CAT.isin(ARIES_RSV_CATS)
+
+    def pull(query):
+        conn = backend['connect_aries']()
+        aries = read_sql_chunked(query, conn, ARIES_SCHEMA)
+        conn.close()
+        return aries
+
+    return cached_pull(
+        'aries', snapshot_name,
+        ARIES_QUERY.format(select_list=select_list,
+                           business_units=_sql_list(units),
+                           filters=_aries_filters(), **backend['tables']),
+        pull, ttl, force_refresh,
+        delta_query=delta_query if watermark is not None else None,
+        key='ARIES_CODE', keep=keep, cache_dir=backend['cache_dir'])
+
+
+def _with_key_only_rows(matching, key_only, schema):
+    """
+    Appends the key-only rows of a semi-join pull to the fully pulled rows.
+    The columns they weren't pulled with are left empty.
+    """
+    key_only = cast_columns(key_only.reindex(columns=matching.columns),
+                            schema)
+    return concat_chunks([matching, key_only])
+
+
+def _load_snowflake_matching(business_unit, aries_codes, columns=None):
+    """
+    Semi-join version of _load_snowflake. Pulls every column only for the
+    Dev Planning rows whose ARIES_ID is in aries_codes, and just the
+    DP_BASE_COLUMNS for the rest so in_dp_not_aries can still be built.
+
+    The codes are bound into IN lists of at most SNOWFLAKE_MAX_IN_LIST
+    values. The DP_BASE_COLUMNS are pulled for the whole business unit and
+    the matched rows dropped here, so no statement binds more codes than
+    that. The result depends on the codes, so it isn't cached.
+
+    Args:
+        business_unit: The name of the business unit you are updating, or
+                       a list of them to pull in one query.
+        aries_codes: Aries codes already pulled from Working District.
+        columns: DEV_PLANNING columns to select, or None for all of them.
+    """
+    units = _business_units(business_unit)[0]
+    codes = sorted(set(pd.Series(aries_codes).dropna()))
+    if not codes:
+        # Nothing to join on, and the key-only pull alone would be missing
+        # the columns the checks need.
+        return _load_snowflake(business_unit, columns)
+
+    chunks = [codes[i:i + SNOWFLAKE_MAX_IN_LIST]
+              for i in range(0, len(codes), SNOWFLAKE_MAX_IN_LIST)]
+    # pyodbc only takes ? as a parameter marker.
+    in_lists = ['({})'.format(','.join(['?'] * len(chunk)))
+                for chunk in chunks]
+
+    sf_conn = backend['connect_dev_planning']()
+    try:
+        frames = []
+        for chunk, in_list in zip(chunks, in_lists):
+            frames.append(read_sql_chunked(
+                SNOWFLAKE_QUERY.format(
+                    select_list=_dp_select_list(columns),
+                    business_units=_sql_list(units),
+                    filters=f'{_dp_filters()}\n'
+                            f'        AND DP.ARIES_ID IN {in_list}',
+                    **backend['tables']),
+                sf_conn, DP_SCHEMA, params=chunk))
+
+        key_only = read_sql_chunked(
+            SNOWFLAKE_QUERY.format(
+                select_list=_dp_select_list(DP_BASE_COLUMNS),
+                business_units=_sql_list(units),
+                filters=_dp_filters(),
+                **backend['tables']),
+            sf_conn, DP_SCHEMA)
+    finally:
+        sf_conn.close()
+    key_only = key_only.loc[~key_only.ARIES_ID.isin(codes)]
+
+    return _with_key_only_rows(concat_chunks(frames), key_only, DP_SCHEMA)
+
+
+def _load_aries_matching(business_unit, aries_ids):
+    """
+    Semi-join version of _load_aries. Stages the Dev Planning ARIES_IDs in a
+    #keys temp table, pulls every column for the Aries cases in it, and
+    just ARIES_KEY_COLUMNS for the rest so in_aries_not_dp can still be
+    built. The result depends on the keys, so it isn't cached.
+
+    Args:
+        business_unit: The name of the business unit you are updating, or
+                       a list of them to pull in one query.
+        aries_ids: ARIES_IDs already pulled from Dev Planning.
+    """
+    units = _business_units(business_unit)[0]
+    keys = sorted(set(pd.Series(aries_ids).dropna()))
+
+    keys_table = backend['keys_table']
+    in_keys = (f'EXISTS (SELECT 1 FROM {keys_table} AS K '
+               'WHERE K.ARIES_CODE = M.ARIES_CODE)')
+    conn = backend['connect_aries']()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'CREATE TABLE {keys_table} '
+                       '(ARIES_CODE VARCHAR(255) NOT NULL PRIMARY KEY)')
+        if keys:
+            # Only pyodbc has fast_executemany.
+            if hasattr(cursor, 'fast_executemany'):
+                cursor.fast_executemany = True
+            cursor.executemany(
+                f'INSERT INTO {keys_table} (ARIES_CODE) VALUES (?)',
+                [(key,) for key in keys])
+
+        matching = read_sql_chunked(
+            ARIES_QUERY.format(
+                select_list=',\n        '.join(ARIES_COLUMNS),
+                business_units=_sql_list(units),
+                filters=f'{_aries_filters()}\n        AND {in_keys}',
+                **backend['tables']),
+            conn, ARIES_SCHEMA)
+        key_only = read_sql_chunked(
+            ARIES_QUERY.format(
+                select_list=',\n        '.join(ARIES_KEY_COLUMNS),
+                business_units=_sql_list(units),
+                filters=f'{_aries_filters()}\n        AND NOT {in_keys}',
+                **backend['tables']),
+            conn, ARIES_SCHEMA)
+    finally:
+        conn.close()
+
+    return _with_key_only_rows(matching, key_only, ARIES_SCHEMA)
+
+
+def _timed_load(loader, *args):
+    """
+    Runs one of the loaders and returns the frame with how many seconds the
+    pull took. The pull is recorded as a stage of the active trace.
+    """
+    started = time.perf_counter()
+    with trace_stage(f"pull {loader.__name__.strip('_')}") as record:
+        frame = loader(*args)
+        record.update(rows_out=len(frame), bytes=frame_bytes(frame),
+                      pulled_from=frame.attrs.get('pull', {}).get('mode'))
+    return frame, time.perf_counter() - started
+
+
+def load_sources(business_unit, columns=None, force_refresh=False,
+                 ttl=DEFAULT_TTL, semi_join=None):
+    """
+    Pulls Dev Planning from Snowflake and Aries from Working District at the
+    same time on a thread pool, so the wait is close to the slower of the
+    two queries instead of their sum.
+
+    With semi_join one side is pulled first and only its keys are sent to
+    the other database, which then returns full rows only for the wells both
+    sides know about. Its other rows come back with just the columns the
+    in_dp_not_aries and in_aries_not_dp reports use.
+
+    Args:
+        business_unit: The name of the business unit you are updating, or
+                       a list of them to pull in one query.
+        columns: DEV_PLANNING columns to select, or None for all of them.
+        force_refresh: Query both databases even if a snapshot is fresh.
+        ttl: Oldest snapshot to reuse, in seconds.
+        semi_join: None to pull both sides in full at once, 'aries' to pull
+                   Aries first, or 'dev_planning' to pull Dev Planning first.
+                   Pick the side with fewer rows.
+
+    Returns:
+        Tuple of (dev_planning, aries, timings) where timings holds the
+        seconds each source took and the total wall time. attrs['pull'] on
+        a frame says whether it came from a snapshot. When several business
+        units are pulled each frame holds all of them; split_business_units
+        splits them up.
+
+    Raises:
+        Whatever the failing loader raised. Both pulls are allowed to finish
+        before the error is passed on.
+        ValueError: semi_join isn't one of the options above.
+    """
+    started = time.perf_counter()
+    if semi_join is None:
+        # Each pull runs in a copy of this thread's context so its stage
+        # lands in the caller's trace.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            dp_future = executor.submit(contextvars.copy_context().run,
+                                        _timed_load, _load_snowflake,
+                                        business_unit, columns,
+                                        force_refresh, ttl)
+            aries_future = executor.submit(contextvars.copy_context().run,
+                                           _timed_load, _load_aries,
+                                           business_unit, force_refresh, ttl)
+            dev_planning, dp_seconds = dp_future.result()
+            aries, aries_seconds = aries_future.result()
+    elif semi_join == 'aries':
+        aries, aries_seconds = _timed_load(_load_aries, business_unit,
+                                           force_refresh, ttl)
+        dev_planning, dp_seconds = _timed_load(
+            _load_snowflake_matching, business_unit, aries.ARIES_CODE,
+            columns)
+    elif semi_join == 'dev_planning':
+        dev_planning, dp_seconds = _timed_load(_load_snowflake,
+                                               business_unit, columns,
+                                               force_refresh, ttl)
+        aries, aries_seconds = _timed_load(
+            _load_aries_matching, business_unit, dev_planning.ARIES_ID)
+    else:
+        raise ValueError(f"Unknown semi_join side '{semi_join}'")
 
-    return aries
+    timings = {'Dev Planning': dp_seconds,
+               'Working District': aries_seconds,
+               'Total': time.perf_counter() - started}
+    return dev_planning, aries, timings
 
 
 # This function will fail to set the global variables aries and dev_planning
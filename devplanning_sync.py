@@ -3,286 +3,652 @@
 Created on Thu Nov 17 14:47:58 2022
 
 @author: zrose
-"""
 
-# Third party packages
-import matplotlib.pyplot as plt
-import numpy as np
-import openpyxl
-import pandas as pd
-import pyodbc
+Runs the whole sync (pull, checks, backups, update and post update QC)
+without the GUI, so it can be scheduled off-hours on a server:
 
-# Zelda's Written functions
-from devplanning_sync_functions import compare_columns
-from devplanning_sync_functions import compare_numeric_columns
-from devplanning_sync_functions import connect_to_snowflake
-from devplanning_sync_functions import hierarchical_select
-from devplanning_sync_functions import match
+    python -m devplanning_sync run --bu "SOUTH TEXAS" --out D:\\sync --dry-run
+    python -m devplanning_sync run --bu "SOUTH TEXAS" --fields PSID LEASE \\
+        --out D:\\sync --apply
+    python -m devplanning_sync run --bu "SOUTH TEXAS" "BRAZOS VALLEY" \\
+        --out D:\\sync --apply
 
+Several business units are synced in parallel, see run_many.
 
-# Supresses error messages for valid pandas operations.
-pd.options.mode.chained_assignment = None
-
-
-conn = connect_to_snowflake()
-
-snowflake_string = """
-SELECT
-*
-FROM
-SOURCE.GIS.DEV_PLANNING AS DP
-WHERE (DP.BUSINESS_UNIT = 'BRAZOS VALLEY' OR DP.BUSINESS_UNIT = 'SOUTH TEXAS') AND DP.SCENARIO IN ('A', 'MDV') AND DP.DEV_STATUS IN ('PRIMARY', 'DEVELOPMENT')
+A JSON summary of the run is printed to stdout and the exit code says how
+it went (see the EXIT_ constants). Where the time and memory went, stage by
+stage, is saved next to the workbooks in trace.json.
 """
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-dev_planning = pd.read_sql(snowflake_string, conn)
-conn.close()
-
-#####     End connect to snowflake database     #####
-
-
-#####     Connect to Aries Working District     #####
-
-conn = pyodbc.connect(r'DRIVER={ODBC Driver 17 for SQL Server}; uid={zdrane}; server={Aries-prod}; Database={Working_District}; Trusted_Connection=yes')
-
-# Write Query string from SQL
-aries_string = """
-SELECT
-	M.ARIES_CODE,
-    M.RSV_CAT,
-    M.PROP_NUM,
-    M.PRESPUDWELLID,
-	M.USER3,
-    M.LEASE,
-    M.SPUDDER_DATE,
-    M.FIRST_PROD,
-    M.PAD_NAME,
-    M.LAT_SURFACE,
-    M.LONG_SURFACE,
-    M.LAT_TARGET,
-    M.LONG_TARGET,
-    M.LAT_BH,
-    M.LONG_BH,
-    B.PLANNED_SH_LAT,
-    B.PLANNED_SH_LONG,
-    B.PLANNED_TARGET_LAT,
-    B.PLANNED_TARGET_LONG,
-    B.PLANNED_BH_LAT,
-    B.PLANNED_BH_LONG,
-    M.LATERAL_LEN,
-    B.PLANNED_LL,
-    B.PROJECT_NAME,
-    M.MDA,
-    M.RESV_ENG,
-    M.RESERVOIR,
-    M.TYPECURVE,
-    M.TYPECURVE_SHORT,
-    M.TD_DATE,
-    B.AFE_DATE
-FROM [Working_District].[AriesAdmin].[AC_PROPERTY] AS M
-INNER JOIN [Working_District].[AriesAdmin].[AC_BUDGET] AS B ON M.PROPNUM = B.PROPNUM
-WHERE (M.BUSINESS_UNIT ='SOUTH TEXAS') AND M.RSV_CAT IN ('5PUD','5PUDX','6PROB','7POSS');
-"""
-
-
-aries = pd.read_sql(aries_string, conn)
-conn.close()
-
-#####     End Connect to Aries Working District     #####
-
+import pandas as pd
 
-#####     Check for active cases in Aries that aren't in DP and active DP that aren't in Aries     #####
+# Zelda's Written functions
+from devplanning_syn_GUI_functions import current_backend
+from devplanning_syn_GUI_functions import get_aries_engine
+from devplanning_syn_GUI_functions import load_sources
+from devplanning_syn_GUI_functions import use_backend
+from devplanning_sync_cache import clear_snapshots
+from devplanning_sync_functions import add_derived_columns
+from devplanning_sync_functions import aries_changes
+from devplanning_sync_functions import ARIES_PRIORITY
+from devplanning_sync_functions import combine_sources
+from devplanning_sync_functions import compare_fields
+from devplanning_sync_functions import dev_planning_columns
+from devplanning_sync_functions import DP_PRIORITY
+from devplanning_sync_functions import FIELD_CHECKS
+from devplanning_sync_functions import pending_updates
+from devplanning_sync_functions import resolve_duplicates
+from devplanning_sync_functions import split_business_units
+from devplanning_sync_functions import update_tables
+from devplanning_sync_functions import write_backup_workbook
+from devplanning_sync_functions import write_check_workbook
+from devplanning_sync_trace import save_trace
+from devplanning_sync_trace import trace_stage
+from devplanning_sync_trace import tracing
 
-dp_st = dev_planning.loc[dev_planning.BUSINESS_UNIT == 'SOUTH TEXAS']
 
-combined_df = dp_st.merge(
-    aries,
-    left_on='ARIES_ID',
-    right_on='ARIES_CODE',
-    how='left',
-    suffixes=['_DP', '_AR']
-)
-in_dp_not_aries = combined_df.loc[pd.isna(combined_df.ARIES_CODE)]
-in_dp_not_aries = in_dp_not_aries[['ARIES_CODE', 'ARIES_ID',
-                                   'WELL_NAME', 'LEASE',
-                                   'RSV_CAT_DP', 'RSV_CAT_AR']]
+# Supresses error messages for valid pandas operations.
+pd.options.mode.chained_assignment = None
 
-combined_df = aries.merge(
-    dp_st,
-    left_on='ARIES_CODE',
-    right_on='ARIES_ID',
-    how='left',
-    suffixes=['_AR', '_DP']
-)
-
-in_aries_not_dp = combined_df.loc[pd.isna(combined_df.ARIES_ID)]
-in_aries_not_dp = in_aries_not_dp[['ARIES_CODE', 'ARIES_ID', 'WELL_NAME',
-                                   'LEASE', 'RSV_CAT_DP', 'RSV_CAT_AR',
-                                   'TD_DATE']]
-
-in_aries_not_dp.loc[pd.isna(in_aries_not_dp.TD_DATE)]
 
-
-#####     END Active cases check.     #####
-combined_df.dropna(subset=['ARIES_ID'], inplace=True)
-
-# Start checking individual columns.
-
-psid_list = []
-for index, row in combined_df.iterrows():
-    psid_list.append(hierarchical_select(row.USER3,
-                                         row.PRESPUDWELLID,
-                                         type_to_coerce=int))
-
-combined_df['PSID_AR'] = psid_list
-combined_df.PSID_AR = combined_df.PSID_AR.astype('float64')
-
-combined_df.rename(columns={'PSID': 'PSID_DP'}, inplace=True)
-
-psid_check = compare_numeric_columns("PSID_DP",
-                                     "PSID_AR",
-                                     dataframe=combined_df,
-                                     round_to=0)
-
-pn_check = compare_columns('PROP_NUM_DP',
-                           'PROP_NUM_AR',
-                           dataframe=combined_df)
-pn_check[['PROP_NUM_DP', 'PROP_NUM_AR', 'MATCH']]
-print(pn_check.value_counts(['MATCH']))
-
-
-lease_check = compare_columns('WELL_NAME', 'LEASE', dataframe=combined_df)
-print(lease_check[['WELL_NAME', 'LEASE', 'MATCH']])
-print(lease_check.MATCH.value_counts())
-
-proj_name_check = compare_columns('PROJECT_NAME_DP',
-                                  'PROJECT_NAME_AR',
-                                  dataframe=combined_df)
-print(proj_name_check[['PROJECT_NAME_DP', 'PROJECT_NAME_AR', 'MATCH']])
-print(proj_name_check.MATCH.value_counts())
-
-pad_name_check = compare_columns('PAD_NAME_DP',
-                                 'PAD_NAME_AR',
-                                 dataframe=combined_df)
-print(pad_name_check[['PAD_NAME_DP', 'PAD_NAME_AR', 'MATCH']])
-print(pad_name_check.MATCH.value_counts())
-
-mda_check = compare_columns('MKT_DEDICATION_AREA',
-                            'MDA',
-                            dataframe=combined_df)
-print(mda_check[['MKT_DEDICATION_AREA', 'MDA', 'MATCH']])
-print(mda_check.MATCH.value_counts())
-
-
-#            Start Checking Lat Longs          #
-#            Start Checking Lat Longs          #
-#            Start Checking Lat Longs          #
-
-
-sl_lat_check = compare_numeric_columns('SL_LAT',
-                                       'LAT_SURFACE',
-                                       dataframe=combined_df,
-                                       round_to=4)
-print(sl_lat_check[['SL_LAT', 'LAT_SURFACE', 'DELTA', 'MATCH']])
-print(sl_lat_check.value_counts('MATCH'))
-print(sl_lat_check[sl_lat_check.MATCH == "UPDATE ARIES"])
-
-sl_long_check = compare_numeric_columns('SL_LONG',
-                                        'LONG_SURFACE',
-                                        dataframe=combined_df,
-                                        round_to=4)
-print(sl_long_check.value_counts('MATCH'))
-
-#    Start Target Hole checks     #
-
-# In South Texas we used the first waypoint values if they existed and if not
-# we would use the Landing point. This may be different in different BUs
-dp_tp_lat_list = []
-dp_tp_long_list = []
-
-for index, row in combined_df.iterrows():
-    dp_tp_lat_list.append(
-        hierarchical_select(row.WAYPOINT1_LAT,
-                            row.LP_LAT,
-                            float
-                            )
-    )
-    dp_tp_long_list.append(
-        hierarchical_select(row.WAYPOINT1_LONG,
-                            row.LP_LONG,
-                            float
-                            )
-    )
-dp_tp_lat_list
-combined_df['TP_LAT'] = dp_tp_lat_list
-combined_df['TP_LONG'] = dp_tp_long_list
-
-print(combined_df[['WAYPOINT1_LAT', 'LP_LAT', 'TP_LAT']])
-print(combined_df[['WAYPOINT1_LONG', 'LP_LONG', 'TP_LONG']])
-
-
-th_lat_check = compare_numeric_columns('TP_LAT',
-                                       'LAT_TARGET',
-                                       dataframe=combined_df,
-                                       round_to=4)
-print(th_lat_check[['TP_LAT', 'LAT_TARGET', 'DELTA', 'MATCH']])
-print(th_lat_check.MATCH.value_counts())
-
-th_long_check = compare_numeric_columns('TP_LONG',
-                                        'LONG_TARGET',
-                                        dataframe=combined_df,
-                                        round_to=4)
-print(th_long_check[['TP_LONG', 'LONG_TARGET', 'DELTA', 'MATCH']])
-print(th_long_check.MATCH.value_counts())
-
-bh_lat_check = compare_numeric_columns('BHL_LAT',
-                                       'LAT_BH',
-                                       dataframe=combined_df,
-                                       round_to=4)
-print(bh_lat_check[['BHL_LAT', 'LAT_BH', 'DELTA', 'MATCH']])
-print(bh_lat_check.MATCH.value_counts())
-
-bh_long_check = compare_numeric_columns('BHL_LONG',
-                                        'LONG_BH',
-                                        dataframe=combined_df,
-                                        round_to=4)
-print(bh_long_check[['BHL_LONG', 'LONG_BH', 'DELTA', 'MATCH']])
-print(bh_long_check.MATCH.value_counts())
-
-# End Checking lat longs  #
-
-m_lateral_len_check = compare_numeric_columns('COMPLETABLE_LL',
-                                              'LATERAL_LEN',
-                                              dataframe=combined_df,
-                                              round_to=0)
-b_lateral_len_check = compare_numeric_columns('COMPLETABLE_LL',
-                                              'PLANNED_LL',
-                                              dataframe=combined_df,
-                                              round_to=0)
-lat_len_check = m_lateral_len_check.merge(b_lateral_len_check,
-                                          how='inner',
-                                          on=['ARIES_CODE',
-                                              'LEASE',
-                                              'COMPLETABLE_LL'],
-                                          suffixes=['_m', '_b']
-                                          )
-
-# Output backups to an excel file
-with pd.ExcelWriter(r'.\output_spreadsheets\backups.xlsx') as writer:
-    dp_st.to_excel(writer, sheet_name='DevPlanning_backup')
-    aries.to_excel(writer, sheet_name='Aries_Backup')
-
-with pd.ExcelWriter(r'.\output_spreadsheets\changes.xlsx') as writer:
-    in_aries_not_dp.to_excel(writer, sheet_name='in_aries_not_dp')
-    in_dp_not_aries.to_excel(writer, sheet_name='in_dp_not_aries')
-    psid_check.to_excel(writer, sheet_name='PSID')
-    pn_check.to_excel(writer, sheet_name='PROP_NUM')
-    lease_check.to_excel(writer, sheet_name='LEASE')
-    proj_name_check.to_excel(writer, sheet_name="PROJECT NAME")
-    pad_name_check.to_excel(writer, sheet_name='PAD_NAME')
-    sl_lat_check.to_excel(writer, sheet_name="SH_LAT")
-    sl_long_check.to_excel(writer, sheet_name="SH_LONG")
-    th_lat_check.to_excel(writer, sheet_name='TH_LAT')
-    th_long_check.to_excel(writer, sheet_name='TH_LONG')
-    bh_lat_check.to_excel(writer, sheet_name='BH_LAT')
-    bh_long_check.to_excel(writer, sheet_name='BH_LONG')
-    lat_len_check.to_excel(writer, sheet_name='Lateral Lengths')
+# The checks run when --fields isn't given. That's every check, as the GUI
+# starts with every check box ticked.
+DEFAULT_FIELDS = list(FIELD_CHECKS)
+
+# Exit codes. EXIT_PENDING means Aries still has values to update, either
+# because it was a dry run or because some still differ after the push.
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2  # Returned by argparse for bad arguments.
+EXIT_PENDING = 3
+
+# Most database connections run_many opens at once. Every business unit is
+# pulled with one query per source, but each push holds its own Working
+# District connection, so this caps the number of processes.
+MAX_CONNECTIONS = 8
+
+# File in --out the stage trace of a run is saved to.
+TRACE_FILE = 'trace.json'
+
+# --semi-join choices, mapped to load_sources' semi_join argument.
+SEMI_JOINS = {'none': None,
+              'aries': 'aries',
+              'dev_planning': 'dev_planning'}
+
+
+@contextlib.contextmanager
+def _stage(summary, name):
+    """
+    Records how long a stage took in the summary, and its name if it
+    raises.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        summary['failed_stage'] = name
+        raise
+    finally:
+        summary['stages'][name] = round(time.perf_counter() - started, 3)
+
+
+def check(dev_planning, aries, fields):
+    """
+    Runs the same checks as the GUI's run_checks on two pulls.
+
+    Returns:
+        Dict of the frames write_check_workbook takes: results,
+        combined_df, in_aries_not_dp, in_dp_not_aries, dp_duplicates and
+        aries_duplicates.
+    """
+    with trace_stage('resolve duplicates',
+                     len(dev_planning) + len(aries)) as record:
+        dp_unique, dp_duplicates = resolve_duplicates(
+            dev_planning, 'ARIES_ID', DP_PRIORITY)
+        aries_unique, aries_duplicates = resolve_duplicates(
+            aries, 'ARIES_CODE', ARIES_PRIORITY)
+        record['rows_out'] = len(dp_unique) + len(aries_unique)
+    with trace_stage('merge', len(dp_unique) + len(aries_unique)) as record:
+        combined_df, in_dp_not_aries, in_aries_not_dp = combine_sources(
+            dp_unique, aries_unique)
+        add_derived_columns(combined_df)
+        record['rows_out'] = len(combined_df)
+    results = compare_fields({field: FIELD_CHECKS[field] for field in fields},
+                             combined_df)
+    return {'results': results,
+            'combined_df': combined_df,
+            'in_aries_not_dp': in_aries_not_dp,
+            'in_dp_not_aries': in_dp_not_aries,
+            'dp_duplicates': dp_duplicates,
+            'aries_duplicates': aries_duplicates}
+
+
+def _check_counts(checks):
+    """
+    Summarises a check() result for the JSON summary.
+    """
+    results = checks['results']
+    statuses = pd.crosstab(results.FIELD, results.STATUS)
+    return {'combined': len(checks['combined_df']),
+            'in_aries_not_dp': len(checks['in_aries_not_dp']),
+            'in_dp_not_aries': len(checks['in_dp_not_aries']),
+            'dp_duplicates': len(checks['dp_duplicates']),
+            'aries_duplicates': len(checks['aries_duplicates']),
+            'pending_updates': pending_updates(results),
+            'statuses': {field: {status: int(count)
+                                 for status, count in row.items() if count}
+                         for field, row in statuses.iterrows()}}
+
+
+def extract(business_unit, fields, out_dir, force_refresh=False,
+            semi_join=None, sources=None):
+    """
+    Pulls both sources for a business unit, checks them and writes the
+    backups. Nothing is written to Aries.
+
+    Args:
+        business_unit: The business unit to sync, e.g. 'SOUTH TEXAS'.
+        fields: FIELD_CHECKS names to check.
+        out_dir: Folder the workbooks are written to. Created if missing.
+        force_refresh: Query both databases even if a snapshot is fresh.
+        semi_join: Passed on to load_sources.
+        sources: (dev_planning, aries) already pulled for the business
+                 unit, e.g. by run_many. Nothing is pulled when given.
+
+    Returns:
+        Tuple of (summary dict, checks). checks is the output of check(),
+        or None if a stage failed, in which case the summary has the error.
+    """
+    business_unit = business_unit.upper()
+    summary = {'business_unit': business_unit,
+               'fields': list(fields),
+               'stages': {},
+               'outputs': []}
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+
+        if sources is None:
+            with _stage(summary, 'pull'):
+                sources = load_sources(
+                    business_unit, dev_planning_columns(fields),
+                    force_refresh, semi_join=semi_join)[:2]
+        dev_planning, aries = sources
+        summary['rows'] = {'dev_planning': len(dev_planning),
+                           'aries': len(aries)}
+        summary['pulled_from'] = {
+            'dev_planning': dev_planning.attrs.get('pull', {}).get('mode'),
+            'aries': aries.attrs.get('pull', {}).get('mode')}
+
+        with _stage(summary, 'checks'):
+            checks = check(dev_planning, aries, fields)
+        summary['checks'] = _check_counts(checks)
+
+        with _stage(summary, 'backups'):
+            backup_path = os.path.join(out_dir, 'backups.xlsx')
+            write_backup_workbook(backup_path, dev_planning, aries)
+            changes_path = os.path.join(out_dir, 'changes.xlsx')
+            write_check_workbook(changes_path, **checks)
+        summary['outputs'] += [backup_path, changes_path]
+    except Exception as e:
+        summary['error'] = f'{type(e).__name__}: {e}'
+        return summary, None
+    return summary, checks
+
+
+def clear_aries_snapshots(summary, business_units):
+    """
+    Deletes the Aries snapshots of business units that were pushed to, so
+    the QC pull goes back to Aries. By then the push has committed, so a
+    snapshot that can't be deleted is only noted in the summary under
+    'cache_error' and doesn't fail the run.
+
+    Args:
+        summary (dict): Summary to note a failure in.
+        business_units: The business units that were pushed to.
+    """
+    try:
+        for unit in business_units:
+            clear_snapshots('aries', unit,
+                            cache_dir=current_backend()['cache_dir'])
+    except OSError as e:
+        summary['cache_error'] = f'{type(e).__name__}: {e}'
+
+
+def apply_updates(summary, checks, engine=None, clear_cache=True):
+    """
+    Pushes the updates found by extract to Aries in one transaction. The
+    summary from extract is filled in with the rows updated.
+
+    Args:
+        summary (dict): What extract returned for the business unit.
+        checks (dict): The checks extract returned.
+        engine: SQLAlchemy engine to push with. Defaults to Working
+                District.
+        clear_cache: Delete the business unit's Aries snapshots after the
+                     push, see clear_aries_snapshots. run_many does that
+                     itself once every push is done.
+
+    Returns:
+        The summary.
+    """
+    business_unit = summary['business_unit']
+    try:
+        with _stage(summary, 'update'):
+            timings = update_tables(
+                aries_changes(checks['results'], checks['combined_df'],
+                              summary['fields'], business_unit),
+                engine or get_aries_engine())
+        summary['updates'] = {
+            table: ({'error': str(result)} if isinstance(result, Exception)
+                    else {'rows': result[0], 'ms': result[1]})
+            for table, result in timings.items()}
+    except Exception as e:
+        summary['error'] = f'{type(e).__name__}: {e}'
+        return summary
+    if clear_cache:
+        clear_aries_snapshots(summary, [business_unit])
+    return summary
+
+
+def post_update_qc(summary, out_dir, semi_join=None, sources=None):
+    """
+    Checks a business unit again after apply_updates and writes the post
+    update QC workbook, with the tabs that still have values to push
+    flagged. The QC counts are added to the summary.
+
+    Args:
+        summary (dict): What apply_updates returned for the business unit.
+        out_dir: Folder the QC workbook is written to.
+        semi_join: Passed on to load_sources.
+        sources: (dev_planning, aries) already pulled again for the
+                 business unit. Nothing is pulled when given.
+
+    Returns:
+        The summary.
+    """
+    fields = summary['fields']
+    try:
+        with _stage(summary, 'qc'):
+            if sources is None:
+                sources = load_sources(summary['business_unit'],
+                                       dev_planning_columns(fields),
+                                       semi_join=semi_join)[:2]
+            checks = check(*sources, fields)
+            qc_path = os.path.join(out_dir, 'post_update.xlsx')
+            write_check_workbook(qc_path, flag_updates=True, **checks)
+        summary['outputs'].append(qc_path)
+        summary['qc'] = _check_counts(checks)
+    except Exception as e:
+        summary['error'] = f'{type(e).__name__}: {e}'
+    return summary
+
+
+def exit_code(summary):
+    """
+    Works out the exit code for one business unit's summary.
+    """
+    if 'error' in summary:
+        return EXIT_FAILED
+    counts = summary.get('qc', summary['checks'])
+    return EXIT_PENDING if counts['pending_updates'] else EXIT_OK
+
+
+def _save_trace(summary, trace, out_dir):
+    """
+    Saves a run's trace to out_dir and lists it in the summary's outputs.
+    """
+    try:
+        summary.setdefault('outputs', []).append(
+            save_trace(trace, os.path.join(out_dir, TRACE_FILE)))
+    except OSError as e:
+        summary['trace_error'] = f'{type(e).__name__}: {e}'
+
+
+def run(business_unit, fields, out_dir, apply=False, force_refresh=False,
+        semi_join=None, engine=None, trace_memory=False):
+    """
+    Pulls both sources for a business unit, checks them, writes the
+    backups, and with apply pushes the updates to Aries and writes the post
+    update QC.
+
+    Args:
+        business_unit: The business unit to sync, e.g. 'SOUTH TEXAS'.
+        fields: FIELD_CHECKS names to check and push.
+        out_dir: Folder the workbooks are written to. Created if missing.
+        apply: Push the updates. When False nothing is written to Aries.
+        force_refresh: Query both databases even if a snapshot is fresh.
+        semi_join: Passed on to load_sources.
+        engine: SQLAlchemy engine to push with. Defaults to Working
+                District.
+        trace_memory: Record each stage's peak allocations in the trace
+                      with tracemalloc. Slows the run down.
+
+    Returns:
+        Tuple of (exit code, summary dict).
+    """
+    with tracing(business_unit.upper(), trace_memory) as trace:
+        summary, checks = extract(business_unit, fields, out_dir,
+                                  force_refresh, semi_join)
+        summary['apply'] = apply
+        if apply and checks is not None:
+            apply_updates(summary, checks, engine)
+            if 'error' not in summary:
+                post_update_qc(summary, out_dir, semi_join)
+    _save_trace(summary, trace, out_dir)
+    return exit_code(summary), summary
+
+
+def _unit_folder(out_dir, business_unit):
+    """
+    Returns the sub folder of out_dir a business unit's workbooks go in.
+    """
+    return os.path.join(out_dir, ''.join(
+        character if character.isalnum() else '_'
+        for character in business_unit.upper()))
+
+
+def _pull_split(business_units, fields, force_refresh=False,
+                semi_join=None):
+    """
+    Pulls several business units with one query per source and splits the
+    result.
+
+    Returns:
+        Dict of business unit: (dev_planning, aries).
+    """
+    dev_planning, aries, _ = load_sources(business_units,
+                                          dev_planning_columns(fields),
+                                          force_refresh, semi_join=semi_join)
+    dp_units = split_business_units(dev_planning, business_units)
+    aries_units = split_business_units(aries, business_units)
+    return {unit: (dp_units[unit], aries_units[unit])
+            for unit in business_units}
+
+
+def _traced(memory, function, *args, **kwargs):
+    """
+    Runs one of run_many's per business unit jobs under its own trace in
+    the worker process.
+
+    Returns:
+        Tuple of (what the job returned, the stages it recorded).
+    """
+    with tracing(function.__name__, memory) as trace:
+        returned = function(*args, **kwargs)
+    return returned, trace['stages']
+
+
+def _gather(futures, summaries, trace):
+    """
+    Waits for run_many's per business unit jobs, submitted through _traced,
+    and adds the stages they recorded to the run's trace. A job whose
+    process died is recorded as an error in that business unit's summary.
+
+    Returns:
+        Dict of business unit: what its job returned, for the jobs that
+        finished.
+    """
+    returned = {}
+    for unit, future in futures.items():
+        try:
+            returned[unit], stages = future.result()
+        except Exception as e:
+            summaries[unit]['error'] = f'{type(e).__name__}: {e}'
+            continue
+        for record in stages:
+            record['business_unit'] = unit
+        trace['stages'].extend(stages)
+    return returned
+
+
+def run_many(business_units, fields, out_dir, apply=False,
+             force_refresh=False, semi_join=None,
+             max_connections=MAX_CONNECTIONS, trace_memory=False):
+    """
+    Syncs several business units at once. Each source is pulled once for
+    all of them and split by business unit in memory. Every business unit
+    is then checked in its own process, and the ones with values to push
+    are updated, again one process and one transaction each, so one
+    business unit failing doesn't hold up or roll back the others.
+
+    Args:
+        business_units: The business units to sync.
+        fields: FIELD_CHECKS names to check and push.
+        out_dir: Folder for the combined report. Each business unit's
+                 workbooks go in a sub folder named after it.
+        apply: Push the updates. When False nothing is written to Aries.
+        force_refresh: Query the databases even if a snapshot is fresh.
+        semi_join: Passed on to load_sources.
+        max_connections: Most database connections open at once. Each push
+                         holds one, so this caps the number of processes.
+        trace_memory: Record each stage's peak allocations in the trace
+                      with tracemalloc. Slows the run down.
+
+    Returns:
+        Tuple of (exit code, combined summary dict). The exit code is the
+        worst of the business units': a failure, then values still to
+        push, then OK.
+    """
+    business_units = list(dict.fromkeys(unit.upper()
+                                        for unit in business_units))
+    workers = max(1, min(len(business_units), max_connections))
+    report = {'fields': list(fields),
+              'apply': apply,
+              'workers': workers,
+              'stages': {},
+              'business_units': {}}
+    summaries = {unit: {'business_unit': unit,
+                        'fields': list(fields),
+                        'apply': apply,
+                        'stages': {},
+                        'outputs': []}
+                 for unit in business_units}
+    os.makedirs(out_dir, exist_ok=True)
+
+    with tracing(', '.join(business_units), trace_memory) as trace:
+        try:
+            with _stage(report, 'pull'):
+                sources = _pull_split(business_units, fields, force_refresh,
+                                      semi_join)
+        except Exception as e:
+            sources = {}
+            for summary in summaries.values():
+                summary['failed_stage'] = 'pull'
+                summary['error'] = f'{type(e).__name__}: {e}'
+
+        # The workers are new processes on Windows, so they are handed the
+        # backend in use rather than falling back to PRODUCTION.
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=use_backend,
+                                 initargs=(current_backend(),)) as executor:
+            checks = {}
+            with _stage(report, 'checks'):
+                returned = _gather(
+                    {unit: executor.submit(_traced, trace_memory, extract,
+                                           unit, fields,
+                                           _unit_folder(out_dir, unit),
+                                           sources=unit_sources)
+                     for unit, unit_sources in sources.items()},
+                    summaries, trace)
+            for unit, (summary, unit_checks) in returned.items():
+                summary['apply'] = apply
+                summaries[unit] = summary
+                if unit_checks is not None:
+                    checks[unit] = unit_checks
+
+            pending = [unit for unit in checks
+                       if summaries[unit]['checks']['pending_updates']]
+            updated = []
+            if apply and pending:
+                with _stage(report, 'update'):
+                    summaries.update(_gather(
+                        {unit: executor.submit(_traced, trace_memory,
+                                               apply_updates, summaries[unit],
+                                               checks[unit], clear_cache=False)
+                         for unit in pending},
+                        summaries, trace))
+
+                updated = [unit for unit in pending
+                           if 'error' not in summaries[unit]]
+                # The business units share the snapshot of the combined pull,
+                # so it's cleared here once rather than by every worker.
+                clear_aries_snapshots(report, updated)
+            if updated:
+                try:
+                    with _stage(report, 'qc'):
+                        sources = _pull_split(updated, fields,
+                                              semi_join=semi_join)
+                        summaries.update(_gather(
+                            {unit: executor.submit(_traced, trace_memory,
+                                                   post_update_qc,
+                                                   summaries[unit],
+                                                   _unit_folder(out_dir, unit),
+                                                   sources=unit_sources)
+                             for unit, unit_sources in sources.items()},
+                            summaries, trace))
+                except Exception as e:
+                    for unit in updated:
+                        summaries[unit]['failed_stage'] = 'qc'
+                        summaries[unit]['error'] = f'{type(e).__name__}: {e}'
+
+    for unit, summary in summaries.items():
+        summary['exit_code'] = exit_code(summary)
+        report['business_units'][unit] = summary
+
+    report_path = os.path.join(out_dir, 'combined_report.xlsx')
+    try:
+        write_combined_report(report_path, report['business_units'])
+        report['outputs'] = [report_path]
+    except Exception as e:
+        report['report_error'] = f'{type(e).__name__}: {e}'
+    _save_trace(report, trace, out_dir)
+
+    codes = {summary['exit_code']
+             for summary in report['business_units'].values()}
+    for code in (EXIT_FAILED, EXIT_PENDING):
+        if code in codes:
+            return code, report
+    return EXIT_OK, report
+
+
+def write_combined_report(path, summaries):
+    """
+    Writes one workbook covering every business unit of a run_many: a row
+    per business unit with its counts, and the status counts per field.
+
+    Args:
+        path: File to write.
+        summaries: Dict of business unit: summary, as in run_many's report.
+    """
+    rows = []
+    statuses = []
+    for unit, summary in summaries.items():
+        checks = summary.get('checks', {})
+        qc = summary.get('qc', {})
+        rows.append({
+            'BUSINESS_UNIT': unit,
+            'EXIT_CODE': summary.get('exit_code'),
+            'DP_ROWS': summary.get('rows', {}).get('dev_planning'),
+            'ARIES_ROWS': summary.get('rows', {}).get('aries'),
+            'IN_DP_NOT_ARIES': checks.get('in_dp_not_aries'),
+            'IN_ARIES_NOT_DP': checks.get('in_aries_not_dp'),
+            'DP_DUPLICATES': checks.get('dp_duplicates'),
+            'ARIES_DUPLICATES': checks.get('aries_duplicates'),
+            'PENDING_BEFORE': checks.get('pending_updates'),
+            'PENDING_AFTER': qc.get('pending_updates'),
+            'ROWS_UPDATED': sum(
+                update.get('rows', 0)
+                for update in summary.get('updates', {}).values()),
+            'FAILED_STAGE': summary.get('failed_stage'),
+            'ERROR': summary.get('error'),
+            'SECONDS': sum(summary.get('stages', {}).values())})
+        for field, counts in checks.get('statuses', {}).items():
+            for status, count in counts.items():
+                statuses.append({'BUSINESS_UNIT': unit,
+                                 'FIELD': field,
+                                 'STATUS': status,
+                                 'COUNT': count})
+
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame(rows).to_excel(writer, sheet_name='business_units',
+                                    index=False)
+        pd.DataFrame(statuses, columns=['BUSINESS_UNIT', 'FIELD', 'STATUS',
+                                        'COUNT']).to_excel(
+            writer, sheet_name='statuses', index=False)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='devplanning_sync',
+        description='Sync Aries with Dev Planning without the GUI.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser(
+        'run', help='Pull, check, back up and optionally update one or '
+                    'more business units.')
+    run_parser.add_argument('--bu', required=True, nargs='+',
+                            help='Business units, e.g. "SOUTH TEXAS". With '
+                                 'more than one they are synced in '
+                                 'parallel, each in a sub folder of --out.')
+    run_parser.add_argument('--fields', nargs='+', choices=list(FIELD_CHECKS),
+                            default=DEFAULT_FIELDS, metavar='FIELD',
+                            help='Checks to run. Defaults to '
+                                 + ', '.join(DEFAULT_FIELDS) + '.')
+    run_parser.add_argument('--out', required=True,
+                            help='Folder to write the workbooks to.')
+    mode = run_parser.add_mutually_exclusive_group()
+    mode.add_argument('--apply', action='store_true',
+                      help='Push the updates to Aries and write the post '
+                           'update QC.')
+    mode.add_argument('--dry-run', dest='apply', action='store_false',
+                      help="Only check and back up. This is the default.")
+    run_parser.add_argument('--force-refresh', action='store_true',
+                            help='Ignore the local snapshots.')
+    run_parser.add_argument('--semi-join', choices=list(SEMI_JOINS),
+                            default='none',
+                            help='Side to pull first. See load_sources.')
+    run_parser.add_argument('--max-connections', type=int,
+                            default=MAX_CONNECTIONS,
+                            help='Most database connections open at once '
+                                 'when syncing several business units.')
+    run_parser.add_argument('--trace-memory', action='store_true',
+                            help='Also record the peak allocations of each '
+                                 'stage in trace.json. Slows the run down.')
+    return parser
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+
+    Returns:
+        The exit code.
+    """
+    args = _parser().parse_args(argv)
+    if len(args.bu) == 1:
+        code, summary = run(args.bu[0], args.fields, args.out,
+                            apply=args.apply,
+                            force_refresh=args.force_refresh,
+                            semi_join=SEMI_JOINS[args.semi_join],
+                            trace_memory=args.trace_memory)
+    else:
+        code, summary = run_many(args.bu, args.fields, args.out,
+                                 apply=args.apply,
+                                 force_refresh=args.force_refresh,
+                                 semi_join=SEMI_JOINS[args.semi_join],
+                                 max_connections=args.max_connections,
+                                 trace_memory=args.trace_memory)
+    summary['exit_code'] = code
+    print(json.dumps(summary, indent=2, default=str))
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
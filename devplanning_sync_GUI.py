@@ -7,24 +7,45 @@ Created on Tue Jan 31 07:59:45 2023
 
 # Build a GUI for the devplanning sync script.
 import os
+import queue
+import threading
+from functools import partial
 
 # Import third party packages
 import pandas as pd
 import pyodbc
-import sqlalchemy
 import tkinter as tk
+from tkinter import ttk
 
 # Import Zelda written packages
 # from devplanning_syn_GUI_functions import pull_data
-from devplanning_syn_GUI_functions import _load_aries
-from devplanning_syn_GUI_functions import _load_snowflake
-from devplanning_sync_functions import compare_columns
-from devplanning_sync_functions import compare_numeric_columns
-from devplanning_sync_functions import hierarchical_select
-from devplanning_sync_functions import update_table
-
-
-def pull_data(business_unit):
+from devplanning_syn_GUI_functions import current_backend
+from devplanning_syn_GUI_functions import get_aries_engine
+from devplanning_syn_GUI_functions import load_sources
+from devplanning_sync_cache import changed_since
+from devplanning_sync_cache import clear_snapshots
+from devplanning_sync_functions import aries_changes
+from devplanning_sync_functions import ARIES_PRIORITY
+from devplanning_sync_functions import add_derived_columns
+from devplanning_sync_functions import combine_sources
+from devplanning_sync_functions import compare_fields
+from devplanning_sync_functions import dev_planning_columns
+from devplanning_sync_functions import DP_PRIORITY
+from devplanning_sync_functions import FIELD_CHECKS
+from devplanning_sync_functions import recompare_fields
+from devplanning_sync_functions import resolve_duplicates
+from devplanning_sync_functions import update_columns
+from devplanning_sync_functions import update_tables
+from devplanning_sync_functions import write_backup_workbook
+from devplanning_sync_functions import write_check_workbook
+from devplanning_sync_trace import run_stages
+from devplanning_sync_trace import save_trace
+from devplanning_sync_trace import StageFailed
+from devplanning_sync_trace import trace_stage
+
+
+def pull_data(business_unit, force_refresh=False, semi_join=None,
+              fields=None):
     """
     This function will take the two functions from the devplanning_sync_GUI\
         functions.py script and combine them into one. It is necessary to
@@ -33,27 +54,64 @@ def pull_data(business_unit):
 
     Args:
         business_unit: The name of the business unit you are updating.
+        force_refresh: Query both databases even if a local snapshot of the
+                       same pull is still fresh.
+        semi_join: Side to pull first so the other side only returns the
+                   wells it knows about, or None to pull both in full. See
+                   load_sources.
+        fields: FIELD_CHECKS names to pull the columns for. Defaults to the
+                ticked boxes, which can only be read on the main thread.
 
     Returns: None
     """
     global dev_planning
     global aries
     try:
-        dev_planning = _load_snowflake(business_unit)
-        aries = _load_aries(business_unit)
+        # Both sources are pulled at the same time.
+        # Only the Dev Planning columns the ticked checks need are pulled.
+        dev_planning, aries, timings = load_sources(
+            business_unit,
+            dev_planning_columns(
+                selected_fields() if fields is None else fields),
+            force_refresh, semi_join=semi_join)
 
         aries_len = len(aries)
         dp_len = len(dev_planning)
-        tk.messagebox.showinfo("Connection Status", f"""
+        aries_from = _pulled_from(aries, 'Working District')
+        dp_from = _pulled_from(dev_planning, 'Dev Planning')
+        notify("Connection Status", f"""
                                Connection Success!
-                               {aries_len} rows imported from Working District
-                               {dp_len} rows imported from Dev Planning
+                               {aries_len} rows imported from {aries_from}
+                               ({timings['Working District']:.1f} s)
+                               {dp_len} rows imported from {dp_from}
+                               ({timings['Dev Planning']:.1f} s)
+                               Total time: {timings['Total']:.1f} s
                                """)
     except:
-        tk.messagebox.showinfo("Connection Status", "Connection Failed")
+        stage_failed("Connection Status", "Connection Failed")
+
+
+def _pulled_from(frame, source_name):
+    """
+    Describes where load_sources got a frame from for the Connect message.
+    """
+    mode = frame.attrs.get('pull', {}).get('mode')
+    if mode == 'snapshot':
+        return 'local snapshot'
+    if mode == 'incremental':
+        changed = len(frame.attrs['pull']['changed'])
+        return f'{source_name} ({changed} changed since last pull)'
+    return source_name
+
+
+def selected_fields():
+    """
+    Returns the FIELD_CHECKS names whose check boxes are ticked.
+    """
+    return [field for field in FIELD_CHECKS if field_bools[field].get() == 1]
 
 
-def run_checks():
+def run_checks(fields=None):
     """
     This procedure runs all the checks and comparisons between the Aries
     and DevPlanning columns.
@@ -63,619 +121,339 @@ def run_checks():
 
     From here it goes column by column and compares them if the boxes are
     checked for that particular field.
+
+    Args:
+        fields: FIELD_CHECKS names to check. Defaults to the ticked boxes,
+                which can only be read on the main thread.
     """
+    if fields is None:
+        fields = selected_fields()
     try:
+        # A well listed under more than one scenario or reserve category
+        # would multiply rows in the join, so only the best row per key is
+        # kept. The rest are reported on the duplicate sheets.
+        global dp_duplicates
+        global aries_duplicates
+        with trace_stage('resolve duplicates',
+                         len(dev_planning) + len(aries)) as record:
+            dp_unique, dp_duplicates = resolve_duplicates(
+                dev_planning, 'ARIES_ID', DP_PRIORITY)
+            aries_unique, aries_duplicates = resolve_duplicates(
+                aries, 'ARIES_CODE', ARIES_PRIORITY)
+            record['rows_out'] = len(dp_unique) + len(aries_unique)
+
+        # One outer join gives the matched wells and both orphan lists.
         global combined_df
-        combined_df = dev_planning.merge(
-            aries,
-            left_on='ARIES_ID',
-            right_on='ARIES_CODE',
-            how='left',
-            suffixes=['_DP', '_AR']
-        )
         global in_dp_not_aries
-        in_dp_not_aries = combined_df.loc[pd.isna(combined_df.ARIES_CODE)]
-        in_dp_not_aries = in_dp_not_aries[['ARIES_CODE', 'ARIES_ID',
-                                           'WELL_NAME', 'LEASE',
-                                           'RSV_CAT_DP', 'RSV_CAT_AR']]
-
-        combined_df = aries.merge(
-            dev_planning,
-            left_on='ARIES_CODE',
-            right_on='ARIES_ID',
-            how='left',
-            suffixes=['_AR', '_DP']
-        )
-
         global in_aries_not_dp
-        in_aries_not_dp = combined_df.loc[pd.isna(combined_df.ARIES_ID)]
-        in_aries_not_dp = in_aries_not_dp[['ARIES_CODE', 'ARIES_ID',
-                                           'WELL_NAME', 'LEASE', 'RSV_CAT_DP',
-                                           'RSV_CAT_AR', 'TD_DATE']]
-
-        in_aries_not_dp.loc[pd.isna(in_aries_not_dp.TD_DATE)]
-
-        combined_df.dropna(subset=['ARIES_ID'], inplace=True)
-
-        psid_list = []
-        for index, row in combined_df.iterrows():
-            psid_list.append(hierarchical_select(row.USER3,
-                                                 row.PRESPUDWELLID,
-                                                 type_to_coerce=int))
-
-        combined_df['PSID_AR'] = psid_list
-        combined_df.PSID_AR = combined_df.PSID_AR.astype('float64')
-
-        combined_df.rename(columns={'PSID': 'PSID_DP'}, inplace=True)
-
-        if psid_bool.get() == 1:
-            global psid_check
-            psid_check = compare_numeric_columns("PSID_DP",
-                                                 "PSID_AR",
-                                                 dataframe=combined_df,
-                                                 round_to=0)
-
-        if pn_bool.get() == 1:
-            global pn_check
-            pn_check = compare_columns('PROP_NUM_DP',
-                                       'PROP_NUM_AR',
-                                       dataframe=combined_df)
-            pn_check[['PROP_NUM_DP', 'PROP_NUM_AR', 'MATCH']]
-
-        if lease_bool.get() == 1:
-            global lease_check
-            lease_check = compare_columns('WELL_NAME', 'LEASE',
-                                          dataframe=combined_df)
-
-        if projnm_bool.get() == 1:
-            global proj_name_check
-            proj_name_check = compare_columns('PROJECT_NAME_DP',
-                                              'PROJECT_NAME_AR',
-                                              dataframe=combined_df)
-
-        if padnm_bool.get() == 1:
-            global pad_name_check
-            pad_name_check = compare_columns('PAD_NAME_DP',
-                                             'PAD_NAME_AR',
-                                             dataframe=combined_df)
-
-        if mda_bool.get() == 1:
-            global mda_check
-            mda_check = compare_columns('MKT_DEDICATION_AREA',
-                                        'MDA',
-                                        dataframe=combined_df)
-
-        #            Start Checking Master table Lat Longs          #
-        #            Start Checking Master table Lat Longs          #
-        #            Start Checking Master table Lat Longs          #
-
-        if msh_lat_bool.get() == 1:
-            global sl_lat_check
-            sl_lat_check = compare_numeric_columns('SL_LAT',
-                                                   'LAT_SURFACE',
-                                                   dataframe=combined_df,
-                                                   round_to=4)
-
-        if msh_long_bool.get() == 1:
-            global sl_long_check
-            sl_long_check = compare_numeric_columns('SL_LONG',
-                                                    'LONG_SURFACE',
-                                                    dataframe=combined_df,
-                                                    round_to=4)
-
-        #    Start Target Hole checks     #
-
-        # In South Texas we used the first waypoint values if they existed
-        # and if not we would use the Landing point.
-        # This may be different in different BUs
-        dp_tp_lat_list = []
-        dp_tp_long_list = []
-
-        for index, row in combined_df.iterrows():
-            dp_tp_lat_list.append(
-                hierarchical_select(row.WAYPOINT1_LAT,
-                                    row.LP_LAT,
-                                    float
-                                    )
-            )
-            dp_tp_long_list.append(
-                hierarchical_select(row.WAYPOINT1_LONG,
-                                    row.LP_LONG,
-                                    float
-                                    )
-            )
-        combined_df['TP_LAT'] = dp_tp_lat_list
-        combined_df['TP_LONG'] = dp_tp_long_list
-
-        if mth_lat_bool.get() == 1:
-            global th_lat_check
-            th_lat_check = compare_numeric_columns('TP_LAT',
-                                                   'LAT_TARGET',
-                                                   dataframe=combined_df,
-                                                   round_to=4)
-
-        if mth_long_bool.get() == 1:
-            global th_long_check
-            th_long_check = compare_numeric_columns('TP_LONG',
-                                                    'LONG_TARGET',
-                                                    dataframe=combined_df,
-                                                    round_to=4)
-
-        if mbh_lat_bool.get() == 1:
-            global bh_lat_check
-            bh_lat_check = compare_numeric_columns('BHL_LAT',
-                                                   'LAT_BH',
-                                                   dataframe=combined_df,
-                                                   round_to=4)
-
-        if mbh_long_bool.get() == 1:
-            global bh_long_check
-            bh_long_check = compare_numeric_columns('BHL_LONG',
-                                                    'LONG_BH',
-                                                    dataframe=combined_df,
-                                                    round_to=4)
-
-        #          Check Budget table Lat Longs          #
-        #          Check Budget table Lat Longs          #
-        #          Check Budget table Lat Longs          #
-
-        if bsh_lat_bool.get() == 1:
-            global b_sl_lat_check
-            b_sl_lat_check = compare_numeric_columns('SL_LAT',
-                                                     'PLANNED_SH_LAT',
-                                                     dataframe=combined_df,
-                                                     round_to=4)
-
-        if bsh_long_bool.get() == 1:
-            global b_sl_long_check
-            b_sl_long_check = compare_numeric_columns('SL_LONG',
-                                                      'PLANNED_SH_LONG',
-                                                      dataframe=combined_df,
-                                                      round_to=4)
-
-        #    Start Target Hole checks     #
-
-        if bth_lat_bool.get() == 1:
-            global b_th_lat_check
-            b_th_lat_check = compare_numeric_columns('TP_LAT',
-                                                     'PLANNED_TARGET_LAT',
-                                                     dataframe=combined_df,
-                                                     round_to=4)
-
-        if bth_long_bool.get() == 1:
-            global b_th_long_check
-            b_th_long_check = compare_numeric_columns('TP_LONG',
-                                                      'PLANNED_TARGET_LONG',
-                                                      dataframe=combined_df,
-                                                      round_to=4)
-
-        if bbh_lat_bool.get() == 1:
-            global b_bh_lat_check
-            b_bh_lat_check = compare_numeric_columns('BHL_LAT',
-                                                     'PLANNED_BH_LAT',
-                                                     dataframe=combined_df,
-                                                     round_to=4)
-
-        if bbh_long_bool.get() == 1:
-            global b_bh_long_check
-            b_bh_long_check = compare_numeric_columns('BHL_LONG',
-                                                      'PLANNED_BH_LONG',
-                                                      dataframe=combined_df,
-                                                      round_to=4)
-
-        # End Checking lat longs #
-
-        if m_ll_bool.get() == 1:
-            global m_lateral_len_check
-            m_lateral_len_check = compare_numeric_columns('COMPLETABLE_LL',
-                                                          'LATERAL_LEN',
-                                                          dataframe=combined_df,
-                                                          round_to=0)
-
-        if b_ll_bool.get() == 1:
-            global b_lateral_len_check
-            b_lateral_len_check = compare_numeric_columns('COMPLETABLE_LL',
-                                                          'PLANNED_LL',
-                                                          dataframe=combined_df,
-                                                          round_to=0)
+        with trace_stage('merge',
+                         len(dp_unique) + len(aries_unique)) as record:
+            combined_df, in_dp_not_aries, in_aries_not_dp = combine_sources(
+                dp_unique, aries_unique)
+
+            in_aries_not_dp.loc[pd.isna(in_aries_not_dp.TD_DATE)]
+
+            add_derived_columns(combined_df)
+            record['rows_out'] = len(combined_df)
+
+        # Every checked field is compared in one pass over combined_df. The
+        # per-field frames the spreadsheets and updates need are built from
+        # check_results with field_view when they are used.
+        # After an incremental pull only the changed Aries codes are
+        # compared again.
+        global check_results
+        specs = {field: FIELD_CHECKS[field] for field in fields}
+        codes = changed_codes(specs)
+        if codes is None:
+            check_results = compare_fields(specs, combined_df)
+        else:
+            check_results = recompare_fields(check_results, combined_df,
+                                             codes)
+        check_results.attrs['sources'] = (
+            dev_planning.attrs.get('pull', {}).get('fingerprint'),
+            aries.attrs.get('pull', {}).get('fingerprint'))
     except NameError as e:
-        tk.messagebox.showinfo("run_checks error",
-                               f"Make sure you pull the data first:\n{e}")
+        stage_failed("run_checks error",
+                     f"Make sure you pull the data first:\n{e}")
+    except KeyError as e:
+        # Only the columns for the checks ticked at Connect are pulled.
+        stage_failed("run_checks error",
+                     "A checked field wasn't pulled, please "
+                     f"Connect again:\n{e}")
+
+
+def changed_codes(specs):
+    """
+    Returns the Aries codes whose data changed since the last run_checks, or
+    None if the checks have to be run in full. That's the case when there
+    are no earlier results, different fields are ticked, or the data wasn't
+    topped up from the pull the earlier results came from.
+
+    Args:
+        specs: The FIELD_CHECKS entries about to be checked.
+    """
+    previous = globals().get('check_results')
+    if previous is None or previous.attrs.get('specs') != specs:
+        return None
+
+    dp_fingerprint, aries_fingerprint = previous.attrs.get('sources',
+                                                           (None, None))
+    dp_changed = changed_since(dev_planning, dp_fingerprint)
+    aries_changed = changed_since(aries, aries_fingerprint)
+    if dp_changed is None or aries_changed is None:
+        return None
+    return dp_changed | aries_changed
 
 
 def write_backups(path_to_folder):
     try:
-        with pd.ExcelWriter(r'{path_to_folder}\backups.xlsx'
-                            .format(path_to_folder=path_to_folder)) as writer:
-            dev_planning.to_excel(writer, sheet_name='DevPlanning_backup')
-            aries.to_excel(writer, sheet_name='Aries_Backup')
-
-        with pd.ExcelWriter(r'{path_to_folder}\changes.xlsx'
-                            .format(path_to_folder=path_to_folder)) as writer:
-            in_aries_not_dp.to_excel(writer, sheet_name='in_aries_not_dp')
-            in_dp_not_aries.to_excel(writer, sheet_name='in_dp_not_aries')
-            if psid_bool.get() == 1:
-                psid_check.to_excel(writer, sheet_name='PSID')
-            if pn_bool.get() == 1:
-                pn_check.to_excel(writer, sheet_name='PROP_NUM')
-            if lease_bool.get() == 1:
-                lease_check.to_excel(writer, sheet_name='LEASE')
-            if projnm_bool.get() == 1:
-                proj_name_check.to_excel(writer, sheet_name="PROJECT NAME")
-            if padnm_bool.get() == 1:
-                pad_name_check.to_excel(writer, sheet_name='PAD_NAME')
-            if msh_lat_bool.get() == 1:
-                sl_lat_check.to_excel(writer, sheet_name="SH_LAT")
-            if msh_long_bool.get() == 1:
-                sl_long_check.to_excel(writer, sheet_name="SH_LONG")
-            if mth_lat_bool.get() == 1:
-                th_lat_check.to_excel(writer, sheet_name='TH_LAT')
-            if mth_long_bool.get() == 1:
-                th_long_check.to_excel(writer, sheet_name='TH_LONG')
-            if mbh_lat_bool.get() == 1:
-                bh_lat_check.to_excel(writer, sheet_name='BH_LAT')
-            if mbh_long_bool.get() == 1:
-                bh_long_check.to_excel(writer, sheet_name='BH_LONG')
-            if m_ll_bool.get() == 1:
-                m_lateral_len_check.to_excel(writer, sheet_name='LATERAL_LEN')
-            if bsh_lat_bool.get() == 1:
-                b_sl_lat_check.to_excel(writer, sheet_name="PLANNED_SH_LAT")
-            if bsh_long_bool.get() == 1:
-                b_sl_long_check.to_excel(writer, sheet_name="PLANNED_SH_LONG")
-            if bth_lat_bool.get() == 1:
-                b_th_lat_check.to_excel(writer,
-                                        sheet_name='PLANNED_TARGET_LAT')
-            if bth_long_bool.get() == 1:
-                b_th_long_check.to_excel(writer,
-                                         sheet_name='PLANNED_TARGET_LONG')
-            if bbh_lat_bool.get() == 1:
-                b_bh_lat_check.to_excel(writer, sheet_name='PLANNED_BH_LAT')
-            if bbh_long_bool.get() == 1:
-                b_bh_long_check.to_excel(writer, sheet_name='PLANNED_BH_LONG')
-            if b_ll_bool.get() == 1:
-                b_lateral_len_check.to_excel(writer, sheet_name='PLANNED_LL')
-        tk.messagebox.showinfo("Backup Status",
-                               "Backup and Checks successful")
+        write_backup_workbook(r'{path_to_folder}\backups.xlsx'
+                              .format(path_to_folder=path_to_folder),
+                              dev_planning, aries)
+        write_check_workbook(r'{path_to_folder}\changes.xlsx'
+                             .format(path_to_folder=path_to_folder),
+                             check_results, combined_df, in_aries_not_dp,
+                             in_dp_not_aries, dp_duplicates,
+                             aries_duplicates)
+        notify("Backup Status",
+               "Backup and Checks successful")
     except NameError:
-        tk.messagebox.showinfo("Backup And Check Error",
-                               """Backup and Checks failed.
-                               Please connect to the database first.""")
+        stage_failed("Backup And Check Error",
+                     """Backup and Checks failed.
+                     Please connect to the database first.""")
     except:
-        tk.messagebox.showinfo("Backup And Check Error",
-                               """Backup and Checks failed.
-                               please check path""")
+        stage_failed("Backup And Check Error",
+                     """Backup and Checks failed.
+                     please check path""")
 
 
 def write_qc(path_to_folder):
     try:
-        with pd.ExcelWriter(r'{path_to_folder}\post_update.xlsx'
-                            .format(path_to_folder=path_to_folder)) as writer:
-            in_aries_not_dp.to_excel(writer, sheet_name='in_aries_not_dp')
-            in_dp_not_aries.to_excel(writer, sheet_name='in_dp_not_aries')
-            if psid_bool.get() == 1:
-                psid_check.to_excel(writer, sheet_name='PSID')
-                if 'UPDATE ARIES' in psid_check.MATCH.value_counts():
-                    writer.PSID.set_tab_color('gold')
-            if pn_bool.get() == 1:
-                pn_check.to_excel(writer, sheet_name='PROP_NUM')
-            if lease_bool.get() == 1:
-                lease_check.to_excel(writer, sheet_name='LEASE')
-                if 'UPDATE ARIES' in lease_check.MATCH.value_counts():
-                    writer.LEASE.set_tab_color('gold')
-            if projnm_bool.get() == 1:
-                proj_name_check.to_excel(writer, sheet_name="PROJECT NAME")
-            if padnm_bool.get() == 1:
-                pad_name_check.to_excel(writer, sheet_name='PAD_NAME')
-            if msh_lat_bool.get() == 1:
-                sl_lat_check.to_excel(writer, sheet_name="SH_LAT")
-            if msh_long_bool.get() == 1:
-                sl_long_check.to_excel(writer, sheet_name="SH_LONG")
-            if mth_lat_bool.get() == 1:
-                th_lat_check.to_excel(writer, sheet_name='TH_LAT')
-            if mth_long_bool.get() == 1:
-                th_long_check.to_excel(writer, sheet_name='TH_LONG')
-            if mbh_lat_bool.get() == 1:
-                bh_lat_check.to_excel(writer, sheet_name='BH_LAT')
-            if mbh_long_bool.get() == 1:
-                bh_long_check.to_excel(writer, sheet_name='BH_LONG')
-            if m_ll_bool.get() == 1:
-                m_lateral_len_check.to_excel(writer, sheet_name='LATERAL_LEN')
-            if bsh_lat_bool.get() == 1:
-                b_sl_lat_check.to_excel(writer, sheet_name="PLANNED_SH_LAT")
-            if bsh_long_bool.get() == 1:
-                b_sl_long_check.to_excel(writer, sheet_name="PLANNED_SH_LONG")
-            if bth_lat_bool.get() == 1:
-                b_th_lat_check.to_excel(writer,
-                                        sheet_name='PLANNED_TARGET_LAT')
-            if bth_long_bool.get() == 1:
-                b_th_long_check.to_excel(writer,
-                                         sheet_name='PLANNED_TARGET_LONG')
-            if bbh_lat_bool.get() == 1:
-                b_bh_lat_check.to_excel(writer, sheet_name='PLANNED_BH_LAT')
-            if bbh_long_bool.get() == 1:
-                b_bh_long_check.to_excel(writer, sheet_name='PLANNED_BH_LONG')
-            if b_ll_bool.get() == 1:
-                b_lateral_len_check.to_excel(writer, sheet_name='PLANNED_LL')
-        tk.messagebox.showinfo("Backup Status",
-                               "Backup and Checks successful")
+        # Tabs that still have values to push are flagged.
+        write_check_workbook(r'{path_to_folder}\post_update.xlsx'
+                             .format(path_to_folder=path_to_folder),
+                             check_results, combined_df, in_aries_not_dp,
+                             in_dp_not_aries, dp_duplicates,
+                             aries_duplicates, flag_updates=True)
+        notify("Backup Status",
+               "Backup and Checks successful")
     except NameError as e:
-        tk.messagebox.showinfo("Write QC Error",
-                               f"""Backup and Checks failed.
-                               Please connect to the database first.
-                               {e}""")
+        stage_failed("Write QC Error",
+                     f"""Backup and Checks failed.
+                     Please connect to the database first.
+                     {e}""")
     except Exception as e:
-        tk.messagebox.showinfo("Write QC Error",
-                               f"""Backup and Checks failed.
-                               please check file path
-                               {e}""")
+        stage_failed("Write QC Error",
+                     f"""Backup and Checks failed.
+                     please check file path
+                     {e}""")
 
 
-def update_aries():
-    Server = 'Aries-prod'
-    Database = 'Working_District'
-    Driver = 'ODBC Driver 17 for SQL Server'
-    database_url = f"mssql://@{Server}/{Database}?driver={Driver}"
+def update_aries(batched=True, savepoints=False, fields=None,
+                 business_unit=None):
+    """
+    Pushes the Dev Planning value for every checked field that came back as
+    'UPDATE ARIES' in the last run_checks into Working District.
 
-    engine = sqlalchemy.create_engine(database_url)
+    The whole push runs on one connection inside one transaction, so it
+    either fully commits or fully rolls back.
 
+    Args:
+        batched: When True all the changes for a table are staged in one
+                 upload and applied with one UPDATE statement. When False
+                 each column is pushed on its own with update_table.
+        savepoints: When True each column (or table when batched) gets its
+                    own savepoint, so a failure only rolls back that part
+                    and the rest of the push still commits.
+        fields: FIELD_CHECKS names to push. Defaults to the ticked boxes.
+        business_unit: Business unit being pushed. Defaults to the one
+                       typed in. Both defaults can only be read on the main
+                       thread.
+    """
+    if fields is None:
+        fields = selected_fields()
+    if business_unit is None:
+        business_unit = bu_select.get().upper()
+    try:
+        changes = aries_changes(check_results, combined_df, fields,
+                                business_unit)
+
+        if batched:
+            timings = update_tables(changes, get_aries_engine(),
+                                    savepoints=savepoints)
+        else:
+            timings = update_columns(changes, get_aries_engine(),
+                                     savepoints=savepoints)
+
+        # Server-side time of each UPDATE, to keep an eye on the join cost.
+        timing_lines = []
+        for name, result in timings.items():
+            if isinstance(result, Exception):
+                timing_lines.append(f'{name}: rolled back ({result})')
+            else:
+                timing_lines.append(
+                    f'{name}: {result[0]} rows in {result[1]} ms')
+        timing_lines = '\n'.join(timing_lines)
+    except:
+        stage_failed("Aries Update", "Push Failed")
+        return
 
-    #         Push updates to Master Table        #
-    #         Push updates to Master Table        #
-    #         Push updates to Master Table        #
+    # Aries has changed, so the next Connect must pull it again. The push
+    # has committed by now, so a snapshot that can't be deleted is only
+    # mentioned.
+    try:
+        clear_snapshots('aries', business_unit,
+                        cache_dir=current_backend()['cache_dir'])
+    except OSError as e:
+        timing_lines += f'\nSaved Aries pull not cleared: {e}'
+    notify("Aries Update",
+           f"Push Successful\n{timing_lines}")
+
+
+# The buttons run their work on a worker thread so the window keeps
+# responding. Tk may only be touched from the main thread, so the worker
+# sends everything it wants shown through ui_queue and poll_queue picks it
+# up with window.after.
+ui_queue = queue.Queue()
+cancel_event = threading.Event()
+
+# (trace, saved path) of the last run, for Show Trace.
+last_trace = None
+
+# Trace record keys shown by Show Trace, with their headings.
+TRACE_COLUMNS = {'stage': 'Stage',
+                 'seconds': 'Seconds',
+                 'rows_in': 'Rows in',
+                 'rows_out': 'Rows out',
+                 'bytes': 'MB',
+                 'peak_rss_mb': 'Peak RSS MB',
+                 'traced_peak_mb': 'Traced peak MB'}
+
+
+def notify(title, message):
+    """
+    Shows a message box, or queues it for the main thread when called from
+    the worker.
+    """
+    if threading.current_thread() is threading.main_thread():
+        tk.messagebox.showinfo(title, message)
+    else:
+        ui_queue.put(('message', title, message))
+
+
+def stage_failed(title, message):
+    """
+    Shows why a stage failed. On the worker thread it then raises
+    StageFailed, so _run_stages stops instead of running the next stage on
+    stale data and reporting the run as done.
+    """
+    notify(title, message)
+    if threading.current_thread() is not threading.main_thread():
+        raise StageFailed(message.strip().splitlines()[0])
 
 
-    # Push updates to the PROP_NUM column into WD Property table.
+def _run_stages(stages, trace_memory=False):
+    """
+    Body of the worker thread. Runs each stage in turn with run_stages,
+    reporting its time, and stops at a stage that fails or before the next
+    stage once Cancel is pressed. The trace is saved to TRACE_DIR.
+    """
+    outcome, timings, trace = run_stages(
+        stages, trace_memory, cancelled=cancel_event.is_set,
+        on_stage=lambda name, timings: ui_queue.put(('stage', name, timings)))
+
     try:
-        if pn_bool.get() == 1:
-            update_table('ac_property_base',
-                         pn_check,
-                         engine,
-                         'PROP_NUM_DP',
-                         'PROP_NUM',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'PROP_NUM_DP': sqlalchemy.VARCHAR(10)
-                             })
-
-        # Update Pre Spud ID
-        # South Texas uses USER3 to house PSID to avoid unwanted syncing
-        # between Aries and GPlat.
-        if psid_bool.get() == 1:
-            if bu_select.get().upper() == "SOUTH TEXAS":
-                update_table('ac_property_base',
-                             psid_check,
-                             engine,
-                             'PSID_DP',
-                             'USER3',
-                             {
-                                 "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                                 'PSID_DP': sqlalchemy.VARCHAR(255)
-                                 })
-            else:
-                update_table('ac_property_base',
-                             psid_check,
-                             engine,
-                             'PSID_DP',
-                             'PRESPUDWELLID',
-                             {
-                                 "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                                 'PSID_DP': sqlalchemy.VARCHAR(255)
-                                 })
-
-        # Update LEASE
-        if lease_bool.get() == 1:
-            update_table('ac_property_base',
-                         lease_check,
-                         engine,
-                         'WELL_NAME',
-                         'LEASE',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'WELL_NAME': sqlalchemy.VARCHAR(36)
-                             })
-
-        # Update PAD_NAME
-        if padnm_bool.get() == 1:
-            update_table('ac_property_base',
-                         pad_name_check,
-                         engine,
-                         'PAD_NAME_DP',
-                         'PAD_NAME',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'PAD_NAME_DP': sqlalchemy.VARCHAR(36)
-                             })
-
-        # Update M.LAT_SURFACE
-        if msh_lat_bool.get() == 1:
-            update_table('ac_property_base',
-                         sl_lat_check,
-                         engine,
-                         'SL_LAT',
-                         'LAT_SURFACE',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'SL_LAT': sqlalchemy.FLOAT()
-                             })
-
-        # Update M.LONG_SURFACE
-        if msh_long_bool.get() == 1:
-            update_table('ac_property_base',
-                         sl_long_check,
-                         engine,
-                         'SL_LONG',
-                         'LONG_SURFACE',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'SL_LONG': sqlalchemy.FLOAT()
-                             })
-
-        # Update M.LAT_TARGET
-        if mth_lat_bool.get() == 1:
-            update_table('ac_property_base',
-                         th_lat_check,
-                         engine,
-                         'TP_LAT',
-                         'LAT_TARGET',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'TP_LAT': sqlalchemy.FLOAT()
-                             })
-
-        # Update M.LONG_TARGET
-        if mth_long_bool.get() == 1:
-            update_table('ac_property_base',
-                         th_long_check,
-                         engine,
-                         'TP_LONG',
-                         'LONG_TARGET',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'TP_LONG': sqlalchemy.FLOAT()
-                             })
-
-        # Update M.LAT_BH
-        if mbh_lat_bool.get() == 1:
-            update_table('ac_property_base',
-                         bh_lat_check,
-                         engine,
-                         'BHL_LAT',
-                         'LAT_BH',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'BHL_LAT': sqlalchemy.FLOAT()
-                             })
-
-        # Update M.LONG_BH
-        if mbh_long_bool.get() == 1:
-            update_table('ac_property_base',
-                         bh_long_check,
-                         engine,
-                         'BHL_LONG',
-                         'LONG_BH',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'BHL_LONG': sqlalchemy.FLOAT()
-                             })
-
-        # Update M.LATERAL_LEN
-        if m_ll_bool.get() == 1:
-            update_table('ac_property_base',
-                         m_lateral_len_check,
-                         engine,
-                         'COMPLETABLE_LL',
-                         'LATERAL_LEN',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'COMPLETABLE_LL': sqlalchemy.INTEGER()
-                             },  # The extra_condition is to ensure reserves
-                         #  cases arent deleted in ST.
-                         extra_condition=r"AND U.TEXT16 <> 'RESERVES CASE'")
-
-
-        #          Push updates to Budget table          #
-        #          Push updates to Budget table          #
-        #          Push updates to Budget table          #
-
-        # Update B.PROJECT_NAME
-        if projnm_bool.get() == 1:
-            update_table('ac_budget_base',
-                         proj_name_check,
-                         engine,
-                         'PROJECT_NAME_DP',
-                         'PROJECT_NAME',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'PROJECT_NAME_DP': sqlalchemy.VARCHAR(75)
-                             })
-
-        # Update B.PLANNED_SH_LAT
-        if bsh_lat_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_sl_lat_check,
-                         engine,
-                         'SL_LAT',
-                         'PLANNED_SH_LAT',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'SL_LAT': sqlalchemy.FLOAT()
-                             })
-
-        # Update B.PLANNED_SH_LONG
-        if bsh_long_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_sl_long_check,
-                         engine,
-                         'SL_LONG',
-                         'PLANNED_SH_LONG',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'SL_LONG': sqlalchemy.FLOAT()
-                             })
-
-        # Update B.PLANNED_TARGET_LAT
-        if bth_lat_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_th_lat_check,
-                         engine,
-                         'TP_LAT',
-                         'PLANNED_TARGET_LAT',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'TP_LAT': sqlalchemy.FLOAT()
-                             })
-
-        # Update B.PLANNED_TARGET_LONG
-        if bth_long_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_th_long_check,
-                         engine,
-                         'TP_LONG',
-                         'PLANNED_TARGET_LONG',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'TP_LONG': sqlalchemy.FLOAT()
-                             })
-
-        # Update B.PLANNED_BH_LAT
-        if bbh_lat_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_bh_lat_check,
-                         engine,
-                         'BHL_LAT',
-                         'PLANNED_BH_LAT',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'BHL_LAT': sqlalchemy.FLOAT()
-                             })
-
-        # Update B.PLANNED_BH_LONG
-        if bbh_long_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_bh_long_check,
-                         engine,
-                         'BHL_LONG',
-                         'PLANNED_BH_LONG',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'BHL_LONG': sqlalchemy.FLOAT()
-                             })
-
-        # Update B.PLANNED_LL
-        if b_ll_bool.get() == 1:
-            update_table('ac_budget_base',
-                         b_lateral_len_check,
-                         engine,
-                         'COMPLETABLE_LL',
-                         'PLANNED_LL',
-                         {
-                             "ARIES_CODE": sqlalchemy.VARCHAR(255),
-                             'COMPLETABLE_LL': sqlalchemy.INTEGER()
-                             })
-
-        tk.messagebox.showinfo("Aries Update", "Push Successful")
-    except:
-        tk.messagebox.showinfo("Aries Update", "Push Failed")
+        trace_path = save_trace(trace)
+    except OSError as e:
+        trace_path = f'not saved ({e})'
+    ui_queue.put(('finished', outcome, timings, trace, trace_path))
+
+
+def run_in_background(stages):
+    """
+    Runs a list of (stage name, function) pairs one after another on a
+    worker thread. The buttons are disabled until it finishes.
+
+    Anything the stages need from the widgets has to be read before this is
+    called and bound into the functions, e.g. with functools.partial.
+    """
+    cancel_event.clear()
+    for button in action_buttons:
+        button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.NORMAL)
+    progress.config(maximum=len(stages), value=0)
+    threading.Thread(target=_run_stages,
+                     args=(stages, trace_memory_bool.get() == 1),
+                     daemon=True).start()
+
+
+def _format_timings(timings):
+    return '   '.join(f'{name}: {seconds:.1f} s' for name, seconds in timings)
+
+
+def poll_queue():
+    """
+    Handles everything the worker has sent since the last poll, then polls
+    again in 100 ms.
+    """
+    global last_trace
+    while True:
+        try:
+            item = ui_queue.get_nowait()
+        except queue.Empty:
+            break
+
+        if item[0] == 'message':
+            tk.messagebox.showinfo(item[1], item[2])
+        elif item[0] == 'stage':
+            name, timings = item[1:]
+            progress.config(value=len(timings))
+            status.set(f'{_format_timings(timings)}   {name}...'.strip())
+        elif item[0] == 'finished':
+            outcome, timings, trace, trace_path = item[1:]
+            last_trace = (trace, trace_path)
+            progress.config(value=len(timings))
+            status.set(f'{outcome}   {_format_timings(timings)}'.strip())
+            for button in action_buttons:
+                button.config(state=tk.NORMAL)
+            cancel_button.config(state=tk.DISABLED)
+    window.after(100, poll_queue)
+
+
+def _trace_cell(record, key):
+    value = record.get(key)
+    if value is None:
+        return ''
+    if key == 'bytes':
+        return f'{value / 2 ** 20:.1f}'
+    return value
+
+
+def show_trace():
+    """
+    Opens a table of the stages of the last run, from its trace.
+    """
+    if last_trace is None:
+        tk.messagebox.showinfo("Trace", "Nothing has been run yet.")
+        return
+    trace, trace_path = last_trace
+
+    trace_window = tk.Toplevel(window)
+    trace_window.title(f"Trace: {trace['label']}")
+    table = ttk.Treeview(trace_window, columns=list(TRACE_COLUMNS),
+                         show='headings', height=20)
+    for key, heading in TRACE_COLUMNS.items():
+        table.heading(key, text=heading)
+        table.column(key, width=220 if key == 'stage' else 90,
+                     anchor=tk.W if key == 'stage' else tk.E)
+    for record in trace['stages']:
+        table.insert('', tk.END, values=[_trace_cell(record, key)
+                                         for key in TRACE_COLUMNS])
+    table.grid(row=0, column=0, padx=5, pady=5)
+
+    tk.Label(trace_window,
+             text=f"Total {trace['seconds']:.1f} s   Saved to {trace_path}"
+             ).grid(row=10, column=0, pady=5)
 
 #%%
 
@@ -690,10 +468,31 @@ bu_select = tk.Entry(width=60)
 bu_select.grid(row=20, column=0)
 
 connect_button = tk.Button(text="Connect", width=15,
-                           command=lambda: pull_data(bu_select.get().upper())
+                           command=lambda: run_in_background([
+                               ('Pull', partial(
+                                   pull_data,
+                                   bu_select.get().upper(),
+                                   force_refresh_bool.get() == 1,
+                                   PULL_MODES[pull_mode.get()],
+                                   selected_fields()))])
                            )
 connect_button.grid(row=20, column=10, pady=5, padx=5)
 
+# Connect reuses a recent local snapshot unless this is ticked.
+force_refresh_bool = tk.IntVar(value=0)
+force_refresh_cb = tk.Checkbutton(text='Force refresh',
+                                  variable=force_refresh_bool)
+force_refresh_cb.grid(row=30, column=10)
+
+# Pulling the smaller side first means the other database only sends back
+# full rows for wells both sides know about.
+PULL_MODES = {'Pull both in full': None,
+              'Pull Aries first': 'aries',
+              'Pull Dev Planning first': 'dev_planning'}
+pull_mode = tk.StringVar(value='Pull both in full')
+pull_mode_menu = tk.OptionMenu(window, pull_mode, *PULL_MODES)
+pull_mode_menu.grid(row=40, column=10, sticky=tk.N)
+
 
 #           Check Box Frame          #
 #           Check Box Frame          #
@@ -746,71 +545,60 @@ b_ll_cb.grid(row=25, column=10)
 m_lat_long_label = tk.Label(checkbox_frame, text="Master table Lat Longs:")
 m_lat_long_label.grid(row=30, column=5, columnspan=4, sticky=tk.EW)
 
-msh_lat_bool = tk.IntVar(checkbox_frame, value=1)
-msh_lat_cb = tk.Checkbutton(checkbox_frame, text="LAT_SURFACE",
-                            variable=msh_lat_bool)
-msh_lat_cb.grid(row=40, column=0)
-
-msh_long_bool = tk.IntVar(checkbox_frame, value=1)
-msh_long_cb = tk.Checkbutton(checkbox_frame, text="LONG_SURFACE",
-                             variable=msh_long_bool)
-msh_long_cb.grid(row=40, column=10)
-
-mth_lat_bool = tk.IntVar(checkbox_frame, value=1)
-mth_lat_cb = tk.Checkbutton(checkbox_frame, text="LAT_TARGET",
-                            variable=mth_lat_bool)
-mth_lat_cb.grid(row=50, column=0)
+# Each location is checked as a (lat, long) point, by how far apart the two
+# are on the ground.
+msh_bool = tk.IntVar(checkbox_frame, value=1)
+msh_cb = tk.Checkbutton(checkbox_frame, text="SURFACE",
+                        variable=msh_bool)
+msh_cb.grid(row=40, column=0)
 
-mth_long_bool = tk.IntVar(checkbox_frame, value=1)
-mth_long_cb = tk.Checkbutton(checkbox_frame, text="LONG_TARGET",
-                             variable=mth_long_bool)
-mth_long_cb.grid(row=50, column=10)
+mth_bool = tk.IntVar(checkbox_frame, value=1)
+mth_cb = tk.Checkbutton(checkbox_frame, text="TARGET",
+                        variable=mth_bool)
+mth_cb.grid(row=40, column=10)
 
-mbh_lat_bool = tk.IntVar(checkbox_frame, value=1)
-mbh_lat_cb = tk.Checkbutton(checkbox_frame, text="LAT_BH",
-                            variable=mbh_lat_bool)
-mbh_lat_cb.grid(row=60, column=0)
-
-mbh_long_bool = tk.IntVar(checkbox_frame, value=1)
-mbh_long_cb = tk.Checkbutton(checkbox_frame, text="LONG_BH",
-                             variable=mbh_long_bool)
-mbh_long_cb.grid(row=60, column=10)
+mbh_bool = tk.IntVar(checkbox_frame, value=1)
+mbh_cb = tk.Checkbutton(checkbox_frame, text="BH",
+                        variable=mbh_bool)
+mbh_cb.grid(row=50, column=0)
 
 # Add label for budget table start dates
 b_lat_long_label = tk.Label(checkbox_frame, text="Budget table Lat Longs:")
 b_lat_long_label.grid(row=70, column=5, columnspan=4, sticky=tk.EW)
 
-bsh_lat_bool = tk.IntVar(checkbox_frame, value=1)
-bsh_lat_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_SH_LAT",
-                            variable=bsh_lat_bool)
-bsh_lat_cb.grid(row=80, column=0)
-
-bsh_long_bool = tk.IntVar(checkbox_frame, value=1)
-bsh_long_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_SH_LONG",
-                             variable=bsh_long_bool)
-bsh_long_cb.grid(row=80, column=10)
-
-bth_lat_bool = tk.IntVar(checkbox_frame, value=1)
-bth_lat_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_TARGET_LAT",
-                            variable=bth_lat_bool)
-bth_lat_cb.grid(row=90, column=0)
-
-bth_long_bool = tk.IntVar(checkbox_frame, value=1)
-bth_long_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_TARGET_LONG",
-                             variable=bth_long_bool)
-bth_long_cb.grid(row=90, column=10)
-
-bbh_lat_bool = tk.IntVar(checkbox_frame, value=1)
-bbh_lat_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_BH_LAT",
-                            variable=bbh_lat_bool)
-bbh_lat_cb.grid(row=100, column=0)
-
-
-bbh_long_bool = tk.IntVar(checkbox_frame, value=1)
-bbh_long_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_BH_LONG",
-                             variable=bbh_long_bool)
-bbh_long_cb.grid(row=100, column=10)
-
+bsh_bool = tk.IntVar(checkbox_frame, value=1)
+bsh_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_SH",
+                        variable=bsh_bool)
+bsh_cb.grid(row=80, column=0)
+
+bth_bool = tk.IntVar(checkbox_frame, value=1)
+bth_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_TARGET",
+                        variable=bth_bool)
+bth_cb.grid(row=80, column=10)
+
+bbh_bool = tk.IntVar(checkbox_frame, value=1)
+bbh_cb = tk.Checkbutton(checkbox_frame, text="PLANNED_BH",
+                        variable=bbh_bool)
+bbh_cb.grid(row=90, column=0)
+
+
+# Check box variables keyed by the FIELD_CHECKS name they switch on.
+field_bools = {
+    'PSID': psid_bool,
+    'PROP_NUM': pn_bool,
+    'LEASE': lease_bool,
+    'PROJECT NAME': projnm_bool,
+    'PAD_NAME': padnm_bool,
+    'MDA': mda_bool,
+    'SH_LOCATION': msh_bool,
+    'TH_LOCATION': mth_bool,
+    'BH_LOCATION': mbh_bool,
+    'LATERAL_LEN': m_ll_bool,
+    'PLANNED_SH_LOCATION': bsh_bool,
+    'PLANNED_TARGET_LOCATION': bth_bool,
+    'PLANNED_BH_LOCATION': bbh_bool,
+    'PLANNED_LL': b_ll_bool,
+}
 
 #           End Check Box Frame          #
 #           End Check Box Frame          #
@@ -824,8 +612,10 @@ backup_fold_ent = tk.Entry(width=60)
 backup_fold_ent.grid(row=60, column=0, padx=15)
 
 backup_btn = tk.Button(text="Backup Aries and DP",
-                       command=lambda: [run_checks(),
-                                        write_backups(backup_fold_ent.get())])
+                       command=lambda: run_in_background([
+                           ('Checks', partial(run_checks, selected_fields())),
+                           ('Backups', partial(write_backups,
+                                               backup_fold_ent.get()))]))
 backup_btn.grid(row=60, column=10)
 
 
@@ -844,13 +634,20 @@ open_change_btn.grid(row=66, column=10)
 
 
 update_button = tk.Button(text="UPDATE ARIES", background='Red',
-                          width=70, height=5, command=lambda: update_aries())
+                          width=70, height=5,
+                          command=lambda: run_in_background([
+                              ('Update Aries', partial(
+                                  update_aries,
+                                  fields=selected_fields(),
+                                  business_unit=bu_select.get().upper()))]))
 update_button.grid(row=70, column=0, columnspan=40, pady=7)
 
 qc_btn = tk.Button(text="Post Update QC",
                    width=15,
-                   command=lambda: [run_checks(),
-                                    write_qc(backup_fold_ent.get())])
+                   command=lambda: run_in_background([
+                       ('Checks', partial(run_checks, selected_fields())),
+                       ('QC workbook', partial(write_qc,
+                                               backup_fold_ent.get()))]))
 qc_btn.grid(row=80, column=10)
 
 open_change_btn = tk.Button(text="Open Update QC", width=15,
@@ -863,6 +660,30 @@ close_btn = tk.Button(text='Exit', width=15, height=3, pady=10,
                       command=lambda: window.destroy())
 close_btn.grid(row=90, column=10)
 
+# Progress of whatever the worker thread is running.
+progress = ttk.Progressbar(window, mode='determinate', length=400)
+progress.grid(row=95, column=0, pady=5)
+
+cancel_button = tk.Button(text='Cancel', width=15, state=tk.DISABLED,
+                          command=lambda: cancel_event.set())
+cancel_button.grid(row=95, column=10)
+
+status = tk.StringVar(value='Ready')
+status_label = tk.Label(textvariable=status)
+status_label.grid(row=100, column=0, columnspan=40)
+
+# Every run is traced. Tracing memory as well slows the run down.
+trace_memory_bool = tk.IntVar(value=0)
+trace_memory_cb = tk.Checkbutton(text='Trace memory',
+                                 variable=trace_memory_bool)
+trace_memory_cb.grid(row=105, column=0)
+
+trace_btn = tk.Button(text="Show Trace", width=15, command=show_trace)
+trace_btn.grid(row=105, column=10, pady=5)
+
+action_buttons = [connect_button, backup_btn, update_button, qc_btn]
+
+window.after(100, poll_queue)
 window.mainloop()
 #%%
 
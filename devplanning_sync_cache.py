@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Local snapshot cache for the Dev Planning and Aries pulls.
+
+Each (source, business unit) pull is saved as an Arrow IPC file with a small
+JSON file next to it holding when it was pulled, the query it came from and
+a fingerprint of its contents. Re-runs and post-update QC read the
+snapshot instead of going back to Snowflake or Working District.
+
+When a source has a last-modified column, a stale snapshot is brought up to
+date by pulling only the rows changed since its high-water mark and merging
+them in by key, instead of pulling the whole business unit again.
+
+pyarrow is optional. Without it every read is a miss and nothing is written.
+"""
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from devplanning_sync_functions import concat_chunks
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401
+except ImportError:
+    pa = None
+
+
+# Folder the snapshots are kept in. Set DEVPLANNING_SYNC_CACHE to move it.
+CACHE_DIR = os.environ.get(
+    'DEVPLANNING_SYNC_CACHE',
+    os.path.join(os.path.expanduser('~'), '.devplanning_sync_cache'))
+
+# How many seconds a snapshot is used for before the source is queried again.
+DEFAULT_TTL = 60 * 60
+
+# Column the loaders select the last-modified expression into. Its highest
+# value is saved with the snapshot as the high-water mark.
+WATERMARK_COLUMN = 'SYNC_WATERMARK'
+
+
+def _snapshot_paths(source, business_unit, cache_dir):
+    """
+    Returns the (data, metadata) file paths for a source and business unit.
+    """
+    name = '{source}_{business_unit}'.format(
+        source=source,
+        business_unit=''.join(character if character.isalnum() else '_'
+                              for character in business_unit.upper()))
+    return (os.path.join(cache_dir, name + '.arrow'),
+            os.path.join(cache_dir, name + '.json'))
+
+
+def _temp_path(path):
+    """
+    Returns a name to write a file under before it is moved to path, unique
+    to the process and thread writing it.
+    """
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def fingerprint(frame):
+    """
+    Hashes the column names and contents of a frame, so two pulls can be
+    told apart without comparing them cell by cell.
+
+    Returns:
+        Hex digest string.
+    """
+    digest = hashlib.sha256()
+    digest.update('\x1f'.join(map(str, frame.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=False)
+                  .to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _query_key(query):
+    """
+    Shortens a query to a hash so a snapshot is only reused for the query
+    that produced it.
+    """
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def snapshot_info(source, business_unit, cache_dir=CACHE_DIR):
+    """
+    Returns the metadata saved with a snapshot, or None if there isn't one.
+    """
+    meta_path = _snapshot_paths(source, business_unit, cache_dir)[1]
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        return json.load(meta_file)
+
+
+def read_snapshot(source, business_unit, query, ttl=DEFAULT_TTL,
+                  cache_dir=CACHE_DIR):
+    """
+    Loads a saved pull if there is one for the same query that is younger
+    than ttl.
+
+    Args:
+        source: 'dev_planning' or 'aries'.
+        business_unit: The business unit the pull was for.
+        query: The SQL the pull ran.
+        ttl: Oldest snapshot to accept, in seconds.
+        cache_dir: Folder the snapshots are kept in.
+
+    Returns:
+        pd.DataFrame, or None when there is no usable snapshot, or the data
+        file isn't the one the metadata was saved with. The metadata is kept
+        in the frame's attrs under 'snapshot'.
+    """
+    if pa is None:
+        return None
+
+    info = snapshot_info(source, business_unit, cache_dir)
+    if (info is None
+            or info['query'] != _query_key(query)
+            or time.time() - info['pulled_at'] > ttl):
+        return None
+
+    data_path = _snapshot_paths(source, business_unit, cache_dir)[0]
+    # Read into memory rather than memory mapped. A frame backed by a
+    # mapping keeps the file open, and Windows won't delete or replace an
+    # open file, so the snapshot couldn't be cleared or rewritten while the
+    # frame is in use.
+    try:
+        with pa.OSFile(data_path, 'rb') as source_file:
+            table = pa.ipc.open_file(source_file).read_all()
+    except (OSError, pa.ArrowInvalid):
+        return None
+    # The data file is replaced before the metadata, so one being written
+    # right now can be newer than info.
+    if (table.schema.metadata or {}).get(b'fingerprint') != (
+            info['fingerprint'].encode()):
+        return None
+
+    frame = table.to_pandas()
+
+    frame.attrs['snapshot'] = info
+    return frame
+
+
+def write_snapshot(frame, source, business_unit, query, watermark=None,
+                   cache_dir=CACHE_DIR):
+    """
+    Saves a pull so later runs can reuse it.
+
+    Args:
+        frame (pd.DataFrame): The pulled data.
+        source: 'dev_planning' or 'aries'.
+        business_unit: The business unit the pull was for.
+        query: The SQL the pull ran.
+        watermark: High-water mark to start the next incremental pull from.
+        cache_dir: Folder the snapshots are kept in.
+
+    Returns:
+        The metadata that was saved, or None if pyarrow isn't installed or
+        the frame holds values Arrow can't store.
+    """
+    if pa is None:
+        return None
+
+    try:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+    info = {'source': source,
+            'business_unit': business_unit,
+            'query': _query_key(query),
+            'pulled_at': time.time(),
+            'rows': len(frame),
+            'fingerprint': fingerprint(frame),
+            'watermark': watermark}
+    # Saved in the data file too, so read_snapshot can tell it goes with
+    # the metadata.
+    table = table.replace_schema_metadata(
+        dict(table.schema.metadata or {}, fingerprint=info['fingerprint']))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = _snapshot_paths(source, business_unit, cache_dir)
+    temp_paths = [_temp_path(path) for path in paths]
+    # Both files are written under temporary names and then moved into
+    # place, the metadata last, so a crash or a reader never sees half a
+    # file or new metadata with the old data.
+    try:
+        with pa.OSFile(temp_paths[0], 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        with open(temp_paths[1], 'w') as meta_file:
+            json.dump(info, meta_file)
+        for temp_path, path in zip(temp_paths, paths):
+            os.replace(temp_path, path)
+    finally:
+        for temp_path in temp_paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+    return info
+
+
+def clear_snapshots(source=None, business_unit=None, cache_dir=CACHE_DIR):
+    """
+    Deletes saved pulls so the next load goes back to the database.
+
+    Args:
+        source: Only clear this source. Clears every source when None.
+        business_unit: Only clear this business unit, including pulls that
+                       covered it along with others. Clears every business
+                       unit when None.
+        cache_dir: Folder the snapshots are kept in.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    # Another process may be clearing the same snapshots, so files that
+    # are gone by the time they're opened or deleted are skipped.
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(cache_dir, file_name)) as meta_file:
+                info = json.load(meta_file)
+        except FileNotFoundError:
+            continue
+        if source is not None and info['source'] != source:
+            continue
+        # Pulls of several business units are saved under their names
+        # joined with ', '.
+        if (business_unit is not None
+                and business_unit.upper() not in
+                info['business_unit'].upper().split(', ')):
+            continue
+        for path in _snapshot_paths(info['source'], info['business_unit'],
+                                    cache_dir):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def _watermark(values):
+    """
+    Returns the highest value of a last-modified column as a string that
+    both Snowflake and SQL Server will compare against, or None if the
+    column is empty.
+    """
+    latest = values.max() if len(values) else None
+    if latest is None or pd.isna(latest):
+        return None
+    if isinstance(latest, (datetime.datetime, np.datetime64)):
+        # Cut to milliseconds so SQL Server DATETIME columns accept it.
+        # Rounding down only means a few rows get pulled twice.
+        return pd.Timestamp(latest).isoformat(sep=' ', timespec='milliseconds')
+    return str(latest)
+
+
+def merge_snapshot(cached, changed, key):
+    """
+    Folds the rows of an incremental pull into an earlier pull. A key can
+    have several rows (Dev Planning has an A and an MDV scenario, Aries a
+    case per reserve category) and rows with no key can't be matched up at
+    all. So every cached row of a key that came back is replaced by the
+    rows that came back for it, and every cached row with no key is
+    replaced by the ones that came back.
+
+    Args:
+        cached (pd.DataFrame): The earlier pull.
+        changed (pd.DataFrame): Every current row of each key with a change
+                                since the earlier pull, and every current
+                                row with no key.
+        key: Column the rows are grouped on, e.g. ARIES_CODE.
+
+    Returns:
+        pd.DataFrame with the merged rows.
+    """
+    replaced = cached[key].isin(changed[key].dropna()) | cached[key].isna()
+    return concat_chunks([cached.loc[~replaced], changed])
+
+
+def cached_pull(source, business_unit, query, pull, ttl=DEFAULT_TTL,
+                force_refresh=False, delta_query=None, key=None, keep=None,
+                cache_dir=CACHE_DIR):
+    """
+    Returns a source's data from the freshest place that's good enough: a
+    snapshot younger than ttl, a stale snapshot plus the rows changed since
+    its high-water mark, or a full pull.
+
+    Args:
+        source: 'dev_planning' or 'aries'.
+        business_unit: The business unit being pulled.
+        query: The SQL for a full pull.
+        pull: Function that runs a SQL string and returns a pd.DataFrame.
+        ttl: Oldest snapshot to reuse as is, in seconds.
+        force_refresh: Skip the snapshot and do a full pull.
+        delta_query: Function that takes a high-water mark and returns the
+                     SQL for every row of each key changed since then and
+                     every row with no key (see merge_snapshot).
+                     Incremental pulls are off when None.
+        key: Column the changed rows are merged in on.
+        keep: Function that takes the merged frame and returns a boolean
+              mask of the rows that still pass the full query's filters.
+              The delta query leaves those filters out so rows that no
+              longer pass them are seen and dropped.
+        cache_dir: Folder the snapshots are kept in.
+
+    Returns:
+        pd.DataFrame. attrs['pull'] says where it came from ('snapshot',
+        'incremental' or 'full'), its fingerprint, and for incremental
+        pulls the fingerprint it was merged into and the changed keys.
+
+    Notes:
+        Rows deleted at the source aren't seen by an incremental pull. Use
+        force_refresh now and then to start again from a full pull.
+    """
+    if not force_refresh:
+        frame = read_snapshot(source, business_unit, query, ttl, cache_dir)
+        if frame is not None:
+            frame.attrs['pull'] = {
+                'mode': 'snapshot',
+                'fingerprint': frame.attrs['snapshot']['fingerprint']}
+            return frame
+
+    if not force_refresh and delta_query is not None:
+        cached = read_snapshot(source, business_unit, query, float('inf'),
+                               cache_dir)
+        if cached is not None and cached.attrs['snapshot']['watermark']:
+            since = cached.attrs['snapshot']['watermark']
+            changed = pull(delta_query(since))
+            frame = merge_snapshot(cached, changed, key)
+            if keep is not None:
+                frame = frame.loc[keep(frame)].reset_index(drop=True)
+            info = write_snapshot(
+                frame, source, business_unit, query,
+                _watermark(changed[WATERMARK_COLUMN]) or since, cache_dir)
+            frame.attrs['pull'] = {
+                'mode': 'incremental',
+                'fingerprint': info and info['fingerprint'],
+                'base': cached.attrs['snapshot']['fingerprint'],
+                'changed': changed[key].dropna().unique().tolist()}
+            return frame
+
+    frame = pull(query)
+    watermark = None
+    if delta_query is not None and WATERMARK_COLUMN in frame:
+        watermark = _watermark(frame[WATERMARK_COLUMN])
+    info = write_snapshot(frame, source, business_unit, query, watermark,
+                          cache_dir)
+    frame.attrs['pull'] = {'mode': 'full',
+                           'fingerprint': info and info['fingerprint']}
+    return frame
+
+
+def changed_since(frame, fingerprint):
+    """
+    Works out which keys of a pulled frame changed since the pull with the
+    given fingerprint.
+
+    Returns:
+        A set of keys, empty if nothing changed, or None when it can't be
+        told and everything should be treated as changed.
+    """
+    pull = frame.attrs.get('pull')
+    if pull is None or fingerprint is None or pull['fingerprint'] is None:
+        return None
+    if pull['fingerprint'] == fingerprint:
+        return set()
+    if pull['mode'] == 'incremental' and pull['base'] == fingerprint:
+        return set(pull['changed'])
+    return None
+
+
+if __name__ == "__main__":
+    pass
@@ -1,11 +1,354 @@
+import contextlib
 import os
+import re
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pyodbc
 import sqlalchemy
+from pandas.api.types import union_categoricals
 
+from devplanning_sync_trace import frame_bytes
+from devplanning_sync_trace import trace_stage
+
+# Text columns are stored as Arrow strings when pyarrow is installed, which
+# take a fraction of the memory of Python str objects.
+try:
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    STRING_DTYPE = pd.StringDtype()
+
+
+# Every label a check can return. The long-format results from compare_fields
+# store the status as a categorical over this list.
+STATUS_LABELS = ['MATCH',
+                 'UPDATE ARIES',
+                 'UPDATE DEVPLANNING',
+                 'NOT ASSIGNED',
+                 'BOTH VALUES NULL',
+                 'DP EMPTY',
+                 'COSMETIC ONLY']
+
+# Mean radius of the Earth, for the distances the point checks measure.
+EARTH_RADIUS_M = 6371008.8
+EARTH_RADIUS_FT = EARTH_RADIUS_M / 0.3048
+
+# Furthest apart, in feet, two locations can be and still match. The old
+# per-axis cut off of 0.00005 degrees is about 18 ft of latitude.
+POINT_TOLERANCE = 20
+
+# Words name checks treat as the same as their abbreviation, keyed by the
+# casefolded word.
+NAME_ABBREVIATIONS = {'north': 'n',
+                      'south': 's',
+                      'east': 'e',
+                      'west': 'w',
+                      'unit': 'unt',
+                      'ranch': 'rch',
+                      'state': 'st'}
+
+# The field checks run_checks can run, keyed by the name used for the check
+# boxes and spreadsheet tabs. Each spec is (DP column, Aries column, kind,
+# tolerance). kind is 'text', 'name', 'numeric' or 'point'. Name checks
+# compare text on name_key and call differences in case, spacing,
+# punctuation or NAME_ABBREVIATIONS 'COSMETIC ONLY' so they aren't pushed.
+# A numeric tolerance is either a number, which is absolute so 0.5 matches
+# the old round_to=0 behaviour, or an ('abs', x) or ('rel', x) pair, where
+# ('rel', 0.01) lets the values differ by 1% of the larger one. Point checks
+# compare (lat, long) column pairs and their tolerance is a distance in
+# feet.
+FIELD_CHECKS = {
+    'PSID': ('PSID_DP', 'PSID_AR', 'numeric', 0.5),
+    'PROP_NUM': ('PROP_NUM_DP', 'PROP_NUM_AR', 'text', None),
+    'LEASE': ('WELL_NAME', 'LEASE', 'name', None),
+    'PROJECT NAME': ('PROJECT_NAME_DP', 'PROJECT_NAME_AR', 'name', None),
+    'PAD_NAME': ('PAD_NAME_DP', 'PAD_NAME_AR', 'name', None),
+    'MDA': ('MKT_DEDICATION_AREA', 'MDA', 'text', None),
+    'SH_LOCATION': (('SL_LAT', 'SL_LONG'), ('LAT_SURFACE', 'LONG_SURFACE'),
+                    'point', POINT_TOLERANCE),
+    'TH_LOCATION': (('TP_LAT', 'TP_LONG'), ('LAT_TARGET', 'LONG_TARGET'),
+                    'point', POINT_TOLERANCE),
+    'BH_LOCATION': (('BHL_LAT', 'BHL_LONG'), ('LAT_BH', 'LONG_BH'),
+                    'point', POINT_TOLERANCE),
+    'LATERAL_LEN': ('COMPLETABLE_LL', 'LATERAL_LEN', 'numeric', 0.5),
+    'PLANNED_SH_LOCATION': (('SL_LAT', 'SL_LONG'),
+                            ('PLANNED_SH_LAT', 'PLANNED_SH_LONG'),
+                            'point', POINT_TOLERANCE),
+    'PLANNED_TARGET_LOCATION': (('TP_LAT', 'TP_LONG'),
+                                ('PLANNED_TARGET_LAT', 'PLANNED_TARGET_LONG'),
+                                'point', POINT_TOLERANCE),
+    'PLANNED_BH_LOCATION': (('BHL_LAT', 'BHL_LONG'),
+                            ('PLANNED_BH_LAT', 'PLANNED_BH_LONG'),
+                            'point', POINT_TOLERANCE),
+    'PLANNED_LL': ('COMPLETABLE_LL', 'PLANNED_LL', 'numeric', 0.5),
+}
+
+# Dev Planning columns every run pulls, whichever checks are switched on.
+# They are used for the in_dp_not_aries report and to pick between
+# duplicate rows.
+DP_BASE_COLUMNS = ['ARIES_ID',
+                   'WELL_NAME',
+                   'RSV_CAT',
+                   'BUSINESS_UNIT',
+                   'SCENARIO',
+                   'DEV_STATUS']
+
+# FIELD_CHECKS columns that don't come straight from DEV_PLANNING under the
+# same name, mapped to the DEV_PLANNING columns they are built from.
+DP_SOURCE_COLUMNS = {
+    'PSID_DP': ['PSID'],
+    'PROP_NUM_DP': ['PROP_NUM'],
+    'PROJECT_NAME_DP': ['PROJECT_NAME'],
+    'PAD_NAME_DP': ['PAD_NAME'],
+    'TP_LAT': ['WAYPOINT1_LAT', 'LP_LAT'],
+    'TP_LONG': ['WAYPOINT1_LONG', 'LP_LONG'],
+}
+
+
+def dev_planning_columns(fields=None):
+    """
+    Works out which DEV_PLANNING columns have to be pulled for a set of
+    checks, so the Snowflake query doesn't fetch every GIS column.
+
+    Args:
+        fields: FIELD_CHECKS names that will be run. Defaults to all of them.
+
+    Returns:
+        List of DEV_PLANNING column names, without duplicates.
+    """
+    if fields is None:
+        fields = FIELD_CHECKS
+
+    columns = list(DP_BASE_COLUMNS)
+    for field in fields:
+        for col_dp in _spec_columns(FIELD_CHECKS[field][0]):
+            for column in DP_SOURCE_COLUMNS.get(col_dp, [col_dp]):
+                if column not in columns:
+                    columns.append(column)
+    return columns
+
+
+def _spec_columns(column):
+    """
+    Returns the columns one side of a FIELD_CHECKS spec uses as a list. That
+    is the (lat, long) pair for point checks and a single column otherwise.
+    """
+    if isinstance(column, tuple):
+        return list(column)
+    return [column]
+
+
+# dtypes the pulls are cast to as they are read. 'category' columns get
+# whatever codes turn up; the fixed categoricals are the values the queries
+# filter on, so anything else becomes NaN. PROP_NUM stays text because the
+# leading zeros matter.
+_COORDINATE = 'float64'
+DP_SCHEMA = {
+    'ARIES_ID': STRING_DTYPE,
+    'WELL_NAME': STRING_DTYPE,
+    'RSV_CAT': 'category',
+    'BUSINESS_UNIT': 'category',
+    'SCENARIO': pd.CategoricalDtype(['A', 'MDV']),
+    'DEV_STATUS': pd.CategoricalDtype(['PRIMARY', 'DEVELOPMENT']),
+    'PSID': 'Int64',
+    'PROP_NUM': STRING_DTYPE,
+    'PROJECT_NAME': STRING_DTYPE,
+    'PAD_NAME': STRING_DTYPE,
+    'MKT_DEDICATION_AREA': 'category',
+    'SL_LAT': _COORDINATE,
+    'SL_LONG': _COORDINATE,
+    'WAYPOINT1_LAT': _COORDINATE,
+    'WAYPOINT1_LONG': _COORDINATE,
+    'LP_LAT': _COORDINATE,
+    'LP_LONG': _COORDINATE,
+    'BHL_LAT': _COORDINATE,
+    'BHL_LONG': _COORDINATE,
+    'COMPLETABLE_LL': 'float64',
+}
+ARIES_SCHEMA = {
+    'ARIES_CODE': STRING_DTYPE,
+    'BUSINESS_UNIT': 'category',
+    'RSV_CAT': pd.CategoricalDtype(['5PUD', '5PUDX', '6PROB', '7POSS']),
+    'PROP_NUM': STRING_DTYPE,
+    'PRESPUDWELLID': STRING_DTYPE,
+    'USER3': STRING_DTYPE,
+    'LEASE': STRING_DTYPE,
+    'PAD_NAME': STRING_DTYPE,
+    'LAT_SURFACE': _COORDINATE,
+    'LONG_SURFACE': _COORDINATE,
+    'LAT_TARGET': _COORDINATE,
+    'LONG_TARGET': _COORDINATE,
+    'LAT_BH': _COORDINATE,
+    'LONG_BH': _COORDINATE,
+    'PLANNED_SH_LAT': _COORDINATE,
+    'PLANNED_SH_LONG': _COORDINATE,
+    'PLANNED_TARGET_LAT': _COORDINATE,
+    'PLANNED_TARGET_LONG': _COORDINATE,
+    'PLANNED_BH_LAT': _COORDINATE,
+    'PLANNED_BH_LONG': _COORDINATE,
+    'LATERAL_LEN': 'float64',
+    'PLANNED_LL': 'float64',
+    'PROJECT_NAME': STRING_DTYPE,
+    'MDA': 'category',
+    'RESV_ENG': 'category',
+    'RESERVOIR': 'category',
+    'TYPECURVE': 'category',
+    'TYPECURVE_SHORT': 'category',
+}
+
+
+def cast_columns(frame, schema):
+    """
+    Casts the columns of frame that appear in schema to their declared
+    dtype. Columns that aren't in the schema, and schema entries that
+    weren't pulled, are left alone.
+
+    Args:
+        frame (pd.DataFrame): A chunk of pulled rows. It is changed in place.
+        schema: Dict of column name to dtype, like DP_SCHEMA.
+
+    Returns:
+        frame, for chaining.
+    """
+    for column, dtype in schema.items():
+        if column not in frame.columns:
+            continue
+        if dtype in ('Int64', 'float64'):
+            # Snowflake hands NUMBER columns back as Decimal objects.
+            frame[column] = pd.to_numeric(frame[column]).astype(dtype)
+        else:
+            frame[column] = frame[column].astype(dtype)
+    return frame
+
+
+def concat_chunks(frames):
+    """
+    Concatenates chunks cast by cast_columns. Categoricals are given the
+    union of every chunk's categories first, otherwise pd.concat would turn
+    them back into object columns. A chunk where a categorical column is
+    all null has no categories of the right type, so it is left out of the
+    union.
+
+    Args:
+        frames: List of pd.DataFrames with the same columns.
+
+    Returns:
+        pd.DataFrame with a fresh RangeIndex.
+    """
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+
+    for column in frames[0].columns:
+        if not isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            continue
+        columns = [frame[column] for frame in frames
+                   if len(frame[column].cat.categories)]
+        if not columns:
+            continue
+        categories = union_categoricals(columns).categories
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_sql_chunked(query, conn, schema, chunksize=50000, params=None):
+    """
+    Streams a query in chunks and casts each chunk to schema as it arrives,
+    so only one chunk at a time is ever held as Python objects.
+
+    Args:
+        query: SQL string to run.
+        conn: Open DB-API connection.
+        schema: Dict of column name to dtype, like DP_SCHEMA.
+        chunksize: Rows fetched per chunk.
+        params: Values for the query's placeholders.
+
+    Returns:
+        pd.DataFrame with the schema's dtypes. A query that returns no rows
+        still gives its columns, taken from the cursor rather than by
+        running the query again.
+    """
+    cursor = conn.cursor()
+    try:
+        if params is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        frames = []
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows and frames:
+                break
+            # Decimals are turned into floats, as pd.read_sql does.
+            frames.append(cast_columns(
+                pd.DataFrame.from_records(rows, columns=columns,
+                                          coerce_float=True), schema))
+            if not rows:
+                break
+    finally:
+        cursor.close()
+    return concat_chunks(frames)
+
+
+# Where update_aries pushes each FIELD_CHECKS field, as (table to update,
+# Aries column, SQL type of the Dev Planning value, extra condition). Point
+# checks push both columns of their (lat, long) pair. The PSID column is
+# swapped for USER3 in South Texas by aries_changes.
+ARIES_UPDATES = {
+    'PROP_NUM': ('ac_property_base', 'PROP_NUM', sqlalchemy.VARCHAR(10), ''),
+    'PSID': ('ac_property_base', 'PRESPUDWELLID', sqlalchemy.VARCHAR(255),
+             ''),
+    'LEASE': ('ac_property_base', 'LEASE', sqlalchemy.VARCHAR(36), ''),
+    'PAD_NAME': ('ac_property_base', 'PAD_NAME', sqlalchemy.VARCHAR(36), ''),
+    'SH_LOCATION': ('ac_property_base', ('LAT_SURFACE', 'LONG_SURFACE'),
+                    sqlalchemy.FLOAT(), ''),
+    'TH_LOCATION': ('ac_property_base', ('LAT_TARGET', 'LONG_TARGET'),
+                    sqlalchemy.FLOAT(), ''),
+    'BH_LOCATION': ('ac_property_base', ('LAT_BH', 'LONG_BH'),
+                    sqlalchemy.FLOAT(), ''),
+    # The extra condition is to ensure reserves cases aren't deleted in ST.
+    'LATERAL_LEN': ('ac_property_base', 'LATERAL_LEN', sqlalchemy.INTEGER(),
+                    "AND U.TEXT16 <> 'RESERVES CASE'"),
+    'PROJECT NAME': ('ac_budget_base', 'PROJECT_NAME',
+                     sqlalchemy.VARCHAR(75), ''),
+    'PLANNED_SH_LOCATION': ('ac_budget_base',
+                            ('PLANNED_SH_LAT', 'PLANNED_SH_LONG'),
+                            sqlalchemy.FLOAT(), ''),
+    'PLANNED_TARGET_LOCATION': ('ac_budget_base',
+                                ('PLANNED_TARGET_LAT', 'PLANNED_TARGET_LONG'),
+                                sqlalchemy.FLOAT(), ''),
+    'PLANNED_BH_LOCATION': ('ac_budget_base',
+                            ('PLANNED_BH_LAT', 'PLANNED_BH_LONG'),
+                            sqlalchemy.FLOAT(), ''),
+    'PLANNED_LL': ('ac_budget_base', 'PLANNED_LL', sqlalchemy.INTEGER(), ''),
+}
+
+# How the updates address Aries on each database, keyed by the SQLAlchemy
+# dialect name of the engine they are pushed with. table is formatted with
+# the Aries table name, staging is the table the changes are uploaded to
+# and the two statements clear and create it. SQL Server is Working
+# District. SQLite is the local stand-in from devplanning_sync_sqlite.
+UPDATE_DIALECTS = {
+    'mssql': {
+        'table': '[WORKING_DISTRICT].[AriesAdmin].[{table}]',
+        'staging': '#check_table',
+        'drop_staging': "IF OBJECT_ID('tempdb..#check_table') IS NOT NULL "
+                        "DROP TABLE #check_table;",
+        'create_staging': 'CREATE TABLE #check_table ({columns}, '
+                          'PRIMARY KEY CLUSTERED (ARIES_CODE));',
+    },
+    'sqlite': {
+        'table': '{table}',
+        'staging': 'check_table',
+        'drop_staging': 'DROP TABLE IF EXISTS temp.check_table;',
+        'create_staging': 'CREATE TEMP TABLE check_table ({columns}, '
+                          'PRIMARY KEY (ARIES_CODE));',
+    },
+}
 
 
 def connect_to_snowflake():
@@ -20,12 +363,106 @@ def connect_to_snowflake():
     return conn
 
 
+def _coerce_value(value, type_to_coerce):
+    """
+    Coerces a single value the way hierarchical_select always has, returning
+    None when the value is None, NaN or can't be coerced.
+    """
+    try:
+        type_to_coerce(value)
+        if pd.isna(value):
+            return None
+        return type_to_coerce(value)
+    except TypeError:  # This is necessary to handle None types
+        return None
+    except ValueError:  # This is necessary to handle NaN float types.
+        return None
+
+
+def _coerce_column(column, type_to_coerce):
+    """
+    Coerces a whole column to type_to_coerce, leaving NaN (or None for
+    types other than int and float) wherever a value is missing or can't be
+    parsed. Every value parses the same as it would with int() or float().
+
+    Args:
+        column (pd.Series): Values to coerce.
+        type_to_coerce: int, float or any callable that converts one value.
+
+    Returns:
+        np.ndarray of float64 for int and float, of objects otherwise.
+    """
+    column = column.astype(object)
+    if type_to_coerce not in (int, float):
+        return np.array([_coerce_value(value, type_to_coerce)
+                         for value in column], dtype=object)
+
+    numeric = pd.to_numeric(column, errors='coerce').to_numpy(
+        dtype='float64', na_value=np.nan)
+    is_text = column.map(lambda value: isinstance(value, (str, bytes)))
+    is_text = is_text.to_numpy(dtype=bool)
+
+    if type_to_coerce is int:
+        # int() only accepts strings written as whole numbers, so '43720.0'
+        # or '1e3' can't keep what to_numeric made of them.
+        whole = column[is_text].astype(str).str.fullmatch(r'\s*[+-]?\d+\s*')
+        numeric[np.flatnonzero(is_text)[~whole.to_numpy(dtype=bool)]] = np.nan
+        numeric[~np.isfinite(numeric)] = np.nan
+        numeric = np.trunc(numeric)
+
+    # int() and float() read some text to_numeric doesn't, like '1_000' or
+    # b'5', so what it couldn't read is tried one value at a time.
+    for position in np.flatnonzero(is_text & np.isnan(numeric)):
+        value = _coerce_value(column.iloc[position], type_to_coerce)
+        if value is not None:
+            numeric[position] = value
+    return numeric
+
+
+def coalesce_columns(columns, type_to_coerce, default=0):
+    """
+    Columnar version of hierarchical_select. Takes an ordered list of columns
+    and, for every row, returns the first value that is not None, NaN or
+    unparseable after coercing it to type_to_coerce.
+
+    Params:
+        columns (list): Columns (pd.Series or array-likes of equal length) in
+                        order of preference.
+        type_to_coerce (type): int or float. Other callables work as well but
+                               are applied one value at a time.
+        default (any): Value used when none of the columns have a usable value.
+
+    Returns:
+        pd.Series indexed like the first column. It is int64 for int, float64
+        for float and object for anything else.
+    """
+    columns = [pd.Series(column) for column in columns]
+    index = columns[0].index
+
+    result = _coerce_column(columns[0], type_to_coerce)
+    for column in columns[1:]:
+        coerced = _coerce_column(column, type_to_coerce)
+        missing = pd.isna(result)
+        result[missing] = coerced[missing]
+    result[pd.isna(result)] = default
+
+    if type_to_coerce is int:
+        return pd.Series(result, index=index, dtype='int64')
+    if type_to_coerce is float:
+        return pd.Series(result, index=index, dtype='float64')
+    return pd.Series(result, index=index, dtype=object)
+
+
 def hierarchical_select(primary, secondary, type_to_coerce):
     """
     Takes two inputs and returns the first if it is not none
     returns the second if it isn't none, and
     returns 0 when both inputs are none.
 
+    This is the single row version of coalesce_columns and is kept for
+    scripts that still work one value at a time. Unlike coalesce_columns it
+    returns the int 0 whatever type_to_coerce is.
+
     Params:
         primary (any): the first variable to check
         secondary (any): the second variable to check
@@ -35,30 +472,221 @@ def hierarchical_select(primary, secondary, type_to_coerce):
         the secondary value as an integer if it exists and is not null,
         0 if both values are None or NaN.
     """
-    try:
-        type_to_coerce(primary)
-        if pd.isna(primary):
-            pass
-        else:
-            return type_to_coerce(primary)
-    except TypeError:  # This is necessary to handle None types
-        pass
-    except ValueError:  # This is necessary to handle NaN float types.
-        pass
-    try:
-        type_to_coerce(secondary)
-        if pd.isna(secondary):
-            pass
-        else:
-            return type_to_coerce(secondary)
-    except TypeError:
-        pass
-    except ValueError:
-        pass
-    try:
-        return 0
-    finally:
-        pass
+    for value in (primary, secondary):
+        value = _coerce_value(value, type_to_coerce)
+        if value is not None:
+            return value
+    return 0
+
+
+# How to pick the row to keep when a key shows up more than once. Columns
+# are tried in order, and within a column earlier values win. Values that
+# aren't listed lose to the listed ones.
+DP_PRIORITY = {'SCENARIO': ['A', 'MDV'],
+               'DEV_STATUS': ['PRIMARY', 'DEVELOPMENT']}
+ARIES_PRIORITY = {'RSV_CAT': ['5PUD', '5PUDX', '6PROB', '7POSS']}
+
+
+def resolve_duplicates(frame, key, priority):
+    """
+    Collapses rows that share a key down to the one that ranks highest in
+    priority, so the join in combine_sources stays one to one. Ties go to
+    the row that came first. Rows with no key are left alone.
+
+    Args:
+        frame (pd.DataFrame): Dev Planning or Aries pull.
+        key: Column to de-duplicate on, ARIES_ID or ARIES_CODE.
+        priority: Dict of column to values in order of preference, like
+                  DP_PRIORITY. Columns that weren't pulled are skipped.
+
+    Returns:
+        Tuple of (deduplicated, report). report holds every row that shared
+        its key with another, sorted by key, with a KEPT column saying which
+        one survived.
+    """
+    keys = frame[key]
+    duplicated = (keys.duplicated(keep=False) & keys.notna()).to_numpy()
+    if not duplicated.any():
+        return frame, frame.iloc[:0].assign(KEPT=pd.Series(dtype=bool))
+
+    # One integer per row that orders rows the way priority does, so the
+    # winner of each key is a group-wise argmax.
+    score = np.zeros(len(frame), dtype='int64')
+    for column, order in priority.items():
+        if column not in frame.columns:
+            continue
+        rank = pd.Categorical(frame[column], categories=order).codes
+        rank = np.where(rank < 0, len(order), rank)
+        score = score * (len(order) + 1) + (len(order) - rank)
+
+    positions = np.flatnonzero(duplicated)
+    winners = (pd.Series(score[positions], index=positions)
+               .groupby(keys.to_numpy()[positions])
+               .idxmax()
+               .to_numpy())
+    keep = ~duplicated
+    keep[winners] = True
+
+    report = (frame.iloc[positions]
+              .assign(KEPT=keep[positions])
+              .sort_values(key, kind='stable'))
+    return frame.loc[keep], report
+
+
+# Columns kept for the wells only one side has.
+IN_DP_NOT_ARIES_COLUMNS = ['ARIES_CODE', 'ARIES_ID', 'WELL_NAME', 'LEASE',
+                           'RSV_CAT_DP', 'RSV_CAT_AR']
+IN_ARIES_NOT_DP_COLUMNS = ['ARIES_CODE', 'ARIES_ID', 'WELL_NAME', 'LEASE',
+                           'RSV_CAT_DP', 'RSV_CAT_AR', 'TD_DATE']
+
+
+def combine_sources(dev_planning, aries):
+    """
+    Lines Aries up with Dev Planning in a single outer join on
+    ARIES_CODE/ARIES_ID and splits the result by where each row came from.
+    Both sides must already have unique keys (see resolve_duplicates).
+    Dev Planning rows without an ARIES_ID go straight to in_dp_not_aries.
+
+    Args:
+        dev_planning (pd.DataFrame): The Dev Planning pull.
+        aries (pd.DataFrame): The Aries pull.
+
+    Returns:
+        Tuple of (combined_df, in_dp_not_aries, in_aries_not_dp).
+        combined_df holds the wells on both sides, Aries columns first, with
+        ARIES_CODE as a sorted index as well as a column. The other two hold
+        the IN_DP_NOT_ARIES_COLUMNS and IN_ARIES_NOT_DP_COLUMNS of the wells
+        only one side has.
+
+    Raises:
+        pd.errors.MergeError: A key shows up more than once on either side.
+    """
+    no_id = dev_planning['ARIES_ID'].isna()
+    joined = aries.merge(dev_planning.loc[~no_id],
+                         left_on='ARIES_CODE',
+                         right_on='ARIES_ID',
+                         how='outer',
+                         suffixes=['_AR', '_DP'],
+                         indicator=True,
+                         validate='one_to_one')
+    if no_id.any():
+        # Merged against no Aries rows, so they get the same columns as
+        # the rest of the right_only rows without being compared.
+        unmatched = aries.iloc[:0].merge(dev_planning.loc[no_id],
+                                         left_on='ARIES_CODE',
+                                         right_on='ARIES_ID',
+                                         how='right',
+                                         suffixes=['_AR', '_DP'],
+                                         indicator=True)
+        unmatched['_merge'] = 'right_only'
+        joined = pd.concat([joined, unmatched], ignore_index=True)
+    side = joined.pop('_merge')
+
+    in_dp_not_aries = joined.loc[side == 'right_only',
+                                 IN_DP_NOT_ARIES_COLUMNS]
+    in_aries_not_dp = joined.loc[side == 'left_only',
+                                 IN_ARIES_NOT_DP_COLUMNS]
+    combined_df = (joined.loc[side == 'both']
+                   .set_index('ARIES_CODE', drop=False)
+                   .rename_axis(None)
+                   .sort_index(kind='stable'))
+    return combined_df, in_dp_not_aries, in_aries_not_dp
+
+
+def split_business_units(frame, business_units=None):
+    """
+    Splits a pull covering several business units into one frame per
+    business unit. The rows are put in BUSINESS_UNIT order once and each
+    business unit is a slice of that, so they aren't copied again.
+
+    Args:
+        frame (pd.DataFrame): A pull with a BUSINESS_UNIT column.
+        business_units: Business units to return. Ones without rows get an
+                        empty frame. Defaults to every business unit in the
+                        frame.
+
+    Returns:
+        Dict of business unit: pd.DataFrame.
+    """
+    codes, units = pd.factorize(frame['BUSINESS_UNIT'], sort=True)
+    order = np.argsort(codes, kind='stable')
+    ordered = frame.take(order)
+    # Rows without a business unit have code -1 and sort before the rest.
+    bounds = np.searchsorted(codes[order], np.arange(len(units) + 1))
+    slices = {unit: ordered.iloc[bounds[i]:bounds[i + 1]]
+              for i, unit in enumerate(units)}
+
+    if business_units is None:
+        return slices
+    return {unit: slices.get(unit, ordered.iloc[:0])
+            for unit in business_units}
+
+
+def add_derived_columns(combined_df):
+    """
+    Adds the columns the checks compare that aren't pulled directly:
+    PSID_AR from USER3 or PRESPUDWELLID, PSID_DP renamed from PSID, the
+    target hole TP_LAT/TP_LONG, and a <column>_KEY from name_key for each
+    column a FIELD_CHECKS name check compares. Columns whose inputs weren't
+    pulled are skipped.
+
+    Args:
+        combined_df (pd.DataFrame): Merged Aries and Dev Planning data. It is
+                                    changed in place.
+
+    Returns:
+        combined_df, for chaining.
+    """
+    combined_df['PSID_AR'] = coalesce_columns(
+        [combined_df.USER3, combined_df.PRESPUDWELLID],
+        type_to_coerce=int).astype('float64')
+
+    combined_df.rename(columns={'PSID': 'PSID_DP'}, inplace=True)
+
+    # In South Texas we used the first waypoint values if they existed
+    # and if not we would use the Landing point.
+    # This may be different in different BUs
+    for derived, sources in [('TP_LAT', ['WAYPOINT1_LAT', 'LP_LAT']),
+                             ('TP_LONG', ['WAYPOINT1_LONG', 'LP_LONG'])]:
+        if all(source in combined_df.columns for source in sources):
+            combined_df[derived] = coalesce_columns(
+                [combined_df[source] for source in sources], float)
+
+    # Built once here so every name check, and any recompare_fields run on
+    # a slice of the frame, reuses them.
+    for col_dp, col_ar, kind, _ in FIELD_CHECKS.values():
+        if kind != 'name':
+            continue
+        for column in (col_dp, col_ar):
+            if column in combined_df.columns:
+                combined_df[f'{column}_KEY'] = name_key(combined_df[column])
+    return combined_df
+
+
+def name_key(values, abbreviations=NAME_ABBREVIATIONS):
+    """
+    Reduces names to a key that only differs when the names really do:
+    casefolded, punctuation turned into spaces, runs of spaces collapsed and
+    known words swapped for their abbreviation. 'Smith-Jones  Unit #1' and
+    'SMITH JONES UNT 1' get the same key.
+
+    Args:
+        values: Array-like of names.
+        abbreviations: Dict of casefolded word: abbreviation.
+
+    Returns:
+        pd.Series of strings, null where the name is null.
+    """
+    keys = (pd.Series(values).astype(STRING_DTYPE)
+            .str.casefold()
+            .str.replace(r'[\W_]+', ' ', regex=True)
+            .str.strip())
+    if abbreviations:
+        pattern = r'\b({})\b'.format('|'.join(
+            sorted(map(re.escape, abbreviations), key=len, reverse=True)))
+        keys = keys.str.replace(
+            pattern, lambda word: abbreviations[word.group(0)], regex=True)
+    return keys
 
 
 def match(devp,
@@ -101,6 +729,53 @@ def match(devp,
         return msg1
 
 
+def match_columns(devp,
+                  aries,
+                  msg1='MATCH',
+                  msg2='UPDATE ARIES',
+                  msg3='UPDATE ARIES',
+                  msg4='UPDATE DEVPLANNING',
+                  msg5='NOT ASSIGNED'):
+    """
+    Column-at-a-time version of match. Takes a full column of Dev Planning
+    values and a full column of Aries values and returns the match message
+    for every row using boolean masks instead of a Python loop.
+
+    Args:
+        devp: Array-like of values from the Dev Planning dataframe.
+        aries: Array-like of values from the Aries dataframe, the same length
+               as devp.
+        msg1: Message to output when the values from DP and Aries are equal
+        msg2: Message to output when dp and aries don't match but are the same
+              type and are not null.
+        msg3: Message to output when DP value is not null, but Aries value is
+              null.
+        msg4: Message to output when DP is null, but aries is not.
+        msg5: Message to output when both DP and Aries values are null.
+
+    Returns:
+        np.ndarray of objects holding the same message match would return for
+        each pair of values.
+    """
+    devp = np.asarray(devp, dtype=object)
+    aries = np.asarray(aries, dtype=object)
+    devp_null = np.asarray(pd.isna(devp), dtype=bool)
+    aries_null = np.asarray(pd.isna(aries), dtype=bool)
+
+    # Nulls are swapped for None so the element-wise comparison never sees
+    # NaN or pd.NA. Those rows are already decided by the null masks.
+    not_equal = np.asarray(np.where(devp_null, None, devp)
+                           != np.where(aries_null, None, aries),
+                           dtype=bool)
+
+    return np.select([devp_null & aries_null,
+                      devp_null,
+                      aries_null,
+                      not_equal],
+                     [msg5, msg4, msg3, msg2],
+                     default=msg1).astype(object)
+
+
 def compare_columns(col_dp,
                     col_ar,
                     dataframe,  # default value causes errors
@@ -131,28 +806,87 @@ def compare_columns(col_dp,
         were compared and the output Match column.
     """
     if col_ar == "LEASE":
-        tmp_df = dataframe[['ARIES_CODE', col_dp, col_ar]]
+        tmp_df = dataframe[['ARIES_CODE', col_dp, col_ar]].copy()
     else:
-        tmp_df = dataframe[['ARIES_CODE', 'LEASE', col_dp, col_ar]]
-    tmp_df['MATCH'] = 'initial'
+        tmp_df = dataframe[['ARIES_CODE', 'LEASE', col_dp, col_ar]].copy()
+    tmp_df['MATCH'] = match_columns(tmp_df[col_dp],
+                                    tmp_df[col_ar],
+                                    msg1=msg1,
+                                    msg2=msg2,
+                                    msg3=msg3,
+                                    msg4=msg4,
+                                    msg5=msg5)
     tmp_df.reset_index(inplace=True)
-    for index, row in tmp_df.iterrows():
-        tmp_df['MATCH'].iloc[index] = match(row[col_dp],
-                                            row[col_ar],
-                                            msg1=msg1,
-                                            msg2=msg2,
-                                            msg3=msg3,
-                                            msg4=msg4,
-                                            msg5=msg5)
-
-    tmp_df[[col_dp, col_ar, 'MATCH']]
     return tmp_df
 
 
+def match_numeric_columns(devp,
+                          aries,
+                          round_to=0,
+                          abs_tol=None,
+                          rel_tol=None):
+    """
+    Column-at-a-time numeric comparison used by compare_numeric_columns.
+    Works on NumPy float arrays so the DELTA and the match label for every
+    row come out of a single pass.
+
+    A value of 0 is treated the same as a null value on both sides.
+
+    Args:
+        devp: Array-like of numeric Dev Planning values.
+        aries: Array-like of numeric Aries values.
+        round_to: Number of decimals DELTA is rounded to, or None to leave it
+                  unrounded. When no tolerance is given the values match when
+                  the rounded DELTA is 0.
+        abs_tol: Largest absolute difference still considered a match.
+        rel_tol: Largest difference, relative to the larger of the two
+                 values, still considered a match.
+
+    Returns:
+        Tuple of (delta, labels) where delta is a float array of the rounded
+        differences and labels is an object array holding one of
+        'BOTH VALUES NULL', 'DP EMPTY', 'UPDATE ARIES' or 'MATCH'.
+    """
+    devp = pd.Series(devp).to_numpy(dtype='float64', na_value=np.nan)
+    aries = pd.Series(aries).to_numpy(dtype='float64', na_value=np.nan)
+
+    difference = devp - aries
+    if round_to is None:
+        delta = difference
+    else:
+        delta = np.round(difference, round_to)
+
+    if abs_tol is None and rel_tol is None:
+        different = np.abs(delta) > 0.0
+    else:
+        different = np.zeros(len(difference), dtype=bool)
+        if abs_tol is not None:
+            different |= np.abs(difference) > abs_tol
+        if rel_tol is not None:
+            scale = np.maximum(np.abs(devp), np.abs(aries))
+            different |= np.abs(difference) > rel_tol * scale
+
+    devp_empty = np.isnan(devp) | (devp == 0.)
+    aries_empty = np.isnan(aries) | (aries == 0.)
+
+    labels = np.select([devp_empty & aries_empty,
+                        devp_empty,
+                        aries_empty,
+                        different],
+                       ['BOTH VALUES NULL',
+                        'DP EMPTY',
+                        'UPDATE ARIES',
+                        'UPDATE ARIES'],
+                       default='MATCH').astype(object)
+    return delta, labels
+
+
 def compare_numeric_columns(col_dp: str,
                             col_ar: str,
                             dataframe: pd.DataFrame,
-                            round_to: int = 0):
+                            round_to: int = 0,
+                            abs_tol: float = None,
+                            rel_tol: float = None):
     """
     Compares two columns of numeric data.
 
@@ -162,102 +896,824 @@ def compare_numeric_columns(col_dp: str,
         dataframe: The name of the dataframe to compare.
         round_to: The precision to consider a match.
                   It will round to 10eround_to
+        abs_tol: Optional absolute tolerance. When given (or when rel_tol is
+                 given) it decides the match instead of round_to, which is
+                 then only used to round the DELTA column.
+        rel_tol: Optional tolerance relative to the larger of the two values.
 
     Returns:
         DataFrame containing the Aries Code, lease, DP column, Aries column,
         the difference between the two columns, and a column that shows if the
         values match or not.
     """
-    tmp_df = dataframe[['ARIES_CODE', 'LEASE', col_dp, col_ar]]
-    tmp_df['DELTA'] = 0
-    tmp_df['MATCH'] = 'initial'
+    tmp_df = dataframe[['ARIES_CODE', 'LEASE', col_dp, col_ar]].copy()
     tmp_df[col_dp] = pd.to_numeric(tmp_df[col_dp])
     tmp_df[col_ar] = pd.to_numeric(tmp_df[col_ar])
+    tmp_df['DELTA'], tmp_df['MATCH'] = match_numeric_columns(tmp_df[col_dp],
+                                                             tmp_df[col_ar],
+                                                             round_to=round_to,
+                                                             abs_tol=abs_tol,
+                                                             rel_tol=rel_tol)
     tmp_df.reset_index(inplace=True)
-    for index, row in tmp_df.iterrows():
-        tmp_df['DELTA'].iloc[index] = round(row[col_dp] - row[col_ar], round_to)
-        tmp_df['MATCH'].iloc[index] = ''
-        # Check for the condition where both aries and DP are blank
-        if ((pd.isna(tmp_df[col_dp].iloc[index])
-                or tmp_df[col_dp].iloc[index] == 0.)
-            and ((pd.isna(tmp_df[col_ar].iloc[index])
-                 or tmp_df[col_ar].iloc[index] == 0.))):
-            tmp_df['MATCH'].iloc[index] = 'BOTH VALUES NULL'
-        # Check for the condition where DP is null, but aries isn't
-        elif (pd.isna(tmp_df[col_dp].iloc[index]) \
-                or tmp_df[col_dp].iloc[index] == 0.):
-            tmp_df['MATCH'].iloc[index] = 'DP EMPTY'
-        # Check for the condition where Aries is null, but DP isn't
-        elif (pd.isna(tmp_df[col_ar].iloc[index])
-              or tmp_df[col_ar].iloc[index] == 0.):
-            tmp_df['MATCH'].iloc[index] = "UPDATE ARIES"
-        # Check for both Aries and DP being non-zero but non-equal
-        elif abs(tmp_df['DELTA'].iloc[index]) > 0.0:
-            tmp_df['MATCH'].iloc[index] = "UPDATE ARIES"
-        else:
-            tmp_df['MATCH'].iloc[index] = "MATCH"
     return tmp_df
 
 
+def haversine_distance(lat_1, long_1, lat_2, long_2,
+                       radius=EARTH_RADIUS_FT):
+    """
+    Great circle distance between two sets of points, worked out for every
+    row at once.
+
+    Args:
+        lat_1, long_1: Array-likes of the first points, in degrees.
+        lat_2, long_2: Array-likes of the second points, in degrees.
+        radius: Radius of the Earth in the units wanted back.
+                EARTH_RADIUS_FT gives feet, EARTH_RADIUS_M meters.
+
+    Returns:
+        Float array of distances, NaN where any coordinate is missing.
+    """
+    lat_1, long_1, lat_2, long_2 = (
+        np.radians(pd.Series(values).to_numpy(dtype='float64',
+                                              na_value=np.nan))
+        for values in (lat_1, long_1, lat_2, long_2))
+    half_chord = (np.sin((lat_2 - lat_1) / 2) ** 2
+                  + np.cos(lat_1) * np.cos(lat_2)
+                  * np.sin((long_2 - long_1) / 2) ** 2)
+    return 2 * radius * np.arcsin(np.sqrt(half_chord))
+
+
+def match_points(devp, aries, tolerance=POINT_TOLERANCE):
+    """
+    Compares (lat, long) locations by the distance between them instead of
+    one axis at a time.
+
+    A location is empty when either coordinate is null or 0, the same way
+    match_numeric_columns treats a single value.
+
+    Args:
+        devp: (lat, long) pair of array-likes of Dev Planning coordinates.
+        aries: (lat, long) pair of array-likes of Aries coordinates.
+        tolerance: Furthest apart, in feet, the locations can be and still
+                   match.
+
+    Returns:
+        Tuple of (distance, labels) where distance is a float array of feet
+        and labels is an object array holding one of 'BOTH VALUES NULL',
+        'DP EMPTY', 'UPDATE ARIES' or 'MATCH'.
+    """
+    devp = [pd.Series(values).to_numpy(dtype='float64', na_value=np.nan)
+            for values in devp]
+    aries = [pd.Series(values).to_numpy(dtype='float64', na_value=np.nan)
+             for values in aries]
+    distance = haversine_distance(devp[0], devp[1], aries[0], aries[1])
+
+    devp_empty = np.zeros(len(distance), dtype=bool)
+    aries_empty = np.zeros(len(distance), dtype=bool)
+    for coordinate in devp:
+        devp_empty |= np.isnan(coordinate) | (coordinate == 0.)
+    for coordinate in aries:
+        aries_empty |= np.isnan(coordinate) | (coordinate == 0.)
+
+    labels = np.select([devp_empty & aries_empty,
+                        devp_empty,
+                        aries_empty,
+                        distance > tolerance],
+                       ['BOTH VALUES NULL',
+                        'DP EMPTY',
+                        'UPDATE ARIES',
+                        'UPDATE ARIES'],
+                       default='MATCH').astype(object)
+    return distance, labels
+
+
+def _name_keys(dataframe, column):
+    """
+    Returns the name_key of a column, from the <column>_KEY that
+    add_derived_columns saved if there is one.
+    """
+    if f'{column}_KEY' in dataframe.columns:
+        return dataframe[f'{column}_KEY'].reset_index(drop=True)
+    return name_key(dataframe[column]).reset_index(drop=True)
+
+
+def _numeric_tolerance(field, tolerance):
+    """
+    Turns the tolerance of a numeric FIELD_CHECKS spec into the abs_tol and
+    rel_tol arguments of match_numeric_columns.
+    """
+    if tolerance is None:
+        return {}
+    if not isinstance(tolerance, tuple):
+        return {'abs_tol': tolerance}
+    kind, value = tolerance
+    if kind not in ('abs', 'rel'):
+        raise ValueError(f"Unknown kind of tolerance '{kind}' for {field}")
+    return {f'{kind}_tol': value}
+
+
+def _compare_field(dataframe, field, col_dp, col_ar, kind, tolerance):
+    """
+    Runs one compare_fields check.
+
+    Returns:
+        Tuple of (delta, labels) arrays, one entry per row of dataframe.
+    """
+    if kind == 'numeric':
+        return match_numeric_columns(pd.to_numeric(dataframe[col_dp]),
+                                     pd.to_numeric(dataframe[col_ar]),
+                                     round_to=None,
+                                     **_numeric_tolerance(field, tolerance))
+    if kind == 'point':
+        return match_points(
+            [pd.to_numeric(dataframe[column]) for column in col_dp],
+            [pd.to_numeric(dataframe[column]) for column in col_ar],
+            tolerance)
+    if kind == 'text':
+        labels = match_columns(dataframe[col_dp], dataframe[col_ar])
+        return np.full(len(dataframe), np.nan), labels
+    if kind == 'name':
+        labels = match_columns(dataframe[col_dp], dataframe[col_ar])
+        same_key = _name_keys(dataframe, col_dp) == _name_keys(dataframe,
+                                                               col_ar)
+        labels[(labels == 'UPDATE ARIES')
+               & same_key.fillna(False).to_numpy(dtype=bool)] = (
+            'COSMETIC ONLY')
+        return np.full(len(dataframe), np.nan), labels
+    raise ValueError(f"Unknown kind of check '{kind}' for {field}")
+
+
+def compare_fields(specs, dataframe):
+    """
+    Runs several field checks against one shared dataframe and collects every
+    row that didn't come back as a MATCH into one long-format result.
+
+    Nothing is copied per field, so memory grows with the number of
+    mismatches rather than with fields times rows. Use field_view to get the
+    old one-frame-per-check layout back for a single field.
+
+    Args:
+        specs: Either a dict of name: (DP column, Aries column, kind,
+               tolerance) like FIELD_CHECKS, or a list of those tuples in
+               which case the Aries column is used as the name.
+        dataframe (pd.DataFrame): Combined Aries and Dev Planning data.
+
+    Returns:
+        pd.DataFrame with columns ARIES_CODE, FIELD, STATUS and DELTA, indexed
+        by the position of the row in dataframe. FIELD and STATUS are
+        categoricals. DELTA is the distance in feet for point fields and NaN
+        for text fields. The specs used are kept in the result's attrs.
+    """
+    if not isinstance(specs, dict):
+        specs = {spec[1]: tuple(spec) for spec in specs}
+
+    keys = dataframe['ARIES_CODE'].to_numpy()
+    positions = np.arange(len(dataframe))
+    pieces = []
+    for field, (col_dp, col_ar, kind, tolerance) in specs.items():
+        with trace_stage(f'check {field}', len(dataframe)) as record:
+            delta, labels = _compare_field(dataframe, field, col_dp, col_ar,
+                                           kind, tolerance)
+            mismatched = labels != 'MATCH'
+            record['rows_out'] = int(mismatched.sum())
+            pieces.append(pd.DataFrame({'ARIES_CODE': keys[mismatched],
+                                        'FIELD': field,
+                                        'STATUS': labels[mismatched],
+                                        'DELTA': delta[mismatched]},
+                                       index=positions[mismatched]))
+
+    if pieces:
+        results = pd.concat(pieces)
+    else:
+        results = pd.DataFrame({'ARIES_CODE': [], 'FIELD': [],
+                                'STATUS': [], 'DELTA': []})
+    results['FIELD'] = pd.Categorical(results['FIELD'], categories=list(specs))
+    results['STATUS'] = pd.Categorical(results['STATUS'],
+                                       categories=STATUS_LABELS)
+    results.attrs['specs'] = specs
+    return results
+
+
+def recompare_fields(results, dataframe, codes):
+    """
+    Brings an earlier compare_fields result up to date after only some Aries
+    codes changed. Those codes are compared again and every other code keeps
+    its earlier result, moved to the code's row in the new dataframe.
+
+    Args:
+        results (pd.DataFrame): Earlier output of compare_fields.
+        dataframe (pd.DataFrame): The new combined Aries and Dev Planning
+                                  data.
+        codes: Aries codes whose Dev Planning or Aries row changed.
+
+    Returns:
+        pd.DataFrame laid out like compare_fields, equal to running
+        compare_fields with the same specs on the new dataframe.
+    """
+    specs = results.attrs['specs']
+    keys = dataframe['ARIES_CODE']
+
+    # A code on more than one row can't be matched to its earlier rows by
+    # code alone, so it's always compared again.
+    redo = keys.isin(codes) | keys.duplicated(keep=False)
+    redo_positions = np.flatnonzero(redo.to_numpy())
+    fresh = compare_fields(specs, dataframe.iloc[redo_positions])
+    fresh.index = redo_positions[fresh.index.to_numpy()]
+
+    kept_positions = np.flatnonzero(~redo.to_numpy())
+    position = pd.Series(kept_positions,
+                         index=keys.to_numpy()[kept_positions])
+    kept = results.loc[results['ARIES_CODE'].isin(position.index)]
+    kept.index = position[kept['ARIES_CODE']].to_numpy()
+
+    # Same order as compare_fields: field by field, then by row.
+    updated = pd.concat([kept, fresh])
+    updated = updated.iloc[np.lexsort((updated.index.to_numpy(),
+                                       updated['FIELD'].cat.codes))]
+    updated.attrs['specs'] = specs
+    return updated
+
+
+def field_view(results, dataframe, fields):
+    """
+    Builds the per-check frame for one or more fields out of the long-format
+    results returned by compare_fields.
+
+    Args:
+        results (pd.DataFrame): Output of compare_fields.
+        dataframe (pd.DataFrame): The dataframe compare_fields was run on.
+        fields: A field name, or a list of field names to put side by side.
+
+    Returns:
+        pd.DataFrame with the Aries Code, lease, and the compared columns. A
+        single field gets a MATCH column (and DELTA for numeric fields) just
+        like compare_columns and compare_numeric_columns, and point fields
+        get the distance in feet as DELTA. With a list of fields each gets
+        its own MATCH_<field> and DELTA_<field> columns.
+    """
+    single = isinstance(fields, str)
+    if single:
+        fields = [fields]
+
+    specs = results.attrs['specs']
+    columns = ['ARIES_CODE', 'LEASE']
+    for field in fields:
+        col_dp, col_ar = specs[field][:2]
+        columns += [col for col
+                    in _spec_columns(col_dp) + _spec_columns(col_ar)
+                    if col not in columns]
+    view = dataframe[columns].copy()
+
+    for field in fields:
+        col_dp, col_ar, kind = specs[field][:3]
+        suffix = '' if single else f'_{field}'
+        if kind == 'numeric':
+            view[col_dp] = pd.to_numeric(view[col_dp])
+            view[col_ar] = pd.to_numeric(view[col_ar])
+            view['DELTA' + suffix] = view[col_dp] - view[col_ar]
+        elif kind == 'point':
+            for column in col_dp + col_ar:
+                view[column] = pd.to_numeric(view[column])
+            view['DELTA' + suffix] = haversine_distance(
+                view[col_dp[0]], view[col_dp[1]],
+                view[col_ar[0]], view[col_ar[1]])
+        field_rows = results.loc[results['FIELD'] == field]
+        status = np.full(len(view), 'MATCH', dtype=object)
+        status[field_rows.index.to_numpy()] = field_rows['STATUS'].astype(object)
+        view['MATCH' + suffix] = status
+    return view
+
+
 def update_table(table_to_update,
                  check_table,
                  engine,
                  devplanning_column,
                  aries_column,
                  dtype_dict,
-                 extra_condition=""):
+                 extra_condition="",
+                 chunksize=10000):
+    """
+    Pushes one Dev Planning column into Aries for every row of check_table
+    marked 'UPDATE ARIES'.
+
+    Only the Aries Code and new value of those rows are uploaded to
+    #check_table. Create the engine with fast_executemany=True so the upload
+    is sent in bulk. The SQL is written for the engine's dialect, see
+    UPDATE_DIALECTS.
+
+    Args:
+        table_to_update: 'ac_property_base' or the Aries table to update.
+        check_table: Frame with ARIES_CODE, devplanning_column and MATCH.
+        engine: SQLAlchemy engine for Working District, or a connection
+                that already has a transaction open. An engine gets its own
+                connection and transaction that commits when the update is
+                done.
+        devplanning_column: Column of check_table holding the new values.
+        aries_column: Column in table_to_update to overwrite.
+        dtype_dict: SQL types for ARIES_CODE and devplanning_column.
+        extra_condition: Extra SQL appended to the WHERE clause, starting
+                         with AND.
+        chunksize: Number of rows sent per insert batch.
+
+    Returns:
+        Tuple of (rows updated, server-side execution time of the UPDATE in
+        milliseconds). Databases other than SQL Server report the time
+        measured by the client.
+    """
+    actionable = _actionable_rows(
+        check_table, devplanning_column).drop_duplicates('ARIES_CODE')
+    if actionable.empty:
+        return 0, 0
+
+    with trace_stage(f'update {table_to_update}.{aries_column}',
+                     len(actionable), bytes=frame_bytes(actionable)) as record:
+        with _transaction(engine) as connection:
+            sql_string = _update_sql(
+                table_to_update,
+                [(aries_column, f'ct.{devplanning_column}')],
+                f'1 = 1 {extra_condition}', connection.dialect.name)
+            _stage_table(connection, actionable, dtype_dict, chunksize)
+            rows_updated, elapsed_ms = _execute_timed(connection, sql_string)
+        record.update(rows_out=rows_updated, server_ms=elapsed_ms)
+    return rows_updated, elapsed_ms
+
+
+@contextlib.contextmanager
+def _transaction(engine):
+    """
+    Yields a connection to run updates on. A connection passed in is used
+    as-is so the caller's transaction covers the work. An engine gets a new
+    connection inside a transaction that commits on success and rolls back
+    on any error.
+    """
+    if isinstance(engine, sqlalchemy.engine.Connection):
+        yield engine
+    else:
+        with engine.begin() as connection:
+            yield connection
+
+
+@contextlib.contextmanager
+def _savepoint(connection, enabled):
+    """
+    Runs the block inside a savepoint when enabled, so a failure only rolls
+    back that block. Errors are still raised to the caller.
+    """
+    if not enabled:
+        yield
+        return
+    savepoint = connection.begin_nested()
+    try:
+        yield
+    except Exception:
+        savepoint.rollback()
+        raise
+    savepoint.commit()
+
+
+def _stage_table(connection, staged, dtype_dict, chunksize):
+    """
+    Creates #check_table with the exact column types in dtype_dict and a
+    clustered primary key on ARIES_CODE, then bulk inserts staged into it.
+    This lets the UPDATE joins seek on ARIES_CODE instead of scanning a heap.
+    On SQLite the staging table is a TEMP table called check_table.
+
+    Args:
+        connection: Open SQLAlchemy connection. Temp tables only live as long
+                    as the connection that made them.
+        staged (pd.DataFrame): Rows to upload, with unique ARIES_CODEs.
+        dtype_dict: SQLAlchemy type for every column in staged.
+        chunksize: Number of rows sent per insert batch.
+    """
+    column_definitions = []
+    for column in staged.columns:
+        sql_type = dtype_dict[column].compile(dialect=connection.dialect)
+        if column == 'ARIES_CODE':
+            column_definitions.append(f"[{column}] {sql_type} NOT NULL")
+        else:
+            column_definitions.append(f"[{column}] {sql_type} NULL")
+
+    dialect = _update_dialect(connection.dialect.name)
+    connection.execute(sqlalchemy.text(dialect['drop_staging']))
+    connection.execute(sqlalchemy.text(dialect['create_staging'].format(
+        columns=', '.join(column_definitions))))
+
+    staged.to_sql(dialect['staging'], connection, if_exists='append',
+                  index=False, chunksize=chunksize)
+
+
+def _execute_timed(connection, sql_string):
+    """
+    Runs an UPDATE and reports how long it took on the server, so the cost
+    of the join can be told apart from network and upload time. Only SQL
+    Server can time the statement itself. Elsewhere the time is taken around
+    the call, which for SQLite is the same thing.
+
+    Returns:
+        Tuple of (rows updated, server-side elapsed milliseconds).
+    """
+    if connection.dialect.name != 'mssql':
+        started = time.perf_counter()
+        rows_updated = connection.execute(sqlalchemy.text(sql_string)).rowcount
+        return rows_updated, round((time.perf_counter() - started) * 1000)
+
+    timed_sql = (r"""
+                 SET NOCOUNT ON;
+                 DECLARE @started DATETIME2 = SYSDATETIME();
+                 {sql_string}
+                 SELECT
+                     @@ROWCOUNT AS ROWS_UPDATED,
+                     DATEDIFF(MILLISECOND, @started, SYSDATETIME())
+                         AS ELAPSED_MS;
+                 """.format(sql_string=sql_string.strip()))
+    rows_updated, elapsed_ms = connection.execute(
+        sqlalchemy.text(timed_sql)).fetchone()
+    return rows_updated, elapsed_ms
+
+
+def _actionable_rows(check_table, devplanning_column):
+    """
+    Keeps only the key and new value of the rows in a check table that need
+    to be pushed to Aries.
+    """
+    return check_table.loc[check_table['MATCH'] == 'UPDATE ARIES',
+                           ['ARIES_CODE', devplanning_column]]
+
+
+def _stage_changes(changes):
+    """
+    Lines up several column changes for the same table into one staging
+    frame keyed on ARIES_CODE. Only rows that need to be pushed are kept and
+    each Aries column gets a VAL_ column that is null wherever that column
+    should be left alone.
+
+    Args:
+        changes: List of (check_table, devplanning_column, aries_column,
+                 dtype_dict) tuples.
+
+    Returns:
+        Tuple of (staging frame, dtype dict for the staging frame).
+    """
+    staged = None
+    staged_dtypes = {'ARIES_CODE': sqlalchemy.VARCHAR(255)}
+    for check_table, devplanning_column, aries_column, dtype_dict in changes:
+        column = _actionable_rows(check_table, devplanning_column).rename(
+            columns={devplanning_column: f'VAL_{aries_column}'})
+        column = column.drop_duplicates('ARIES_CODE')
+
+        if staged is None:
+            staged = column
+        else:
+            staged = staged.merge(column, on='ARIES_CODE', how='outer')
+        staged_dtypes[f'VAL_{aries_column}'] = dtype_dict[devplanning_column]
+
+    return staged, staged_dtypes
+
+
+def _update_dialect(name):
+    """
+    Returns the UPDATE_DIALECTS entry for a SQLAlchemy dialect name.
+    """
+    try:
+        return UPDATE_DIALECTS[name]
+    except KeyError:
+        raise ValueError(f"Can't write Aries updates for {name}. Use one "
+                         f"of {', '.join(UPDATE_DIALECTS)}.") from None
+
 
-    connection = engine.connect()
+def _update_sql(table_to_update, assignments, where_clause, dialect):
+    """
+    Writes an UPDATE of one Aries table from the staged check table.
+    ac_property_base is joined to the staged rows on ARIES_CODE and to
+    AC_USER as U. Any other table is reached through ac_property_base on
+    PROPNUM.
 
-    check_table.to_sql('#check_table', connection, if_exists='replace',
-                       dtype=dtype_dict)
+    Args:
+        table_to_update: Name of the Aries table to update.
+        assignments: List of (aries_column, SQL expression) pairs to set.
+                     The expressions can use ct for the staged row and M or
+                     ttu for the row being updated.
+        where_clause: SQL picking the rows to update.
+        dialect: SQLAlchemy dialect name, a key of UPDATE_DIALECTS.
 
-    # Check to see if we're using the only table with an Aries Code.
-    if table_to_update.lower() == 'ac_property_base':
+    Returns:
+        The statement as a string.
+    """
+    spec = _update_dialect(dialect)
+    base_table = table_to_update.lower() == 'ac_property_base'
+    target = 'M' if base_table else 'ttu'
+    if dialect == 'mssql':
+        set_clauses = [f'{target}.{column} = {expression}'
+                       for column, expression in assignments]
+    else:
+        # SQLite won't take a table name on the left of SET.
+        set_clauses = [f'{column} = {expression}'
+                       for column, expression in assignments]
 
-        # This will setup the query to join only the Master table and the
-        # temporary table that we uploaded.
-        sql_string = (r"""
+    if dialect == 'mssql' and base_table:
+        template = r"""
                       UPDATE
                           M
                       SET
-                          M.{aries_column} = ct.{devplanning_column}
+                          {set_clauses}
                       FROM
-                          [WORKING_DISTRICT].[AriesAdmin].[AC_PROPERTY_BASE] M
-                          INNER JOIN [#check_table] ct
+                          {property_base} M
+                          INNER JOIN [{staging}] ct
                           ON ct.ARIES_CODE = M.ARIES_CODE
-                          INNER JOIN [WORKING_DISTRICT].[AriesAdmin].[AC_USER]
-                          U ON U.PROPNUM = M.PROPNUM
+                          INNER JOIN {user} U ON U.PROPNUM = M.PROPNUM
                       WHERE
-                          ct.MATCH = 'UPDATE ARIES' {extra_condition}
-                      ;""".format(aries_column=aries_column,
-                                  devplanning_column=devplanning_column,
-                                  extra_condition=extra_condition))
-
-    else:
-        # In order for queries to work as they are setup, we need to join in
-        # the master table so we can connect with an Aries Code.
-        sql_string = (r"""
+                          {where_clause}
+                      ;"""
+    elif dialect == 'mssql':
+        template = r"""
                       UPDATE
                           ttu
                       SET
-                          ttu.{aries_column} = ct.{devplanning_column}
+                          {set_clauses}
                       FROM
-                          ([WORKING_DISTRICT].[AriesAdmin].[AC_PROPERTY_BASE] M
-                           INNER JOIN [Working_District].[AriesAdmin].
-                           [{table_to_update}] ttu ON M.PROPNUM = ttu.PROPNUM)
-                          INNER JOIN [#check_table] ct
+                          ({property_base} M
+                           INNER JOIN {table} ttu ON M.PROPNUM = ttu.PROPNUM)
+                          INNER JOIN [{staging}] ct
                           ON ct.ARIES_CODE = M.ARIES_CODE
-                     WHERE ct.MATCH = 'UPDATE ARIES' {extra_condition}
-                      ;""".format(table_to_update=table_to_update,
-                                  aries_column=aries_column,
-                                  devplanning_column=devplanning_column,
-                                  extra_condition=extra_condition))
+                      WHERE
+                          {where_clause}
+                      ;"""
+    elif base_table:
+        # The table being updated can't appear in SQLite's FROM list, so
+        # it is joined in the WHERE clause.
+        template = r"""
+                      UPDATE
+                          {property_base} AS M
+                      SET
+                          {set_clauses}
+                      FROM
+                          {staging} AS ct,
+                          {user} AS U
+                      WHERE
+                          ct.ARIES_CODE = M.ARIES_CODE
+                          AND U.PROPNUM = M.PROPNUM
+                          AND ({where_clause})
+                      ;"""
+    else:
+        template = r"""
+                      UPDATE
+                          {table} AS ttu
+                      SET
+                          {set_clauses}
+                      FROM
+                          {property_base} AS M
+                          INNER JOIN {staging} AS ct
+                          ON ct.ARIES_CODE = M.ARIES_CODE
+                      WHERE
+                          M.PROPNUM = ttu.PROPNUM
+                          AND ({where_clause})
+                      ;"""
+
+    return template.format(
+        set_clauses=',\n'.join(set_clauses),
+        property_base=spec['table'].format(table='AC_PROPERTY_BASE'),
+        user=spec['table'].format(table='AC_USER'),
+        table=spec['table'].format(table=table_to_update),
+        staging=spec['staging'],
+        where_clause=where_clause)
+
+
+def _batch_update_sql(table_to_update, columns, dialect='mssql'):
+    """
+    Writes the UPDATE statement update_tables runs for one table.
+
+    Args:
+        table_to_update: Name of the Aries table to update.
+        columns: List of (aries_column, extra_condition) tuples. The staging
+                 table holds a VAL_<aries_column> for each of them.
+        dialect: SQLAlchemy dialect name of the database, a key of
+                 UPDATE_DIALECTS.
+
+    Returns:
+        The SQL statement as a string.
+    """
+    target = 'M' if table_to_update.lower() == 'ac_property_base' else 'ttu'
+
+    assignments = []
+    where_clauses = []
+    for aries_column, extra_condition in columns:
+        condition = (f"ct.VAL_{aries_column} IS NOT NULL "
+                     f"{extra_condition}").strip()
+        assignments.append(
+            (aries_column,
+             f"CASE WHEN {condition} THEN ct.VAL_{aries_column} "
+             f"ELSE {target}.{aries_column} END"))
+        where_clauses.append(f"({condition})")
+
+    return _update_sql(table_to_update, assignments,
+                       ' OR '.join(where_clauses), dialect)
+
+
+def update_columns(changes, engine, chunksize=10000, savepoints=False):
+    """
+    Runs update_table for each column in changes on one connection and in
+    one transaction, so the push either fully commits or fully rolls back.
+
+    Args:
+        changes: List of (table_to_update, check_table, devplanning_column,
+                 aries_column, dtype_dict, extra_condition) tuples.
+        engine: SQLAlchemy engine for Working District, or a connection
+                with a transaction already open.
+        chunksize: Number of staged rows sent per insert batch.
+        savepoints: When True each column runs in its own savepoint. A
+                    column that fails is rolled back on its own and the rest
+                    of the push carries on.
+
+    Returns:
+        Dict of table.column: (rows updated, server-side milliseconds), or
+        the exception raised for a column that was rolled back.
+    """
+    timings = {}
+    with _transaction(engine) as connection:
+        for (table_to_update, check_table, devplanning_column, aries_column,
+             dtype_dict, extra_condition) in changes:
+            name = f'{table_to_update}.{aries_column}'
+            try:
+                with _savepoint(connection, savepoints):
+                    timings[name] = update_table(table_to_update,
+                                                 check_table,
+                                                 connection,
+                                                 devplanning_column,
+                                                 aries_column,
+                                                 dtype_dict,
+                                                 extra_condition,
+                                                 chunksize=chunksize)
+            except Exception as e:
+                if not savepoints:
+                    raise
+                timings[name] = e
+    return timings
+
+
+def update_tables(changes, engine, chunksize=10000, savepoints=False):
+    """
+    Batched version of update_table. Stages every pending column change for
+    a table in a single upload and applies them with one UPDATE per table,
+    using a CASE on each column so only the staged values change. Every
+    table is updated on one connection and in one transaction.
+
+    Args:
+        changes: List of (table_to_update, check_table, devplanning_column,
+                 aries_column, dtype_dict, extra_condition) tuples, the same
+                 arguments update_table takes for a single column.
+        engine: SQLAlchemy engine for Working District, or a connection
+                with a transaction already open. Create the engine with
+                fast_executemany=True so the staging upload is sent in bulk.
+        chunksize: Number of staged rows sent per insert batch.
+        savepoints: When True each table's UPDATE runs in its own savepoint
+                    and a table that fails is rolled back on its own.
+
+    Returns:
+        Dict of table name: (rows updated, server-side execution time of the
+        UPDATE in milliseconds), or the exception raised for a table that
+        was rolled back.
+    """
+    tables = {}
+    for (table_to_update, check_table, devplanning_column, aries_column,
+         dtype_dict, extra_condition) in changes:
+        tables.setdefault(table_to_update.lower(), []).append(
+            (check_table, devplanning_column, aries_column, dtype_dict,
+             extra_condition))
+
+    timings = {}
+    with _transaction(engine) as connection:
+        for table_to_update, table_changes in tables.items():
+            staged, staged_dtypes = _stage_changes(
+                [change[:4] for change in table_changes])
+            if staged.empty:
+                timings[table_to_update] = (0, 0)
+                continue
 
-    connection.execute(sqlalchemy.text(sql_string))
+            sql_string = _batch_update_sql(
+                table_to_update,
+                [(change[2], change[4]) for change in table_changes],
+                connection.dialect.name)
+            try:
+                with _savepoint(connection, savepoints), trace_stage(
+                        f'update {table_to_update}', len(staged),
+                        bytes=frame_bytes(staged)) as record:
+                    _stage_table(connection, staged, staged_dtypes, chunksize)
+                    timings[table_to_update] = _execute_timed(connection,
+                                                              sql_string)
+                    record['rows_out'], record['server_ms'] = (
+                        timings[table_to_update])
+            except Exception as e:
+                if not savepoints:
+                    raise
+                timings[table_to_update] = e
+    return timings
 
-    # connection.commit()
-    connection.close()
+
+def aries_changes(results, dataframe, fields, business_unit):
+    """
+    Lists what update_tables or update_columns should push for a set of
+    checks. Fields with no entry in ARIES_UPDATES are skipped, and point
+    fields push their lat and long columns as two changes.
+
+    Args:
+        results (pd.DataFrame): Output of compare_fields.
+        dataframe (pd.DataFrame): The combined_df the results came from.
+        fields: FIELD_CHECKS names to push.
+        business_unit: Business unit being pushed. South Texas keeps PSID
+                       in USER3 to avoid unwanted syncing between Aries and
+                       GPlat.
+
+    Returns:
+        List of (table_to_update, check_table, devplanning_column,
+        aries_column, dtype_dict, extra_condition) tuples.
+    """
+    changes = []
+    for field, (table_to_update, aries_column, sql_type,
+                extra_condition) in ARIES_UPDATES.items():
+        if field not in fields:
+            continue
+
+        if field == 'PSID' and business_unit.upper() == 'SOUTH TEXAS':
+            aries_column = 'USER3'
+
+        check_table = field_view(results, dataframe, field)
+        for devplanning_column, column in zip(
+                _spec_columns(FIELD_CHECKS[field][0]),
+                _spec_columns(aries_column)):
+            changes.append((table_to_update,
+                            check_table,
+                            devplanning_column,
+                            column,
+                            {
+                                'ARIES_CODE': sqlalchemy.VARCHAR(255),
+                                devplanning_column: sql_type
+                                },
+                            extra_condition))
+    return changes
+
+
+def pending_updates(results):
+    """
+    Counts the rows the last checks say Aries should be updated for, only
+    counting fields update_aries can push.
+    """
+    pushable = results.FIELD.isin(list(ARIES_UPDATES))
+    return int(((results.STATUS == 'UPDATE ARIES') & pushable).sum())
+
+
+def write_backup_workbook(path, dev_planning, aries):
+    """
+    Saves both pulls to one workbook before anything is pushed.
+    """
+    with trace_stage(f'write {os.path.basename(path)}',
+                     len(dev_planning) + len(aries)) as record:
+        with pd.ExcelWriter(path) as writer:
+            dev_planning.to_excel(writer, sheet_name='DevPlanning_backup')
+            aries.to_excel(writer, sheet_name='Aries_Backup')
+        record['bytes'] = os.path.getsize(path)
+
+
+def write_check_workbook(path, results, combined_df, in_aries_not_dp,
+                         in_dp_not_aries, dp_duplicates=None,
+                         aries_duplicates=None, flag_updates=False):
+    """
+    Writes the orphan lists, the duplicate keys and a tab per field check to
+    one workbook. Used for both changes.xlsx and post_update.xlsx.
+
+    Args:
+        path: File to write.
+        results (pd.DataFrame): Output of compare_fields.
+        combined_df (pd.DataFrame): The frame the results came from.
+        in_aries_not_dp, in_dp_not_aries: Orphan lists from
+                                          combine_sources.
+        dp_duplicates, aries_duplicates: Reports from resolve_duplicates.
+                                         Only written when they have rows.
+        flag_updates: Colour the tabs that still have values to push, for
+                      the post update QC.
+    """
+    with trace_stage(f'write {os.path.basename(path)}',
+                     len(combined_df)) as record:
+        with pd.ExcelWriter(path) as writer:
+            in_aries_not_dp.to_excel(writer, sheet_name='in_aries_not_dp')
+            in_dp_not_aries.to_excel(writer, sheet_name='in_dp_not_aries')
+            if dp_duplicates is not None and len(dp_duplicates):
+                dp_duplicates.to_excel(writer, sheet_name='dp_duplicates')
+            if aries_duplicates is not None and len(aries_duplicates):
+                aries_duplicates.to_excel(writer,
+                                          sheet_name='aries_duplicates')
+            for field in results.FIELD.cat.categories:
+                field_view(results, combined_df, field).to_excel(
+                    writer, sheet_name=field)
+                if not flag_updates:
+                    continue
+                if ((results.FIELD == field)
+                        & (results.STATUS == 'UPDATE ARIES')).any():
+                    sheet = writer.sheets[field]
+                    if hasattr(sheet, 'set_tab_color'):  # xlsxwriter
+                        sheet.set_tab_color('gold')
+                    else:  # openpyxl
+                        sheet.sheet_properties.tabColor = 'FFD700'
+        record['bytes'] = os.path.getsize(path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+A SQLite stand-in for Dev Planning and Aries, so the pulls, checks and
+updates can be run and load tested without Snowflake or Working District.
+
+seed_sqlite writes a database with the tables the sync touches:
+DEV_PLANNING, AC_PROPERTY_BASE, AC_BUDGET_BASE and AC_USER, and the
+AC_PROPERTY and AC_BUDGET views the pulls read. sqlite_backend points
+the loaders and get_aries_engine at it:
+
+    from devplanning_syn_GUI_functions import use_backend
+    from devplanning_sync_sqlite import seed_sqlite, sqlite_backend
+
+    seed_sqlite('sync.db', dev_planning, aries)
+    previous = use_backend(sqlite_backend('sync.db'))
+    ...
+    use_backend(previous)
+
+The updates are written for SQLite by the compiler in
+devplanning_sync_functions (see UPDATE_DIALECTS), so the whole pull, check
+and update round trip runs against the file.
+"""
+import functools
+import os
+import sqlite3
+
+import pandas as pd
+
+from devplanning_syn_GUI_functions import ARIES_COLUMNS
+
+# AC_USER.TEXT16 of the seeded cases. The LATERAL_LEN update skips
+# 'RESERVES CASE', and a NULL would make it skip every row.
+DEFAULT_TEXT16 = 'PLANNING'
+
+# Indexes the seeded tables get, as (table, columns, unique).
+SQLITE_INDEXES = [('AC_PROPERTY_BASE', ['PROPNUM'], True),
+                  ('AC_PROPERTY_BASE', ['ARIES_CODE'], False),
+                  ('AC_PROPERTY_BASE', ['BUSINESS_UNIT', 'RSV_CAT'], False),
+                  ('AC_BUDGET_BASE', ['PROPNUM'], True),
+                  ('AC_USER', ['PROPNUM'], True),
+                  ('DEV_PLANNING', ['BUSINESS_UNIT'], False),
+                  ('DEV_PLANNING', ['ARIES_ID'], False)]
+
+
+def _aries_table_columns(prefix):
+    """
+    Returns the columns of ARIES_COLUMNS that come from the table with the
+    given alias, e.g. 'M' for AC_PROPERTY.
+    """
+    return [column.split('.', 1)[1] for column in ARIES_COLUMNS
+            if column.startswith(prefix + '.')]
+
+
+def sqlite_backend(path):
+    """
+    Returns a backend for use_backend that pulls from and updates a
+    database written by seed_sqlite.
+
+    SQLite takes at most 32766 parameters in one statement, so a semi_join
+    pull from Aries first can't be run for more Aries codes than that.
+
+    Args:
+        path: The SQLite file.
+
+    Returns:
+        Backend dict, see PRODUCTION in devplanning_syn_GUI_functions. Its
+        snapshots are kept in a folder next to the file.
+    """
+    path = os.path.abspath(path)
+    connect = functools.partial(sqlite3.connect, path)
+    return {'name': f'sqlite {path}',
+            'connect_dev_planning': connect,
+            'connect_aries': connect,
+            'aries_url': f'sqlite:///{path}',
+            'engine_options': {},
+            'tables': {'dev_planning': 'DEV_PLANNING',
+                       'ac_property': 'AC_PROPERTY',
+                       'ac_budget': 'AC_BUDGET'},
+            'keys_table': 'temp.sync_keys',
+            'cache_dir': os.path.splitext(path)[0] + '_snapshots'}
+
+
+def seed_sqlite(path, dev_planning, aries, text16=DEFAULT_TEXT16):
+    """
+    Writes a Dev Planning pull and an Aries pull, e.g. from
+    benchmark_devplanning_sync.generate_sources, to a SQLite file laid out
+    like the real databases. Any tables already in the file are replaced.
+
+    Every Aries row gets its own PROPNUM. Its ARIES_COLUMNS are split
+    between AC_PROPERTY_BASE and AC_BUDGET_BASE by the alias they are
+    pulled with, and columns the pull doesn't have are left NULL.
+
+    Args:
+        path: The SQLite file. Created if missing.
+        dev_planning (pd.DataFrame): Rows for DEV_PLANNING.
+        aries (pd.DataFrame): Rows for the Aries tables.
+        text16: AC_USER.TEXT16 of every case.
+
+    Returns:
+        Dict of table name: rows written.
+    """
+    aries = aries.reset_index(drop=True)
+    propnum = pd.Series(range(1, len(aries) + 1), name='PROPNUM')
+    tables = {
+        'AC_PROPERTY_BASE': aries.reindex(
+            columns=_aries_table_columns('M')),
+        'AC_BUDGET_BASE': aries.reindex(columns=_aries_table_columns('B')),
+        'AC_USER': pd.DataFrame({'TEXT16': text16}, index=aries.index),
+        }
+    tables = {name: pd.concat([propnum, table], axis=1)
+              for name, table in tables.items()}
+    tables['DEV_PLANNING'] = dev_planning
+
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            for view in ('AC_PROPERTY', 'AC_BUDGET'):
+                conn.execute(f'DROP VIEW IF EXISTS {view}')
+            for name, table in tables.items():
+                table.to_sql(name, conn, if_exists='replace', index=False)
+            for table, columns, unique in SQLITE_INDEXES:
+                conn.execute('CREATE {unique}INDEX IX_{table}_{name} '
+                             'ON {table} ({columns})'.format(
+                                 unique='UNIQUE ' if unique else '',
+                                 table=table, name='_'.join(columns),
+                                 columns=', '.join(columns)))
+            # The pulls read these, as they do in Working District.
+            conn.execute('CREATE VIEW AC_PROPERTY AS '
+                         'SELECT * FROM AC_PROPERTY_BASE')
+            conn.execute('CREATE VIEW AC_BUDGET AS '
+                         'SELECT * FROM AC_BUDGET_BASE')
+    finally:
+        conn.close()
+    return {name: len(table) for name, table in tables.items()}
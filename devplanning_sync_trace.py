@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory tracing for a sync run.
+
+The loaders, the duplicate and merge steps, each field check, the workbook
+writers and each Aries update open a stage with trace_stage. While a trace
+is active (see tracing) every stage adds a record to it with its wall time,
+rows in and out, bytes moved and memory use. With no trace active the
+stages cost next to nothing, so the library functions stay instrumented
+all the time and only the GUI and the command line turn tracing on.
+
+A finished trace is saved as JSON with save_trace, one file per run.
+run_stages runs a GUI button's stages one after another under a trace and
+stops at the first one that fails.
+
+Memory is recorded two ways. rss_mb and peak_rss_mb are the process's
+resident memory and its high-water mark when the stage ended. psutil gives
+both on Windows; without it the high-water mark comes from the resource
+module on Unix and the current figure is left out. traced_peak_mb is the
+most Python and numpy allocated during the stage, from tracemalloc. It is
+only recorded when the trace was started with memory=True, because tracing
+allocations slows pandas down a lot. Stages that overlap, like the two
+pulls or a field check inside run_checks, share one tracemalloc peak.
+"""
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Folder the GUI saves its traces in. Set DEVPLANNING_SYNC_TRACES to move it.
+TRACE_DIR = os.environ.get(
+    'DEVPLANNING_SYNC_TRACES',
+    os.path.join(os.path.expanduser('~'), '.devplanning_sync_traces'))
+
+# The trace stages are recorded into. A context variable rather than a
+# global, so the worker jobs of run_many can each trace on their own.
+_active = contextvars.ContextVar('devplanning_sync_trace', default=None)
+
+# Guards the records list and the count of open stages, since the two pulls
+# record from separate threads.
+_lock = threading.Lock()
+_open_stages = 0
+
+_MB = 2 ** 20
+
+
+def _rss():
+    """
+    Returns (current, peak) resident memory of the process in bytes. Either
+    is None when it can't be read on this platform.
+    """
+    current = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        current = info.rss
+        peak = getattr(info, 'peak_wset', None)  # Windows only
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes.
+        peak *= 1 if sys.platform == 'darwin' else 1024
+    return current, peak
+
+
+def _megabytes(count):
+    return None if count is None else round(count / _MB, 2)
+
+
+def active_trace():
+    """
+    Returns the trace stages are being recorded into, or None.
+    """
+    return _active.get()
+
+
+@contextlib.contextmanager
+def tracing(label='', memory=False):
+    """
+    Records every stage run inside the block into a new trace.
+
+    Args:
+        label: Saved with the trace, e.g. the button or business unit.
+        memory: Also record each stage's peak allocations with tracemalloc.
+
+    Yields:
+        The trace dict. Its stages list fills in as stages finish.
+    """
+    trace = {'label': label,
+             'started': datetime.datetime.now().isoformat(timespec='seconds'),
+             'python': sys.version.split()[0],
+             'memory': memory,
+             'stages': []}
+    token = _active.set(trace)
+    started_tracemalloc = memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace['seconds'] = round(time.perf_counter() - started, 4)
+        trace['peak_rss_mb'] = _megabytes(_rss()[1])
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _active.reset(token)
+
+
+@contextlib.contextmanager
+def trace_stage(name, rows_in=None, **details):
+    """
+    Times the block as one stage of the active trace. The record is yielded
+    so the block can fill in rows_out, bytes or anything else worth keeping
+    once it knows them. Nothing is recorded when no trace is active.
+
+    Args:
+        name: Stage name, e.g. 'pull dev_planning' or 'check LEASE'.
+        rows_in: Rows going into the stage.
+        **details: Extra keys for the record.
+
+    Yields:
+        The record dict.
+    """
+    global _open_stages
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None,
+              'bytes': None, **details}
+    trace = _active.get()
+    if trace is None:
+        yield record
+        return
+
+    memory = trace['memory'] and tracemalloc.is_tracing()
+    with _lock:
+        if memory and _open_stages == 0:
+            tracemalloc.reset_peak()
+        _open_stages += 1
+    traced_before = tracemalloc.get_traced_memory()[0] if memory else 0
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - started, 4)
+        if memory:
+            record['traced_peak_mb'] = _megabytes(
+                tracemalloc.get_traced_memory()[1] - traced_before)
+        current, peak = _rss()
+        record['rss_mb'] = _megabytes(current)
+        record['peak_rss_mb'] = _megabytes(peak)
+        record['thread'] = threading.current_thread().name
+        with _lock:
+            _open_stages -= 1
+            trace['stages'].append(record)
+
+
+class StageFailed(Exception):
+    """
+    Raised by a stage that has already shown the user why it failed, so
+    run_stages stops there instead of running the next stage on what this
+    one left behind.
+    """
+
+
+def run_stages(stages, memory=False, cancelled=None, on_stage=None):
+    """
+    Runs stages one after another under a new trace, stopping at the first
+    one that raises.
+
+    Args:
+        stages: List of (stage name, function) pairs. The functions are
+                called with no arguments.
+        memory: Passed on to tracing.
+        cancelled: Function returning True once the run should stop. It is
+                   checked before each stage.
+        on_stage: Called before each stage with its name and the
+                  (name, seconds) of the stages finished so far.
+
+    Returns:
+        Tuple of (outcome, timings, trace). outcome is 'Done', 'Cancelled'
+        or '<stage name> failed: <why>'. timings holds the (name, seconds)
+        of the stages that finished.
+    """
+    timings = []
+    outcome = 'Done'
+    with tracing(', '.join(name for name, _ in stages), memory) as trace:
+        for name, function in stages:
+            if cancelled is not None and cancelled():
+                outcome = 'Cancelled'
+                break
+            if on_stage is not None:
+                on_stage(name, list(timings))
+            started = time.perf_counter()
+            try:
+                with trace_stage(name):
+                    function()
+            except Exception as e:
+                outcome = f'{name} failed: {e}'
+                break
+            timings.append((name, time.perf_counter() - started))
+    return outcome, timings, trace
+
+
+def frame_bytes(frame):
+    """
+    Returns the in-memory size of a frame in bytes. Object columns only
+    count their pointers, which keeps this cheap enough to call on every
+    stage. Arrow string columns are counted in full.
+    """
+    return int(frame.memory_usage(index=True, deep=False).sum())
+
+
+def save_trace(trace, path=None):
+    """
+    Writes a trace to a JSON file.
+
+    Args:
+        trace: What tracing yielded.
+        path: File to write. Defaults to a timestamped file in TRACE_DIR.
+
+    Returns:
+        The path written.
+    """
+    if path is None:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        name = ''.join(character if character.isalnum() else '_'
+                       for character in trace['label'])
+        path = os.path.join(TRACE_DIR, '{started}_{name}.json'.format(
+            started=trace['started'].replace(':', ''), name=name))
+    with open(path, 'w') as trace_file:
+        json.dump(trace, trace_file, indent=2, default=str)
+    return path
@@ -1,10 +1,61 @@
+import contextvars
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 import pytest
+import sqlalchemy
 
+import benchmark_devplanning_sync
+import devplanning_syn_GUI_functions
+import devplanning_sync
+from devplanning_sync_cache import cached_pull
+from devplanning_sync_cache import changed_since
+from devplanning_sync_cache import clear_snapshots
+from devplanning_sync_cache import fingerprint
+from devplanning_sync_cache import merge_snapshot
+from devplanning_sync_cache import read_snapshot
+from devplanning_sync_cache import snapshot_info
+from devplanning_sync_cache import write_snapshot
+from devplanning_sync_functions import _batch_update_sql
+from devplanning_sync_functions import _stage_changes
+from devplanning_sync_functions import aries_changes
+from devplanning_sync_functions import ARIES_SCHEMA
+from devplanning_sync_functions import coalesce_columns
+from devplanning_sync_functions import combine_sources
 from devplanning_sync_functions import compare_columns
+from devplanning_sync_functions import compare_fields
 from devplanning_sync_functions import compare_numeric_columns
+from devplanning_sync_functions import concat_chunks
+from devplanning_sync_functions import dev_planning_columns
+from devplanning_sync_functions import DP_PRIORITY
+from devplanning_sync_functions import EARTH_RADIUS_M
+from devplanning_sync_functions import FIELD_CHECKS
+from devplanning_sync_functions import field_view
+from devplanning_sync_functions import haversine_distance
 from devplanning_sync_functions import hierarchical_select
 from devplanning_sync_functions import match
+from devplanning_sync_functions import match_columns
+from devplanning_sync_functions import match_points
+from devplanning_sync_functions import name_key
+from devplanning_sync_functions import pending_updates
+from devplanning_sync_functions import read_sql_chunked
+from devplanning_sync_functions import resolve_duplicates
+from devplanning_sync_functions import recompare_fields
+from devplanning_sync_functions import split_business_units
+from devplanning_sync_functions import update_tables
+from devplanning_sync_sqlite import seed_sqlite
+from devplanning_sync_sqlite import sqlite_backend
+from devplanning_sync_trace import run_stages
+from devplanning_sync_trace import save_trace
+from devplanning_sync_trace import StageFailed
+from devplanning_sync_trace import trace_stage
+from devplanning_sync_trace import tracing
 
 
 class TestHierarchicalSelect:
@@ -39,6 +90,45 @@ class TestHierarchicalSelect:
         assert actual_value == pytest.approx(expected_value, abs=1e-6), f"The output value was {actual_value}, but we expected {expected_value}."
 
 
+class TestCoalesceColumns:
+    setup_dict = {
+        'PRIMARY': ['76221', None, float('nan'), 'abc', '43720.0', None],
+        'SECONDARY': ['43720', '43720', '43720', '43720', None, None]
+    }
+    combined_df = pd.DataFrame(setup_dict)
+
+    def test_coalesce_columns_int(self):
+        actual = list(coalesce_columns([self.combined_df.PRIMARY,
+                                        self.combined_df.SECONDARY],
+                                       int))
+        expected = [76221, 43720, 43720, 43720, 0, 0]
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_coalesce_columns_float(self):
+        actual = list(coalesce_columns([self.combined_df.PRIMARY,
+                                        self.combined_df.SECONDARY],
+                                       float))
+        expected = [76221., 43720., 43720., 43720., 43720., 0.]
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_coalesce_columns_matches_hierarchical_select(self):
+        # Text int() and float() read but pd.to_numeric doesn't.
+        primary = list(self.combined_df.PRIMARY) + ['1_000', b'5', ' 7 ']
+        secondary = list(self.combined_df.SECONDARY) + [None, None, None]
+        for type_to_coerce in (int, float):
+            actual = list(coalesce_columns([primary, secondary],
+                                           type_to_coerce))
+            expected = [hierarchical_select(first, second, type_to_coerce)
+                        for first, second in zip(primary, secondary)]
+            assert actual == expected, \
+                "One or more of the values are not equal."
+        assert actual[-3:] == [1000., 5., 7.]
+
+    def test_hierarchical_select_default_is_int(self):
+        actual_value = hierarchical_select(None, 'abc', float)
+        assert actual_value == 0 and isinstance(actual_value, int)
+
+
 class TestMatch:
     def test_match_both_null(self):
         actual = match(None, None, msg5="test_pass")
@@ -71,6 +161,33 @@ class TestMatch:
             "function returned {} instead of msg1".format(actual)
 
 
+class TestMatchColumns:
+    # The same value pairs used by TestMatch, evaluated as one column.
+    devp = [None, None, 'valid', 'valid', "We're valid!"]
+    aries = [None, 'valid', None, 'Also valid', "We're valid!"]
+
+    def test_match_columns_agrees_with_match(self):
+        actual = list(match_columns(self.devp, self.aries))
+        expected = [match(dp, ar) for dp, ar in zip(self.devp, self.aries)]
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_match_columns_messages(self):
+        actual = list(match_columns(self.devp, self.aries,
+                                    msg1='msg1', msg2='msg2', msg3='msg3',
+                                    msg4='msg4', msg5='msg5'))
+        expected = ['msg5', 'msg4', 'msg3', 'msg2', 'msg1']
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_match_columns_nan_and_na(self):
+        actual = list(match_columns(pd.Series([float('nan'), pd.NA, 'x'],
+                                              dtype=object),
+                                    pd.Series([pd.NA, 'x', float('nan')],
+                                              dtype=object),
+                                    msg3='msg3', msg4='msg4', msg5='msg5'))
+        expected = ['msg5', 'msg4', 'msg3']
+        assert actual == expected, "One or more of the values are not equal."
+
+
 class TestCompareColumns:
     setup_dict = {
         'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003', 'TEST004', 'TEST005'],
@@ -139,6 +256,979 @@ class TestCompareNumericColumns:
                     'BOTH VALUES NULL', 'BOTH VALUES NULL']
         assert actual == expected, "One or more of the values are not equal."
 
+    def test_compare_numeric_columns_abs_tol(self):
+        actual_df = compare_numeric_columns('DP_COL',
+                                            'AR_COL',
+                                            dataframe=self.combined_df,
+                                            round_to=4,
+                                            abs_tol=0.01)
+        actual = list(actual_df.MATCH.values)
+        expected = ["MATCH", "MATCH",
+                    'MATCH', 'UPDATE ARIES',
+                    "UPDATE ARIES", 'UPDATE ARIES',
+                    'DP EMPTY', 'DP EMPTY',
+                    'BOTH VALUES NULL', 'BOTH VALUES NULL']
+        assert actual == expected, "One or more of the values are not equal."
+        assert actual_df.DELTA.iloc[2] == pytest.approx(0.0064, abs=1e-9)
+
+    def test_compare_numeric_columns_rel_tol(self):
+        actual_df = compare_numeric_columns('DP_COL',
+                                            'AR_COL',
+                                            dataframe=self.combined_df,
+                                            rel_tol=0.05)
+        actual = list(actual_df.MATCH.values)
+        expected = ["MATCH", "MATCH",
+                    'MATCH', 'MATCH',
+                    "UPDATE ARIES", 'UPDATE ARIES',
+                    'DP EMPTY', 'DP EMPTY',
+                    'BOTH VALUES NULL', 'BOTH VALUES NULL']
+        assert actual == expected, "One or more of the values are not equal."
+
+
+class TestCompareFields:
+    setup_dict = {
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003', 'TEST004', 'TEST005'],
+        'LEASE': ['WELL1', 'WELL2', 'WELL3', 'WELL4', 'WELL5'],
+        'DP_COL': ['ImEqual', 'NotEqualSameType', 'NotNull', None, None],
+        'AR_COL': ['ImEqual', 'SameTypeNotEqual', None, 'NotNull', None],
+        'DP_NUM': ['5.12345678', '-32.123456789', '1.0000', None, None],
+        'AR_NUM': ['5.12345678', '-30.98756263', None, '1.0000', None]
+    }
+    combined_df = pd.DataFrame(setup_dict)
+    specs = [('DP_COL', 'AR_COL', 'text', None),
+             ('DP_NUM', 'AR_NUM', 'numeric', 0.5)]
+
+    def test_compare_fields_only_keeps_mismatches(self):
+        results = compare_fields(self.specs, self.combined_df)
+        actual = list(zip(results.FIELD, results.ARIES_CODE, results.STATUS))
+        expected = [('AR_COL', 'TEST002', 'UPDATE ARIES'),
+                    ('AR_COL', 'TEST003', 'UPDATE ARIES'),
+                    ('AR_COL', 'TEST004', 'UPDATE DEVPLANNING'),
+                    ('AR_COL', 'TEST005', 'NOT ASSIGNED'),
+                    ('AR_NUM', 'TEST002', 'UPDATE ARIES'),
+                    ('AR_NUM', 'TEST003', 'UPDATE ARIES'),
+                    ('AR_NUM', 'TEST004', 'DP EMPTY'),
+                    ('AR_NUM', 'TEST005', 'BOTH VALUES NULL')]
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_field_view_matches_compare_columns(self):
+        results = compare_fields(self.specs, self.combined_df)
+        actual = list(field_view(results, self.combined_df, 'AR_COL').MATCH)
+        expected = list(compare_columns('DP_COL', 'AR_COL',
+                                        dataframe=self.combined_df).MATCH)
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_field_view_multiple_fields(self):
+        results = compare_fields(self.specs, self.combined_df)
+        view = field_view(results, self.combined_df, ['AR_COL', 'AR_NUM'])
+        assert list(view.MATCH_AR_NUM) == ['MATCH', 'UPDATE ARIES',
+                                           'UPDATE ARIES', 'DP EMPTY',
+                                           'BOTH VALUES NULL']
+        assert view.DELTA_AR_NUM.iloc[1] == pytest.approx(-1.135894159)
+
+    def test_compare_fields_tolerances(self):
+        # -32.12 against -30.99 is 1.14 apart, or 3.5% of the larger.
+        for tolerance, expected in [(0.5, 'UPDATE ARIES'),
+                                    (('abs', 2), 'MATCH'),
+                                    (('rel', 0.01), 'UPDATE ARIES'),
+                                    (('rel', 0.05), 'MATCH')]:
+            results = compare_fields(
+                {'NUM': ('DP_NUM', 'AR_NUM', 'numeric', tolerance)},
+                self.combined_df)
+            actual = results.STATUS[results.ARIES_CODE == 'TEST002']
+            assert list(actual) == ([expected] if expected != 'MATCH'
+                                    else []), tolerance
+        with pytest.raises(ValueError):
+            compare_fields({'NUM': ('DP_NUM', 'AR_NUM', 'numeric',
+                                    ('pct', 5))}, self.combined_df)
+
+
+class TestNameKey:
+    combined_df = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003', 'TEST004'],
+        'LEASE': ['SMITH JONES UNT 1H', 'Smith Jones 2H', None, 'WELL 4'],
+        'WELL_NAME': ['Smith-Jones  Unit #1H', 'Smith Jones 3H', 'WELL 3',
+                      'WELL 4']
+        })
+
+    def test_name_key(self):
+        actual = name_key(['Smith-Jones  Unit #1H', ' SMITH_JONES UNT 1H',
+                           "O'Neil St. 2", None])
+        assert list(actual[:3]) == ['smith jones unt 1h',
+                                    'smith jones unt 1h', 'o neil st 2']
+        assert pd.isna(actual[3])
+
+    def test_compare_fields_cosmetic_only(self):
+        specs = {'LEASE': ('WELL_NAME', 'LEASE', 'name', None)}
+        results = compare_fields(specs, self.combined_df)
+        assert list(results.STATUS) == ['COSMETIC ONLY', 'UPDATE ARIES',
+                                        'UPDATE ARIES']
+        # Keys saved on the frame give the same result.
+        keyed = self.combined_df.assign(
+            WELL_NAME_KEY=name_key(self.combined_df.WELL_NAME),
+            LEASE_KEY=name_key(self.combined_df.LEASE))
+        pd.testing.assert_frame_equal(compare_fields(specs, keyed), results)
+        assert pending_updates(compare_fields(
+            {'LEASE': FIELD_CHECKS['LEASE']}, self.combined_df)) == 2
+
+
+class TestMatchPoints:
+    combined_df = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003', 'TEST004', 'TEST005'],
+        'LEASE': ['WELL1', 'WELL2', 'WELL3', 'WELL4', 'WELL5'],
+        'SL_LAT': [30.0, 30.0, 30.0, None, 0.0],
+        'SL_LONG': [-97.0, -97.0, -97.0, -97.0, 0.0],
+        'LAT_SURFACE': [30.00001, 30.001, None, 30.0, None],
+        'LONG_SURFACE': [-97.00001, -97.0, -97.0, -97.0, None]
+        })
+
+    def test_haversine_distance(self):
+        # One degree of latitude is 1/360 of a great circle.
+        expected = 2 * np.pi * EARTH_RADIUS_M / 360
+        actual = haversine_distance([0.0], [-97.0], [1.0], [-97.0],
+                                    radius=EARTH_RADIUS_M)
+        assert actual[0] == pytest.approx(expected)
+        assert np.isnan(haversine_distance([None], [0], [0], [0])[0])
+
+    def test_match_points(self):
+        distance, labels = match_points(
+            [self.combined_df.SL_LAT, self.combined_df.SL_LONG],
+            [self.combined_df.LAT_SURFACE, self.combined_df.LONG_SURFACE])
+        assert list(labels) == ['MATCH', 'UPDATE ARIES', 'UPDATE ARIES',
+                                'DP EMPTY', 'BOTH VALUES NULL']
+        assert distance[0] < 5
+        assert distance[1] == pytest.approx(364.8, abs=0.5)
+
+    def test_point_check_pushes_both_columns(self):
+        specs = {'SH_LOCATION': FIELD_CHECKS['SH_LOCATION']}
+        results = compare_fields(specs, self.combined_df)
+        view = field_view(results, self.combined_df, 'SH_LOCATION')
+        assert list(view.MATCH) == ['MATCH', 'UPDATE ARIES', 'UPDATE ARIES',
+                                    'DP EMPTY', 'BOTH VALUES NULL']
+        assert view.DELTA[1] == pytest.approx(results.DELTA.iloc[0])
+
+        changes = aries_changes(results, self.combined_df, ['SH_LOCATION'],
+                                'SOUTH TEXAS')
+        staged, _ = _stage_changes([change[1:5] for change in changes])
+        assert list(staged.columns) == ['ARIES_CODE', 'VAL_LAT_SURFACE',
+                                        'VAL_LONG_SURFACE']
+        assert list(staged.ARIES_CODE) == ['TEST002', 'TEST003']
+
+
+class TestCombineSources:
+    dev_planning = pd.DataFrame({
+        'ARIES_ID': ['TEST003', 'TEST001', None, 'TEST009'],
+        'WELL_NAME': ['Well 3', 'Well 1', 'New well', 'Well 9'],
+        'RSV_CAT': ['5PUD', '5PUD', '6PROB', '5PUD']
+        })
+    aries = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003'],
+        'LEASE': ['Well 1', 'Well 2', 'Well 3'],
+        'RSV_CAT': ['5PUD', '5PUD', '7POSS'],
+        'TD_DATE': [None, None, None]
+        })
+
+    def test_combine_sources(self):
+        combined_df, in_dp_not_aries, in_aries_not_dp = combine_sources(
+            self.dev_planning, self.aries)
+        assert list(combined_df.index) == ['TEST001', 'TEST003']
+        assert list(combined_df.ARIES_CODE) == ['TEST001', 'TEST003']
+        assert list(combined_df.RSV_CAT_AR) == ['5PUD', '7POSS']
+        assert sorted(in_dp_not_aries.WELL_NAME) == ['New well', 'Well 9']
+        assert in_dp_not_aries.ARIES_CODE.isna().all()
+        assert list(in_aries_not_dp.ARIES_CODE) == ['TEST002']
+        assert list(in_aries_not_dp.columns)[-1] == 'TD_DATE'
+
+    def test_combine_sources_duplicate_keys(self):
+        with pytest.raises(pd.errors.MergeError):
+            combine_sources(self.dev_planning,
+                            pd.concat([self.aries, self.aries.iloc[:1]]))
+
+
+class TestResolveDuplicates:
+    dev_planning = pd.DataFrame({
+        'ARIES_ID': ['TEST001', 'TEST001', 'TEST002', 'TEST003', 'TEST003',
+                     'TEST003', None, None],
+        'SCENARIO': ['MDV', 'A', 'A', 'MDV', 'MDV', 'A', 'A', 'A'],
+        'DEV_STATUS': ['PRIMARY', 'DEVELOPMENT', 'PRIMARY', 'PRIMARY',
+                       'PRIMARY', 'DEVELOPMENT', 'PRIMARY', 'PRIMARY'],
+        'WELL_NAME': ['1 MDV', '1 A', '2', '3 MDV', '3 MDV copy', '3 A',
+                      'New 1', 'New 2']
+        })
+
+    def test_resolve_duplicates(self):
+        actual, report = resolve_duplicates(self.dev_planning, 'ARIES_ID',
+                                            DP_PRIORITY)
+        # Scenario A wins over MDV even when its DEV_STATUS ranks lower.
+        assert list(actual.WELL_NAME) == ['1 A', '2', '3 A', 'New 1',
+                                          'New 2']
+        assert list(report.WELL_NAME) == ['1 MDV', '1 A', '3 MDV',
+                                          '3 MDV copy', '3 A']
+        assert list(report.KEPT) == [False, True, False, False, True]
+
+    def test_resolve_duplicates_dev_status_tie_break(self):
+        dev_planning = self.dev_planning.iloc[3:5].assign(
+            DEV_STATUS=['DEVELOPMENT', 'PRIMARY'])
+        actual, report = resolve_duplicates(dev_planning, 'ARIES_ID',
+                                            DP_PRIORITY)
+        assert list(actual.WELL_NAME) == ['3 MDV copy']
+
+    def test_resolve_duplicates_none(self):
+        actual, report = resolve_duplicates(self.dev_planning.iloc[:3:2],
+                                            'ARIES_ID', DP_PRIORITY)
+        assert len(actual) == 2
+        assert report.empty and 'KEPT' in report
+
+
+class TestDevPlanningColumns:
+    def test_dev_planning_columns_renamed_and_derived(self):
+        actual = dev_planning_columns(['PSID', 'TH_LOCATION',
+                                       'PLANNED_TARGET_LOCATION'])
+        expected = ['ARIES_ID', 'WELL_NAME', 'RSV_CAT', 'BUSINESS_UNIT',
+                    'SCENARIO', 'DEV_STATUS', 'PSID', 'WAYPOINT1_LAT',
+                    'LP_LAT', 'WAYPOINT1_LONG', 'LP_LONG']
+        assert actual == expected, "One or more of the values are not equal."
+
+    def test_dev_planning_columns_all_checks(self):
+        actual = dev_planning_columns()
+        assert 'COMPLETABLE_LL' in actual
+        assert 'PROP_NUM_DP' not in actual
+        assert len(actual) == len(set(actual))
+
+
+class TestUpdateTables:
+    lease_check = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003'],
+        'WELL_NAME': ['Well 1', 'Well 2', 'Well 3'],
+        'MATCH': ['UPDATE ARIES', 'MATCH', 'NOT ASSIGNED']
+        })
+    pad_check = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003'],
+        'PAD_NAME_DP': ['Pad 1', 'Pad 2', 'Pad 3'],
+        'MATCH': ['MATCH', 'UPDATE ARIES', 'UPDATE DEVPLANNING']
+        })
+
+    def test_stage_changes(self):
+        staged, staged_dtypes = _stage_changes([
+            (self.lease_check, 'WELL_NAME', 'LEASE',
+             {'WELL_NAME': 'lease_type'}),
+            (self.pad_check, 'PAD_NAME_DP', 'PAD_NAME',
+             {'PAD_NAME_DP': 'pad_type'})
+            ])
+        assert list(staged.ARIES_CODE) == ['TEST001', 'TEST002']
+        assert list(staged.VAL_LEASE.fillna('')) == ['Well 1', '']
+        assert list(staged.VAL_PAD_NAME.fillna('')) == ['', 'Pad 2']
+        assert staged_dtypes['VAL_LEASE'] == 'lease_type'
+
+    def test_batch_update_sql(self):
+        sql_string = _batch_update_sql(
+            'ac_property_base',
+            [('LEASE', ''),
+             ('LATERAL_LEN', "AND U.TEXT16 <> 'RESERVES CASE'")])
+        assert ("M.LEASE = CASE WHEN ct.VAL_LEASE IS NOT NULL "
+                "THEN ct.VAL_LEASE ELSE M.LEASE END") in sql_string
+        assert ("(ct.VAL_LEASE IS NOT NULL) OR (ct.VAL_LATERAL_LEN IS NOT "
+                "NULL AND U.TEXT16 <> 'RESERVES CASE')") in sql_string
+
+    def test_batch_update_sql_sqlite(self):
+        sql_string = _batch_update_sql('ac_budget_base',
+                                       [('PLANNED_LL', '')], 'sqlite')
+        assert ("PLANNED_LL = CASE WHEN ct.VAL_PLANNED_LL IS NOT NULL "
+                "THEN ct.VAL_PLANNED_LL ELSE ttu.PLANNED_LL END") in sql_string
+        assert 'ac_budget_base AS ttu' in sql_string
+        assert '[' not in sql_string
+        with pytest.raises(ValueError):
+            _batch_update_sql('ac_budget_base', [('PLANNED_LL', '')],
+                              'postgresql')
+
+
+class TestReadSqlChunked:
+    def test_read_sql_chunked_schema(self):
+        conn = sqlite3.connect(':memory:')
+        pd.DataFrame({
+            'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003', 'TEST004',
+                           'TEST005'],
+            'RSV_CAT': ['5PUD', '6PROB', '5PUD', '1PDP', '7POSS'],
+            'PROP_NUM': ['000001', None, '000003', '000004', '000005'],
+            'RESERVOIR': ['EAGLE FORD', 'EAGLE FORD', 'AUSTIN CHALK',
+                          'EAGLE FORD', 'BUDA'],
+            'LAT_SURFACE': [28.1, None, 28.3, 28.4, 28.5],
+            'EXTRA': [1, 2, 3, 4, 5]
+            }).to_sql('AC_PROPERTY', conn, index=False)
+
+        actual = read_sql_chunked('SELECT * FROM AC_PROPERTY', conn,
+                                  ARIES_SCHEMA, chunksize=2)
+        conn.close()
+        assert actual.ARIES_CODE.dtype == ARIES_SCHEMA['ARIES_CODE']
+        assert actual.RSV_CAT.dtype == ARIES_SCHEMA['RSV_CAT']
+        # 1PDP isn't one of the reserve categories the queries pull.
+        assert actual.RSV_CAT.isna().tolist() == [False] * 3 + [True, False]
+        assert sorted(actual.RESERVOIR.cat.categories) == [
+            'AUSTIN CHALK', 'BUDA', 'EAGLE FORD']
+        assert actual.PROP_NUM.tolist()[0] == '000001'
+        assert actual.PROP_NUM.isna().tolist()[1]
+        assert actual.LAT_SURFACE.dtype == 'float64'
+        assert actual.EXTRA.tolist() == [1, 2, 3, 4, 5]
+
+    def test_read_sql_chunked_empty(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE AC_PROPERTY '
+                     '(ARIES_CODE TEXT, RSV_CAT TEXT, LAT_SURFACE REAL)')
+        statements = []
+        conn.set_trace_callback(statements.append)
+        actual = read_sql_chunked(
+            'SELECT ARIES_CODE, RSV_CAT, LAT_SURFACE FROM AC_PROPERTY '
+            'WHERE ARIES_CODE IN (?, ?)', conn, ARIES_SCHEMA,
+            params=['TEST001', 'TEST002'])
+        conn.close()
+        # The columns come from the one query, without running it again.
+        assert len(statements) == 1
+        assert actual.empty
+        assert list(actual.columns) == ['ARIES_CODE', 'RSV_CAT',
+                                        'LAT_SURFACE']
+        assert actual.RSV_CAT.dtype == ARIES_SCHEMA['RSV_CAT']
+        assert actual.LAT_SURFACE.dtype == 'float64'
+
+    def test_concat_chunks_null_categorical(self):
+        # Like the key-only rows of a semi-join pull, which are reindexed to
+        # columns they weren't pulled with.
+        actual = concat_chunks([
+            pd.DataFrame({'MDA': ['MDA EAST', 'MDA WEST']}).astype('category'),
+            pd.DataFrame({'MDA': [np.nan, np.nan]}).astype('category')])
+        assert actual.MDA.dtype == 'category'
+        assert actual.MDA.tolist()[:2] == ['MDA EAST', 'MDA WEST']
+        assert actual.MDA.isna().tolist() == [False, False, True, True]
+
+
+class TestLoadSnowflakeMatching:
+    def test_one_marker_per_key(self, monkeypatch):
+        queries = []
+        closed = []
+
+        class Connection:
+            def close(self):
+                closed.append(self)
+
+        def read_sql_chunked(query, conn, schema, params=None):
+            queries.append((query, params or []))
+            aries_ids = [] if params else ['TEST001', 'TEST004', None]
+            return pd.DataFrame({'ARIES_ID': pd.Series(aries_ids,
+                                                       dtype='string')})
+
+        monkeypatch.setattr(devplanning_syn_GUI_functions,
+                            'read_sql_chunked', read_sql_chunked)
+        monkeypatch.setattr(devplanning_syn_GUI_functions,
+                            'SNOWFLAKE_MAX_IN_LIST', 2)
+        monkeypatch.setitem(devplanning_syn_GUI_functions.PRODUCTION,
+                            'connect_dev_planning', Connection)
+        actual = devplanning_syn_GUI_functions._load_snowflake_matching(
+            'SOUTH TEXAS', ['TEST001', 'TEST002', 'TEST003'], ['ARIES_ID'])
+
+        # Two IN lists, then the key-only pull of the whole business unit,
+        # which binds no codes at all.
+        assert [len(params) for _, params in queries] == [2, 1, 0]
+        for query, params in queries:
+            assert query.count('?') == len(params)
+            assert '%s' not in query
+        # The key-only rows of codes that were fully pulled are dropped.
+        assert list(actual.ARIES_ID.dropna()) == ['TEST004']
+        assert actual.ARIES_ID.isna().sum() == 1
+        assert len(closed) == 1
+
+    def test_connection_closed_on_error(self, monkeypatch):
+        closed = []
+
+        class Connection:
+            def close(self):
+                closed.append(self)
+
+        def read_sql_chunked(query, conn, schema, params=None):
+            raise ConnectionError('Snowflake went away')
+
+        monkeypatch.setattr(devplanning_syn_GUI_functions,
+                            'read_sql_chunked', read_sql_chunked)
+        monkeypatch.setitem(devplanning_syn_GUI_functions.PRODUCTION,
+                            'connect_dev_planning', Connection)
+        with pytest.raises(ConnectionError):
+            devplanning_syn_GUI_functions._load_snowflake_matching(
+                'SOUTH TEXAS', ['TEST001'], ['ARIES_ID'])
+        assert len(closed) == 1
+
+
+class TestSnapshotCache:
+    aries = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002'],
+        'LEASE': ['Well 1', None],
+        'LATERAL_LEN': [10000.0, 7500.5]
+        })
+    query = "SELECT * FROM AC_PROPERTY WHERE BUSINESS_UNIT = 'SOUTH TEXAS'"
+
+    def test_snapshot_round_trip(self, tmp_path):
+        pytest.importorskip('pyarrow')
+        info = write_snapshot(self.aries, 'aries', 'SOUTH TEXAS', self.query,
+                              cache_dir=tmp_path)
+        actual = read_snapshot('aries', 'SOUTH TEXAS', self.query,
+                               cache_dir=tmp_path)
+        pd.testing.assert_frame_equal(actual, self.aries)
+        assert info['fingerprint'] == fingerprint(actual)
+        assert actual.attrs['snapshot']['rows'] == 2
+
+    def test_snapshot_misses(self, tmp_path):
+        pytest.importorskip('pyarrow')
+        write_snapshot(self.aries, 'aries', 'SOUTH TEXAS', self.query,
+                       cache_dir=tmp_path)
+        # A different query, an expired snapshot, or a cleared one all miss.
+        assert read_snapshot('aries', 'SOUTH TEXAS', self.query + ' ',
+                             cache_dir=tmp_path) is None
+        assert read_snapshot('aries', 'SOUTH TEXAS', self.query, ttl=-1,
+                             cache_dir=tmp_path) is None
+        clear_snapshots('aries', 'south texas', cache_dir=tmp_path)
+        assert read_snapshot('aries', 'SOUTH TEXAS', self.query,
+                             cache_dir=tmp_path) is None
+
+    def test_snapshot_data_replaced_first(self, tmp_path, monkeypatch):
+        pytest.importorskip('pyarrow')
+        write_snapshot(self.aries, 'aries', 'SOUTH TEXAS', self.query,
+                       cache_dir=tmp_path)
+        replace = os.replace
+
+        def crash_before_metadata(temp_path, path):
+            if path.endswith('.json'):
+                raise OSError('disk full')
+            replace(temp_path, path)
+        monkeypatch.setattr(os, 'replace', crash_before_metadata)
+        with pytest.raises(OSError):
+            write_snapshot(self.aries.iloc[:1], 'aries', 'SOUTH TEXAS',
+                           self.query, cache_dir=tmp_path)
+        # New data with the old metadata isn't read, and no temporary
+        # files are left behind.
+        assert read_snapshot('aries', 'SOUTH TEXAS', self.query,
+                             cache_dir=tmp_path) is None
+        assert sorted(os.listdir(tmp_path)) == ['aries_SOUTH_TEXAS.arrow',
+                                                'aries_SOUTH_TEXAS.json']
+
+    def test_clear_snapshots_multiple_business_units(self, tmp_path):
+        pytest.importorskip('pyarrow')
+        for business_unit in ['BRAZOS VALLEY, SOUTH TEXAS', 'BRAZOS VALLEY']:
+            write_snapshot(self.aries, 'aries', business_unit, self.query,
+                           cache_dir=tmp_path)
+        clear_snapshots('aries', 'SOUTH TEXAS', cache_dir=tmp_path)
+        assert read_snapshot('aries', 'BRAZOS VALLEY, SOUTH TEXAS',
+                             self.query, cache_dir=tmp_path) is None
+        assert read_snapshot('aries', 'BRAZOS VALLEY', self.query,
+                             cache_dir=tmp_path) is not None
+
+    def test_clear_snapshots_already_removed(self, tmp_path, monkeypatch):
+        pytest.importorskip('pyarrow')
+        write_snapshot(self.aries, 'aries', 'SOUTH TEXAS', self.query,
+                       cache_dir=tmp_path)
+        remove = os.remove
+
+        def remove_twice(path):
+            # Another process clearing the same snapshot got there first.
+            remove(path)
+            remove(path)
+        monkeypatch.setattr(os, 'remove', remove_twice)
+        clear_snapshots('aries', 'SOUTH TEXAS', cache_dir=tmp_path)
+        assert os.listdir(tmp_path) == []
+
+    def test_merge_snapshot(self):
+        changed = pd.DataFrame({'ARIES_CODE': ['TEST002', 'TEST003'],
+                                'LEASE': ['Well 2', 'Well 3'],
+                                'LATERAL_LEN': [7600.0, 5000.0]})
+        actual = merge_snapshot(self.aries, changed, 'ARIES_CODE')
+        assert list(actual.ARIES_CODE) == ['TEST001', 'TEST002', 'TEST003']
+        assert list(actual.LATERAL_LEN) == [10000.0, 7600.0, 5000.0]
+
+    def test_merge_snapshot_several_rows_per_key(self):
+        cached = pd.DataFrame({'ARIES_ID': ['TEST001', 'TEST001', None],
+                               'SCENARIO': ['A', 'MDV', 'A'],
+                               'WELL_NAME': ['Well 1', 'Well 1', 'Well 9']})
+        # Only the MDV row and the row with no key were edited, but the
+        # delta pull brings back every row of TEST001.
+        changed = pd.DataFrame({'ARIES_ID': ['TEST001', 'TEST001', None],
+                                'SCENARIO': ['A', 'MDV', 'A'],
+                                'WELL_NAME': ['Well 1', 'Well 1 MDV',
+                                              'Well 9 New']})
+        actual = merge_snapshot(cached, changed, 'ARIES_ID')
+        assert list(actual.SCENARIO) == ['A', 'MDV', 'A']
+        assert list(actual.WELL_NAME) == ['Well 1', 'Well 1 MDV',
+                                          'Well 9 New']
+
+    def test_cached_pull_incremental(self, tmp_path):
+        pytest.importorskip('pyarrow')
+        full = self.aries.assign(
+            RSV_CAT=['5PUD', '5PUD'],
+            SYNC_WATERMARK=pd.to_datetime(['2023-01-01', '2023-01-02']))
+        changed = pd.DataFrame({
+            'ARIES_CODE': ['TEST001'], 'LEASE': ['Well 1'],
+            'LATERAL_LEN': [9000.0], 'RSV_CAT': ['1PDP'],
+            'SYNC_WATERMARK': pd.to_datetime(['2023-01-03'])})
+        queries = []
+
+        def pull(query):
+            queries.append(query)
+            return full if len(queries) == 1 else changed
+
+        def pull_aries(ttl):
+            return cached_pull(
+                'aries', 'SOUTH TEXAS', self.query, pull, ttl=ttl,
+                delta_query=lambda since: f'changed since {since}',
+                key='ARIES_CODE', keep=lambda frame: frame.RSV_CAT == '5PUD',
+                cache_dir=tmp_path)
+
+        first = pull_aries(ttl=3600)
+        second = pull_aries(ttl=-1)
+        assert queries == [self.query, 'changed since 2023-01-02 00:00:00.000']
+        # TEST001 moved to a reserve category outside the filter.
+        assert list(second.ARIES_CODE) == ['TEST002']
+        assert second.attrs['pull']['mode'] == 'incremental'
+        assert changed_since(
+            second, first.attrs['pull']['fingerprint']) == {'TEST001'}
+
+
+class TestRecompareFields:
+    specs = {'LEASE': ('WELL_NAME', 'LEASE', 'text', None),
+             'LATERAL_LEN': ('COMPLETABLE_LL', 'LATERAL_LEN', 'numeric', 0.5)}
+    before = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003'],
+        'WELL_NAME': ['Well 1', 'Well 2', 'Well 3'],
+        'LEASE': ['Well 1', 'Old 2', None],
+        'COMPLETABLE_LL': [10000, 7500, 5000],
+        'LATERAL_LEN': [10000, 7000, 5000]
+        })
+
+    def test_recompare_fields(self):
+        results = compare_fields(self.specs, self.before)
+        # TEST002 is fixed and the rows come back in a different order.
+        after = self.before.copy()
+        after.loc[1, ['LEASE', 'LATERAL_LEN']] = ['Well 2', 7500]
+        after = after.iloc[[2, 1, 0]].reset_index(drop=True)
+        actual = recompare_fields(results, after, {'TEST002'})
+        expected = compare_fields(self.specs, after)
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+class TestSplitBusinessUnits:
+    frame = pd.DataFrame({
+        'BUSINESS_UNIT': pd.Categorical(['SOUTH TEXAS', 'BRAZOS VALLEY',
+                                         None, 'SOUTH TEXAS']),
+        'ARIES_ID': ['TEST001', 'TEST002', 'TEST003', 'TEST004']
+        })
+
+    def test_split_business_units(self):
+        parts = split_business_units(self.frame)
+        assert list(parts) == ['BRAZOS VALLEY', 'SOUTH TEXAS']
+        assert list(parts['SOUTH TEXAS'].ARIES_ID) == ['TEST001', 'TEST004']
+        assert list(parts['BRAZOS VALLEY'].index) == [1]
+
+    def test_split_business_units_missing(self):
+        parts = split_business_units(self.frame,
+                                     ['SOUTH TEXAS', 'HAYNESVILLE'])
+        assert list(parts) == ['SOUTH TEXAS', 'HAYNESVILLE']
+        assert parts['HAYNESVILLE'].empty
+        assert list(parts['HAYNESVILLE'].columns) == ['BUSINESS_UNIT',
+                                                      'ARIES_ID']
+
+
+class TestCommandLine:
+    dev_planning = pd.DataFrame({
+        'ARIES_ID': ['TEST001', 'TEST002', None],
+        'WELL_NAME': ['Well 1', 'Well 2', 'New well'],
+        'RSV_CAT': ['5PUD', '5PUD', '6PROB'],
+        'BUSINESS_UNIT': ['SOUTH TEXAS'] * 3,
+        'SCENARIO': ['A', 'A', 'A'],
+        'DEV_STATUS': ['PRIMARY', 'PRIMARY', 'PRIMARY']
+        })
+    aries = pd.DataFrame({
+        'ARIES_CODE': ['TEST001', 'TEST002', 'TEST003'],
+        'LEASE': ['Well 1', 'Old 2', 'Well 3'],
+        'RSV_CAT': ['5PUD', '5PUD', '5PUD'],
+        'USER3': [None, None, None],
+        'PRESPUDWELLID': [None, None, None],
+        'TD_DATE': [None, None, None]
+        })
+
+    def test_run_dry_run(self, monkeypatch, tmp_path):
+        written = []
+        monkeypatch.setattr(
+            devplanning_sync, 'load_sources',
+            lambda *args, **kwargs: (self.dev_planning, self.aries, {}))
+        monkeypatch.setattr(devplanning_sync, 'write_backup_workbook',
+                            lambda path, *args: written.append(path))
+        monkeypatch.setattr(devplanning_sync, 'write_check_workbook',
+                            lambda path, **kwargs: written.append(path))
+        code, summary = devplanning_sync.run('south texas', ['LEASE'],
+                                             str(tmp_path))
+        assert code == devplanning_sync.EXIT_PENDING
+        assert summary['checks']['pending_updates'] == 1
+        assert summary['checks']['in_dp_not_aries'] == 1
+        assert summary['checks']['in_aries_not_dp'] == 1
+        assert summary['checks']['statuses'] == {'LEASE': {'UPDATE ARIES': 1}}
+        assert list(summary['stages']) == ['pull', 'checks', 'backups']
+        trace_path = str(tmp_path / devplanning_sync.TRACE_FILE)
+        assert written + [trace_path] == summary['outputs']
+        assert 'updates' not in summary
+        with open(trace_path) as trace_file:
+            trace = json.load(trace_file)
+        assert trace['label'] == 'SOUTH TEXAS'
+        assert ([stage['stage'] for stage in trace['stages']]
+                == ['resolve duplicates', 'merge', 'check LEASE'])
+
+    def test_run_failed_stage(self, monkeypatch, tmp_path):
+        def load_sources(*args, **kwargs):
+            raise ConnectionError('no route to Snowflake')
+        monkeypatch.setattr(devplanning_sync, 'load_sources', load_sources)
+        code, summary = devplanning_sync.run('SOUTH TEXAS', ['LEASE'],
+                                             str(tmp_path))
+        assert code == devplanning_sync.EXIT_FAILED
+        assert summary['failed_stage'] == 'pull'
+        assert 'no route to Snowflake' in summary['error']
+
+    def test_run_many(self, monkeypatch, tmp_path):
+        pulls = []
+
+        def load_sources(business_units, *args, **kwargs):
+            pulls.append(business_units)
+            other = self.aries.assign(ARIES_CODE=['TEST101', 'TEST102',
+                                                  'TEST103'])
+            return (self.dev_planning,
+                    pd.concat([self.aries.assign(BUSINESS_UNIT='SOUTH TEXAS'),
+                               other.assign(BUSINESS_UNIT='BRAZOS VALLEY')],
+                              ignore_index=True),
+                    {})
+
+        def write_backup_workbook(path, *args):
+            if 'BRAZOS' in path:
+                raise PermissionError(path)
+        # Threads stand in for the worker processes so the patches apply.
+        monkeypatch.setattr(devplanning_sync, 'ProcessPoolExecutor',
+                            ThreadPoolExecutor)
+        monkeypatch.setattr(devplanning_sync, 'load_sources', load_sources)
+        monkeypatch.setattr(devplanning_sync, 'write_backup_workbook',
+                            write_backup_workbook)
+        monkeypatch.setattr(devplanning_sync, 'write_check_workbook',
+                            lambda path, **kwargs: None)
+        monkeypatch.setattr(devplanning_sync, 'write_combined_report',
+                            lambda path, summaries: None)
+        code, report = devplanning_sync.run_many(
+            ['South Texas', 'BRAZOS VALLEY', 'SOUTH TEXAS'], ['LEASE'],
+            str(tmp_path), max_connections=8)
+        assert pulls == [['SOUTH TEXAS', 'BRAZOS VALLEY']]
+        assert code == devplanning_sync.EXIT_FAILED
+        assert report['workers'] == 2
+        units = report['business_units']
+        assert list(units) == ['SOUTH TEXAS', 'BRAZOS VALLEY']
+        assert (units['SOUTH TEXAS']['exit_code']
+                == devplanning_sync.EXIT_PENDING)
+        assert units['SOUTH TEXAS']['rows'] == {'dev_planning': 3,
+                                                'aries': 3}
+        assert units['BRAZOS VALLEY']['rows'] == {'dev_planning': 0,
+                                                  'aries': 3}
+        assert units['BRAZOS VALLEY']['failed_stage'] == 'backups'
+        assert units['SOUTH TEXAS']['outputs'][0].startswith(
+            str(tmp_path / 'SOUTH_TEXAS'))
+
+    def test_run_many_workers_get_backend(self, monkeypatch, tmp_path):
+        executors = []
+
+        class Executor(ThreadPoolExecutor):
+            def __init__(self, **kwargs):
+                executors.append(kwargs)
+                super().__init__(**kwargs)
+
+        def load_sources(*args, **kwargs):
+            raise ConnectionError('no route to Snowflake')
+        monkeypatch.setattr(devplanning_sync, 'ProcessPoolExecutor', Executor)
+        monkeypatch.setattr(devplanning_sync, 'load_sources', load_sources)
+        monkeypatch.setattr(devplanning_sync, 'write_combined_report',
+                            lambda path, summaries: None)
+        backend = sqlite_backend(str(tmp_path / 'sync.db'))
+        previous = devplanning_syn_GUI_functions.use_backend(backend)
+        try:
+            devplanning_sync.run_many(['SOUTH TEXAS', 'BRAZOS VALLEY'],
+                                      ['LEASE'], str(tmp_path), apply=True)
+        finally:
+            devplanning_syn_GUI_functions.use_backend(previous)
+        assert executors[0]['initializer'] is (
+            devplanning_syn_GUI_functions.use_backend)
+        assert executors[0]['initargs'] == (backend,)
+        # Spawned workers get the backend pickled.
+        assert pickle.loads(pickle.dumps(backend))['aries_url'] == (
+            backend['aries_url'])
+
+    def test_run_many_clears_snapshots_once(self, monkeypatch, tmp_path):
+        cleared = []
+
+        def clear_snapshots(source, business_unit, cache_dir):
+            cleared.append((business_unit,
+                            threading.current_thread() is
+                            threading.main_thread()))
+        monkeypatch.setattr(devplanning_sync, 'ProcessPoolExecutor',
+                            ThreadPoolExecutor)
+        monkeypatch.setattr(
+            devplanning_sync, 'load_sources',
+            lambda *args, **kwargs: (
+                self.dev_planning,
+                self.aries.assign(BUSINESS_UNIT='SOUTH TEXAS'), {}))
+        for name in ('write_backup_workbook', 'write_check_workbook',
+                     'write_combined_report'):
+            monkeypatch.setattr(devplanning_sync, name,
+                                lambda *args, **kwargs: None)
+        monkeypatch.setattr(devplanning_sync, 'get_aries_engine',
+                            lambda: None)
+        monkeypatch.setattr(devplanning_sync, 'update_tables',
+                            lambda changes, engine: {'ac_user': (1, 2)})
+        monkeypatch.setattr(devplanning_sync, 'clear_snapshots',
+                            clear_snapshots)
+        devplanning_sync.run_many(['SOUTH TEXAS', 'BRAZOS VALLEY'],
+                                  ['LEASE'], str(tmp_path), apply=True)
+        # Only SOUTH TEXAS had values to push.
+        assert cleared == [('SOUTH TEXAS', True)]
+
+    def test_apply_updates_cache_error(self, monkeypatch):
+        def clear_snapshots(*args, **kwargs):
+            raise FileNotFoundError('aries_SOUTH_TEXAS.arrow')
+        monkeypatch.setattr(devplanning_sync, 'aries_changes',
+                            lambda *args: [])
+        monkeypatch.setattr(devplanning_sync, 'update_tables',
+                            lambda changes, engine: {'ac_user': (1, 2)})
+        monkeypatch.setattr(devplanning_sync, 'clear_snapshots',
+                            clear_snapshots)
+        summary = {'business_unit': 'SOUTH TEXAS', 'fields': ['LEASE'],
+                   'stages': {}, 'checks': {'pending_updates': 1}}
+        devplanning_sync.apply_updates(
+            summary, {'results': None, 'combined_df': None}, object())
+        # The push went through, so the run hasn't failed.
+        assert summary['updates'] == {'ac_user': {'rows': 1, 'ms': 2}}
+        assert summary['cache_error'].startswith('FileNotFoundError')
+        assert (devplanning_sync.exit_code(summary)
+                == devplanning_sync.EXIT_PENDING)
+
+    def test_default_fields(self):
+        args = devplanning_sync._parser().parse_args(
+            ['run', '--bu', 'SOUTH TEXAS', '--out', '.'])
+        # The same checks the GUI starts with ticked.
+        assert args.fields == list(FIELD_CHECKS)
+
+    def test_main_bad_field(self, capsys):
+        with pytest.raises(SystemExit) as exit_info:
+            devplanning_sync.main(['run', '--bu', 'SOUTH TEXAS', '--out', '.',
+                                   '--fields', 'NOT_A_CHECK'])
+        assert exit_info.value.code == devplanning_sync.EXIT_USAGE
+
+    def test_aries_changes(self):
+        combined_df = self.aries.merge(self.dev_planning,
+                                       left_on='ARIES_CODE',
+                                       right_on='ARIES_ID')
+        combined_df['PSID_DP'] = [1, 2]
+        combined_df['PSID_AR'] = [None, None]
+        results = compare_fields({'PSID': FIELD_CHECKS['PSID'],
+                                  'MDA': ('WELL_NAME', 'LEASE', 'text', None)},
+                                 combined_df)
+        changes = aries_changes(results, combined_df, ['PSID', 'MDA'],
+                                'South Texas')
+        assert [change[3] for change in changes] == ['USER3']
+        assert pending_updates(results) == 2
+
+
+class TestBenchmark:
+    def test_generate_sources_seeded(self):
+        dev_planning, aries = benchmark_devplanning_sync.generate_sources(
+            500, seed=3)
+        again, _ = benchmark_devplanning_sync.generate_sources(500, seed=3)
+        other, _ = benchmark_devplanning_sync.generate_sources(500, seed=4)
+        pd.testing.assert_frame_equal(dev_planning, again)
+        assert not dev_planning.equals(other)
+        assert aries.RSV_CAT.dtype == ARIES_SCHEMA['RSV_CAT']
+        assert dev_planning.ARIES_ID.duplicated().any()
+        assert aries.ARIES_CODE.duplicated().any()
+
+    def test_benchmark_stages(self):
+        report = benchmark_devplanning_sync.benchmark(
+            *benchmark_devplanning_sync.generate_sources(200), repeat=1)
+        assert 'compare_fields' in report
+        assert all(stage['seconds'] >= 0 and stage['peak_mb'] >= 0
+                   for stage in report.values())
+
+    def test_benchmark_end_to_end(self, tmp_path):
+        report = benchmark_devplanning_sync.benchmark_end_to_end(
+            *benchmark_devplanning_sync.generate_sources(200), repeat=1,
+            folder=str(tmp_path))
+        assert list(report) == ['sqlite_seed', 'sqlite_pull', 'sqlite_check',
+                                'sqlite_update', 'sqlite_qc']
+        assert devplanning_syn_GUI_functions.backend['name'] == 'production'
+
+    def test_compare_to_baseline(self):
+        parameters = {'seed': 0}
+        baseline = {'parameters': parameters,
+                    'results': {'10': {'combine': {'seconds': 1.0},
+                                       'compare': {'seconds': 0.01}}}}
+        report = {'parameters': parameters,
+                  'results': {'10': {'combine': {'seconds': 1.5},
+                                     'compare': {'seconds': 0.03},
+                                     'new': {'seconds': 9.0}},
+                              '20': {'combine': {'seconds': 9.0}}}}
+        regressions = benchmark_devplanning_sync.compare_to_baseline(
+            report, baseline)
+        # compare tripled but only by 20 ms, and new has nothing to compare.
+        assert len(regressions) == 1 and regressions[0].startswith('combine')
+        assert not benchmark_devplanning_sync.compare_to_baseline(
+            report, baseline, tolerance=0.6)
+        with pytest.raises(ValueError):
+            benchmark_devplanning_sync.compare_to_baseline(
+                report, dict(baseline, parameters={'seed': 1}))
+
+
+class TestTrace:
+    @staticmethod
+    def pull(name):
+        with trace_stage(name):
+            pass
+
+    def test_trace_stage_without_trace(self):
+        with trace_stage('idle', 3) as record:
+            record['rows_out'] = 2
+        assert 'seconds' not in record
+
+    def test_tracing(self, tmp_path):
+        with tracing('SOUTH TEXAS', memory=True) as trace:
+            with trace_stage('build', 0) as record:
+                frame = pd.DataFrame({'A': np.arange(1000)})
+                record['rows_out'] = len(frame)
+            with pytest.raises(KeyError):
+                with trace_stage('lookup', len(frame)):
+                    frame['B']
+            # Pool threads only record when run in a copy of the caller's
+            # context, as load_sources does.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(self.pull, 'lost').result()
+                executor.submit(contextvars.copy_context().run, self.pull,
+                                'pull').result()
+        build, lookup, pull = trace['stages']
+        assert build['rows_out'] == 1000 and build['traced_peak_mb'] >= 0
+        assert lookup['error'].startswith('KeyError')
+        assert pull['stage'] == 'pull' and pull['thread'] != build['thread']
+
+        path = save_trace(trace, str(tmp_path / 'trace.json'))
+        with open(path) as trace_file:
+            assert json.load(trace_file)['stages'][0]['stage'] == 'build'
+
+    def test_run_stages_stops_at_failed_stage(self):
+        shown = []
+        ran = []
+
+        def pull():
+            # Like the GUI's stage functions: the error is caught and shown,
+            # then StageFailed is raised on the worker thread.
+            try:
+                raise ConnectionError('no route to Snowflake')
+            except ConnectionError:
+                shown.append('Connection Failed')
+                raise StageFailed('Connection Failed')
+        stages = [('Pull', pull),
+                  ('Checks', lambda: ran.append('Checks'))]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            outcome, timings, trace = executor.submit(
+                run_stages, stages,
+                on_stage=lambda name, timings: ran.append(name)).result()
+        assert outcome == 'Pull failed: Connection Failed'
+        assert shown == ['Connection Failed'] and ran == ['Pull']
+        assert timings == []
+        assert trace['stages'][0]['error'].startswith('StageFailed')
+
+    def test_run_stages_cancelled(self):
+        ran = []
+        outcome, timings, _ = run_stages(
+            [('Checks', lambda: ran.append('Checks')),
+             ('Backups', lambda: ran.append('Backups'))],
+            cancelled=lambda: bool(ran))
+        assert outcome == 'Cancelled' and ran == ['Checks']
+        assert [name for name, _ in timings] == ['Checks']
+
+
+class TestSqliteBackend:
+    fields = ['LEASE', 'LATERAL_LEN', 'SH_LOCATION', 'PLANNED_LL']
+
+    @pytest.fixture
+    def backend(self, tmp_path):
+        path = str(tmp_path / 'sync.db')
+        seed_sqlite(path, *benchmark_devplanning_sync.generate_sources(200))
+        previous = devplanning_syn_GUI_functions.use_backend(
+            sqlite_backend(path))
+        yield
+        devplanning_syn_GUI_functions.use_backend(previous)
+
+    def pull(self, semi_join=None):
+        return devplanning_syn_GUI_functions.load_sources(
+            'SOUTH TEXAS', dev_planning_columns(self.fields), True,
+            semi_join=semi_join)[:2]
+
+    def test_pull_update_round_trip(self, backend):
+        checks = devplanning_sync.check(*self.pull(), self.fields)
+        assert pending_updates(checks['results'])
+
+        timings = update_tables(
+            aries_changes(checks['results'], checks['combined_df'],
+                          self.fields, 'SOUTH TEXAS'),
+            devplanning_syn_GUI_functions.get_aries_engine())
+        assert timings['ac_property_base'][0] > 0
+        assert timings['ac_budget_base'][0] > 0
+
+        for semi_join in (None, 'aries', 'dev_planning'):
+            checks = devplanning_sync.check(*self.pull(semi_join),
+                                            self.fields)
+            assert pending_updates(checks['results']) == 0
+
+    def test_apply_updates_clears_backend_snapshot(self, backend):
+        pytest.importorskip('pyarrow')
+        cache_dir = devplanning_syn_GUI_functions.current_backend()[
+            'cache_dir']
+        dev_planning, aries, _ = devplanning_syn_GUI_functions.load_sources(
+            'SOUTH TEXAS', dev_planning_columns(self.fields))
+        assert snapshot_info('aries', 'SOUTH TEXAS', cache_dir)
+        summary = {'business_unit': 'SOUTH TEXAS', 'fields': self.fields,
+                   'stages': {}}
+        devplanning_sync.apply_updates(
+            summary, devplanning_sync.check(dev_planning, aries, self.fields))
+        assert 'error' not in summary
+        assert snapshot_info('aries', 'SOUTH TEXAS', cache_dir) is None
+        assert snapshot_info('dev_planning', 'SOUTH TEXAS', cache_dir)
+
+    def test_incremental_pull_several_rows_per_key(self, tmp_path,
+                                                   monkeypatch):
+        pytest.importorskip('pyarrow')
+        path = str(tmp_path / 'sync.db')
+        dev_planning = pd.DataFrame({
+            'ARIES_ID': ['TEST001', 'TEST001', 'TEST002'],
+            'WELL_NAME': ['Well 1', 'Well 1', 'Well 2'],
+            'RSV_CAT': '5PUD',
+            'BUSINESS_UNIT': 'SOUTH TEXAS',
+            'SCENARIO': ['A', 'MDV', 'A'],
+            'DEV_STATUS': 'PRIMARY',
+            'LAST_MODIFIED': ['2023-01-01', '2023-01-01', '2023-01-02']})
+        seed_sqlite(path, dev_planning,
+                    benchmark_devplanning_sync.generate_sources(10)[1])
+        monkeypatch.setitem(devplanning_syn_GUI_functions.WATERMARKS,
+                            'dev_planning', 'DP.LAST_MODIFIED')
+        previous = devplanning_syn_GUI_functions.use_backend(
+            sqlite_backend(path))
+        try:
+            devplanning_syn_GUI_functions._load_snowflake('SOUTH TEXAS')
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.execute("UPDATE DEV_PLANNING SET WELL_NAME = 'Well 1 "
+                             "MDV', LAST_MODIFIED = '2023-01-03' WHERE "
+                             "SCENARIO = 'MDV'")
+            conn.close()
+            actual = devplanning_syn_GUI_functions._load_snowflake(
+                'SOUTH TEXAS', ttl=-1)
+        finally:
+            devplanning_syn_GUI_functions.use_backend(previous)
+        assert actual.attrs['pull']['mode'] == 'incremental'
+        actual = actual.sort_values(['ARIES_ID', 'SCENARIO'])
+        assert list(actual.WELL_NAME) == ['Well 1', 'Well 1 MDV', 'Well 2']
+
 
 class TestUpdateTable:
     check_table_dict = {
@@ -166,7 +1256,14 @@ class TestUpdateTable:
     Driver = 'ODBC Driver 17 for SQL Server'
     database_url = f"mssql://@{Server}/{Database}?driver={Driver}"
 
-    engine = sqlalchemy.create_engine(database_url)
-    engine.table_names()
-
-    update_wd()
+    def test_working_district_tables(self):
+        # Needs the ODBC driver and a login to Working District, so it is
+        # skipped anywhere else.
+        try:
+            engine = sqlalchemy.create_engine(self.database_url)
+            tables = sqlalchemy.inspect(engine).get_table_names(
+                schema='AriesAdmin')
+        except Exception as e:
+            pytest.skip(f"Can't reach Working District: {e}")
+        assert {'AC_PROPERTY_BASE', 'AC_BUDGET_BASE', 'AC_USER'} <= {
+            table.upper() for table in tables}